@@ -1,7 +1,39 @@
 USERS_FILE = "data/users.json"
+USERS_INDEX_FILE = "data/users.idx.json"
+# Индекс имён пользователей делится на столько разделов (data/users.idx/names-NN.jsonl)
+USERS_INDEX_PARTITIONS = 64
 PORTFOLIOS_FILE = "data/portfolios.json"
+PORTFOLIOS_JOURNAL_FILE = "data/portfolios.journal.jsonl"
+JOURNAL_ARCHIVE_DIR = "data/journal"
+# Портфели по файлам пользователей: data/portfolios/<шард>/<user_id>.json
+PORTFOLIOS_DIR = "data/portfolios"
+PORTFOLIO_SHARDS = 16
+# Снимок портфелей после стольких записей журнала
+JOURNAL_SNAPSHOT_EVERY = 1000
+# Пауза ведущего потока перед групповой фиксацией, с (0 — без ожидания)
+JOURNAL_GROUP_COMMIT_DELAY = 0.0
 RATES_FILE = "data/rates.json"
 HISTORY_RATES_FILE: str = "data/exchange_rates.json"
+HISTORY_DIR: str = "data/history"
+COLUMNAR_DIR: str = "data/columnar"
+ROLLUPS_DIR: str = "data/rollups"
+COINS_FILE: str = "data/coins.json"
+API_BUDGET_FILE: str = "data/api_budget.json"
+# Журнал фонового обновления курсов (сообщения планировщика вместо stdout)
+LOG_FILE: str = "data/valutatrade.log"
+DATABASE_FILE: str = "data/valutatrade.db"
+# Хранилище пользователей и портфелей: sqlite, json (users.json и portfolios.json)
+# или sharded (users.json и портфели по шардам в PORTFOLIOS_DIR)
+STORAGE_BACKEND: str = "sqlite"
+# Переменные окружения для выбора хранилища и файла базы без правки кода
+STORAGE_BACKEND_ENV: str = "VALUTATRADE_STORAGE"
+DATABASE_FILE_ENV: str = "VALUTATRADE_DATABASE"
+# Сеанс CLI сохраняет каждую сделку сразу (1). Пакетное сохранение — по желанию:
+# при N > 1 сделки копятся в памяти и сохраняются одной записью каждые N сделок,
+# а также при logout, exit, конце ввода и завершении процесса (SIGTERM, SIGHUP)
+SESSION_FLUSH_EVERY: int = 1
+# Сколько раз сеанс повторяет сохранение после конфликта версий портфеля
+SESSION_FLUSH_RETRIES: int = 3
     
 HELP_TEXT = """   
     Доступные команды:
@@ -10,8 +42,13 @@ HELP_TEXT = """
       show-portfolio --base <валюта> (опционально) — показать все кошельки и итоговую стоимость в базовой валюте (по умолчанию USD)
       buy --currency <валюта> --amount <число> — купить валюту
       sell --currency <валюта> --amount <число> — продать валюту
-      get-rate  --from <валюта> --to <валюта> — получить текущий курс одной валюты к другой (автоматическое обновление если данные обновлялись более 5 минут назад)
+      orders --file <файл.jsonl> --mode <all|best-effort> (опционально) — исполнить пакет ордеров из файла по одному снимку курсов (по умолчанию all: всё или ничего)
+      get-rate  --from <валюта> --to <валюта> — получить текущий курс одной валюты к другой (если данные старше 5 минут, обновление запускается в фоне)
+      get-rate  --from <валюта> --to <валюта> --at <время ISO 8601> — курс на момент времени по истории
       update — обновить курсы валют
+      history --pair <валюта> --interval <5m|1h|1d> --limit <число> (опционально) — свечи OHLC по истории курса к USD
+      compact — свернуть старую историю курсов в часовые и дневные свечи
+      budget — остаток бюджета запросов к API курсов
       logout — завершить сессию
       help — справка
       exit — выход
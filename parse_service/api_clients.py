@@ -1,21 +1,285 @@
 import requests
+from requests.adapters import HTTPAdapter
 from abc import ABC, abstractmethod
-from typing import Dict
+from typing import Dict, List, Optional, Tuple
 from parse_service.config import config  
+from parse_service.budget import RequestBudget, request_budget, unlimited_budget
+from parse_service.circuit_breaker import CircuitBreaker
+from parse_service.console import echo, submit
 import time
 import hashlib
 from datetime import datetime
 import json
+import random
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
 
 class ApiRequestError(Exception):
     """Исключение для ошибок при запросах к API."""
     pass
 
+
+class FetchCancelledError(Exception):
+    """Исключение: опрос источника отменён (истёк общий дедлайн обновления)."""
+    pass
+
+
+class RatesNotModified(Exception):
+    """Исключение: источник ответил 304 — данные не изменились с прошлого опроса."""
+    def __init__(self, source: str):
+        self.source = source
+        super().__init__(f"Данные {source} не изменились (304 Not Modified)")
+
+
+class BudgetExhaustedError(ApiRequestError):
+    """Исключение: бюджет запросов к источнику исчерпан, запрос не выполнялся."""
+    def __init__(self, source: str, retry_in: float):
+        self.source = source
+        self.retry_in = retry_in
+        super().__init__(
+            f"Бюджет запросов к {source} исчерпан, следующий запрос возможен через {retry_in:.0f} с"
+        )
+
+
+class CircuitOpenError(ApiRequestError):
+    """Исключение: источник отключён предохранителем, запрос не выполнялся."""
+    def __init__(self, source: str, retry_in: float):
+        self.source = source
+        self.retry_in = retry_in
+        super().__init__(f"Источник {source} недоступен, повторная попытка через {retry_in:.0f} с")
+
 class BaseApiClient(ABC):
     """Абстрактный базовый класс для клиентов внешних API."""
+
+    # Общая для всех клиентов сессия с пулом keep-alive соединений
+    _session: Optional[requests.Session] = None
+    _session_lock = threading.Lock()
+
+    # Коды ответа, при которых запрос повторяется с экспоненциальной задержкой
+    RETRY_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
     
-    def __init__(self):
+    def __init__(self, budget: Optional[RequestBudget] = None):
+        """
+        Args:
+            budget: бюджет запросов (по умолчанию общий request_budget, а при
+                заданном RATES_STANDIN_URL — без ограничений).
+        """
+        if budget is None:
+            budget = unlimited_budget if config.RATES_STANDIN_URL else request_budget
+        self.budget = budget
         self._source = None  
+        self._cancel_event = threading.Event()
+        # Валидаторы последнего успешного ответа (ETag / Last-Modified)
+        self._validators: Dict[str, str] = {}
+        # Записи последнего успешного ответа — актуальны, пока источник отвечает 304
+        self._last_rates: list = []
+        self._breaker: Optional[CircuitBreaker] = None
+
+    @property
+    def breaker(self) -> CircuitBreaker:
+        """Предохранитель источника (создаётся при первом обращении, когда известно имя)."""
+        if self._breaker is None:
+            self._breaker = CircuitBreaker(
+                self._source,
+                config.CIRCUIT_FAILURE_THRESHOLD,
+                config.CIRCUIT_COOLDOWN
+            )
+        return self._breaker
+
+    def fetch(self) -> list:
+        """
+        Опрашивает источник через предохранитель.
+
+        Raises:
+            CircuitOpenError: источник отключён после серии неудач, запрос не выполнялся.
+            BudgetExhaustedError: бюджет запросов исчерпан (не считается неудачей).
+            RatesNotModified: данные не изменились (считается успехом).
+            ApiRequestError, FetchCancelledError: неудачный опрос (учитывается предохранителем).
+        """
+        if self.budget.available(self._source) < 1:
+            # Бюджет исчерпан — не тратим пробный запрос предохранителя
+            raise BudgetExhaustedError(self._source, self.budget.status()[self._source]["retry_in"])
+        if not self.breaker.allow_request():
+            raise CircuitOpenError(self._source, self.breaker.retry_in())
+        try:
+            rates = self.fetch_rates()
+        except RatesNotModified:
+            self.breaker.record_success()
+            raise
+        except BudgetExhaustedError:
+            # Источник не ответил, но и не виноват: ни успехом, ни неудачей не считается
+            self.breaker.release()
+            raise
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        return rates
+
+    @property
+    def last_rates(self) -> list:
+        """Записи последнего успешного (200) ответа источника."""
+        return self._last_rates
+
+    def _conditional_headers(self) -> Dict[str, str]:
+        """Заголовки условного запроса по валидаторам прошлого ответа."""
+        headers = {}
+        if self._validators.get("etag"):
+            headers["If-None-Match"] = self._validators["etag"]
+        if self._validators.get("last_modified"):
+            headers["If-Modified-Since"] = self._validators["last_modified"]
+        return headers
+
+    def _check_not_modified(self, response: requests.Response) -> None:
+        """Прерывает обработку, если сервер ответил 304 Not Modified."""
+        if response.status_code == 304:
+            echo(f"Данные {self._source} не изменились")
+            raise RatesNotModified(self._source)
+
+    def _make_batch(self, response: requests.Response, attempts_ms: List[int], timestamp: str) -> Dict:
+        """
+        Метаданные одного ответа API (общие для всех его записей).
+        Отпечаток тела ответа считается один раз, если сервер не прислал ETag.
+        """
+        etag = response.headers.get("ETag", "")
+        return {
+            "batch_id": uuid.uuid4().hex[:16],
+            "source": self._source,
+            "timestamp": timestamp,
+            "request_ms": attempts_ms[-1],
+            "attempts_ms": attempts_ms,
+            "status_code": response.status_code,
+            "etag": etag or f"W/\"{hashlib.md5(response.content).hexdigest()[:6]}\""
+        }
+
+    def _remember_validators(self, response: requests.Response, rates: list) -> None:
+        """Запоминает ETag / Last-Modified и записи успешного ответа."""
+        self._validators = {
+            "etag": response.headers.get("ETag", ""),
+            "last_modified": response.headers.get("Last-Modified", "")
+        }
+        self._last_rates = rates
+
+    @classmethod
+    def get_session(cls) -> requests.Session:
+        """Возвращает общую сессию, создавая её при первом обращении."""
+        if BaseApiClient._session is None:
+            with BaseApiClient._session_lock:
+                if BaseApiClient._session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(
+                        pool_connections=config.HTTP_POOL_SIZE,
+                        pool_maxsize=config.HTTP_POOL_SIZE
+                    )
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    BaseApiClient._session = session
+        return BaseApiClient._session
+
+    @classmethod
+    def close_session(cls) -> None:
+        """Закрывает общую сессию и все соединения пула."""
+        with BaseApiClient._session_lock:
+            if BaseApiClient._session is not None:
+                BaseApiClient._session.close()
+                BaseApiClient._session = None
+
+    def _backoff_delay(self, attempt: int, response: Optional[requests.Response]) -> float:
+        """
+        Задержка перед повтором: экспонента с полным джиттером.
+        Заголовок Retry-After (если он есть и задан в секундах) имеет приоритет.
+        """
+        if response is not None:
+            retry_after = response.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                return min(float(retry_after), config.HTTP_BACKOFF_MAX)
+        ceiling = min(config.HTTP_BACKOFF_MAX, config.HTTP_BACKOFF_BASE * (2 ** attempt))
+        return random.uniform(0, ceiling)
+
+    def _request(
+        self,
+        url: str,
+        params: Optional[dict] = None,
+        headers: Optional[dict] = None
+    ) -> Tuple[requests.Response, List[int]]:
+        """
+        Выполняет GET через общую сессию с повторами для 429/5xx и ошибок
+        соединения. Тайм‑аут не повторяется: недоступный источник стоит одного
+        REQUEST_TIMEOUT, а не HTTP_MAX_RETRIES + 1 тайм‑аутов с задержками.
+
+        Returns:
+            Последний ответ и длительность каждой попытки в миллисекундах.
+
+        Raises:
+            requests.exceptions.RequestException: тайм‑аут или сетевая ошибка во всех попытках.
+            FetchCancelledError: если опрос отменён во время ожидания повтора.
+            BudgetExhaustedError: если бюджет запросов источника исчерпан до первой попытки.
+        """
+        session = self.get_session()
+        attempts_ms = []
+        attempt = 0
+        response = None
+        error = None
+        # Пробный запрос к отключённому источнику — одна попытка, без повторов
+        max_retries = 0 if self.breaker.state == CircuitBreaker.HALF_OPEN else config.HTTP_MAX_RETRIES
+        while True:
+            self._check_cancelled()
+            # Каждая попытка расходует токен общего бюджета запросов источника
+            allowed, retry_in = self.budget.try_acquire(self._source)
+            if not allowed:
+                # Повтор не на что делать: неудача предыдущей попытки остаётся результатом
+                if error is not None:
+                    raise error
+                if response is not None:
+                    return response, attempts_ms
+                raise BudgetExhaustedError(self._source, retry_in)
+            start_time = time.monotonic()
+            try:
+                response = session.get(url, params=params, headers=headers, timeout=self.timeout)
+            except requests.exceptions.Timeout:
+                # Источник не ответил за REQUEST_TIMEOUT — повтор почти наверняка тоже истечёт
+                raise
+            except requests.exceptions.ConnectionError as e:
+                attempts_ms.append(int((time.monotonic() - start_time) * 1000))
+                if attempt >= max_retries:
+                    raise
+                response = None
+                error = e
+            else:
+                error = None
+                attempts_ms.append(int((time.monotonic() - start_time) * 1000))
+                if response.status_code == 429:
+                    # Источник сам сообщил о превышении лимита — дальше ждём пополнения бюджета
+                    self.budget.exhaust(self._source)
+                if (response.status_code not in self.RETRY_STATUS_CODES
+                        or attempt >= max_retries):
+                    return response, attempts_ms
+
+            delay = self._backoff_delay(attempt, response)
+            echo(f"{self._source}: попытка {attempt + 1} неуспешна, повтор через {delay:.2f} с")
+            # Ожидание прерывается отменой опроса
+            if self._cancel_event.wait(delay):
+                self._check_cancelled()
+            attempt += 1
+
+    def cancel(self) -> None:
+        """Отменяет текущий опрос: результат, полученный после отмены, будет отброшен."""
+        self._cancel_event.set()
+
+    def reset_cancel(self) -> None:
+        """Сбрасывает флаг отмены перед новым опросом."""
+        self._cancel_event.clear()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel_event.is_set()
+
+    def _check_cancelled(self) -> None:
+        """Прерывает обработку ответа, если опрос уже отменён."""
+        if self._cancel_event.is_set():
+            raise FetchCancelledError(f"Опрос {self._source} отменён")
 
     @abstractmethod
     def fetch_rates(self) -> Dict[str, float]:
@@ -28,93 +292,176 @@ class BaseApiClient(ABC):
         return self._source
 
 class CoinGeckoClient(BaseApiClient):
-    """Клиент для работы с API CoinGecko."""
+    """
+    Клиент для работы с API CoinGecko.
+
+    Список монет (config.CRYPTO_ID_MAP) делится на части, умещающиеся в URL;
+    части запрашиваются параллельно, поэтому время обновления почти не
+    растёт с числом монет. За одно обновление выполняется не больше
+    COINGECKO_REQUEST_BUDGET запросов — не поместившиеся части
+    опрашиваются следующим обновлением по кругу.
+    """
 
-    def __init__(self):
+    def __init__(self, budget: Optional[RequestBudget] = None):
+        super().__init__(budget)
         self.url = config.COINGECKO_URL
         self.timeout = config.REQUEST_TIMEOUT
         self._source = "CoinGecko"
+        # Валидаторы ответов (ETag / Last-Modified) отдельно для каждой части списка
+        self._chunk_validators: Dict[str, Dict[str, str]] = {}
+        # С какой части начинать, если все части не укладываются в бюджет запросов
+        self._chunk_offset = 0
+
+    def chunk_ids(self, ids: List[str]) -> List[List[str]]:
+        """Делит ids на части: URL запроса не длиннее COINGECKO_MAX_URL_LENGTH."""
+        vs = config.BASE_CURRENCY.lower()
+        base_length = len(f"{self.url}?ids=&vs_currencies={vs}")
+        chunks: List[List[str]] = []
+        current: List[str] = []
+        length = base_length
+        for cg_id in ids:
+            # Запятая между ids кодируется как %2C
+            extra = len(quote(cg_id, safe="")) + (3 if current else 0)
+            if current and (
+                length + extra > config.COINGECKO_MAX_URL_LENGTH
+                or len(current) >= config.COINGECKO_CHUNK_SIZE
+            ):
+                chunks.append(current)
+                current, length = [], base_length
+                extra = len(quote(cg_id, safe=""))
+            current.append(cg_id)
+            length += extra
+        if current:
+            chunks.append(current)
+        return chunks
+
+    def _select_chunks(self, chunks: List[List[str]]) -> List[List[str]]:
+        """Части для текущего обновления в пределах бюджета запросов (по кругу)."""
+        budget = max(config.COINGECKO_REQUEST_BUDGET, 1)
+        if len(chunks) <= budget:
+            return chunks
+        start = self._chunk_offset % len(chunks)
+        self._chunk_offset = start + budget
+        selected = [chunks[(start + i) % len(chunks)] for i in range(budget)]
+        echo(f"CoinGecko: {len(chunks) - budget} из {len(chunks)} частей отложены до следующего обновления")
+        return selected
+
+    def _fetch_chunk(self, chunk: List[str], timestamp: str) -> Optional[list]:
+        """
+        Запрашивает курсы одной части списка монет.
+
+        Returns:
+            Записи курсов или None, если часть не изменилась (304).
+        """
+        key = ",".join(chunk)
+        validators = self._chunk_validators.get(key, {})
+        headers = {}
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+
+        params = {"ids": key, "vs_currencies": config.BASE_CURRENCY.lower()}
+        response, attempts_ms = self._request(self.url, params=params, headers=headers)
+        self._check_cancelled()
+        if response.status_code == 304:
+            return None
+        response.raise_for_status()
+        data = response.json()
+        batch = self._make_batch(response, attempts_ms, timestamp)
+
+        codes = {cg_id: code for code, cg_id in config.CRYPTO_ID_MAP.items()}
+        result = []
+        for cg_id in chunk:
+            if cg_id not in data:
+                echo(f"Данные для {cg_id} не найдены")
+                continue
+            result.append({
+                "from_currency": codes[cg_id],
+                "to_currency": config.BASE_CURRENCY,
+                "rate": data[cg_id][config.BASE_CURRENCY.lower()],
+                "timestamp": timestamp,
+                "source": self._source,
+                "meta": {
+                    "raw_id": cg_id,
+                    "batch_id": batch["batch_id"]
+                },
+                "batch": batch
+            })
+        self._chunk_validators[key] = {
+            "etag": response.headers.get("ETag", ""),
+            "last_modified": response.headers.get("Last-Modified", "")
+        }
+        return result
 
     def fetch_rates(self) -> Dict[str, float]:
- 
-        ids = ",".join(config.CRYPTO_ID_MAP.values())                    
-        params = {
-                "ids": ids,
-                "vs_currencies": config.BASE_CURRENCY.lower()
-            }
-            
-        start_time = time.time()
-            
-        try:
-            print("Подключаюсь к CoinGecko...")
-            response = requests.get(self.url, params=params, timeout=config.REQUEST_TIMEOUT)
-            request_ms = int((time.time() - start_time) * 1000)
-            status_code = response.status_code
-            etag = response.headers.get("ETag", "")
-            response.raise_for_status()         
-            data = response.json()
-            timestamp = datetime.now().isoformat()
+        chunks = self._select_chunks(self.chunk_ids(list(config.CRYPTO_ID_MAP.values())))
+        timestamp = datetime.now().isoformat()
 
-            result = []
-            for code, cg_id in config.CRYPTO_ID_MAP.items():
-                if cg_id in data:
-                    rate = data[cg_id][config.BASE_CURRENCY.lower()]
-                    temp = {
-                        "from_currency": code,
-                        "to_currency": config.BASE_CURRENCY,
-                        "rate": rate,  
-                        "timestamp": timestamp,
-                        "source": self._source,
-                        "meta": {
-                            "raw_id": cg_id,
-                            "request_ms": request_ms,
-                            "status_code": status_code,
-                            "etag": etag or f"W/\"{hashlib.md5(response.text.encode()).hexdigest()[:6]}\""
-
-                        }
-                    }
-                    result.append(temp)
-                else:
-                    print(f"Данные для {cg_id} не найдены")
-            print("Курсы валют от CoinGecko получены")
-            return result
-                
-        except requests.exceptions.RequestException as e:
-            print(f"Ошибка запроса к API: {e}")
-            return []
-        except json.JSONDecodeError as e:
-            print(f"Ошибка парсинга JSON: {e}")
-            return []            
-        except Exception as e:
-                print(e)
+        echo(f"Подключаюсь к CoinGecko ({len(chunks)} запр.)...")
+        results = []
+        errors = []
+        budget_errors = []
+        workers = min(config.COINGECKO_MAX_PARALLEL, len(chunks)) or 1
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="coingecko") as executor:
+            futures = [submit(executor, self._fetch_chunk, chunk, timestamp) for chunk in chunks]
+            for future in futures:
+                try:
+                    results.append(future.result())
+                except (FetchCancelledError, RatesNotModified):
+                    raise
+                except BudgetExhaustedError as e:
+                    budget_errors.append(e)
+                    errors.append(str(e))
+                except requests.exceptions.RequestException as e:
+                    errors.append(f"Ошибка при запросе к CoinGecko: {e}")
+                except (json.JSONDecodeError, KeyError, TypeError) as e:
+                    errors.append(f"Некорректный ответ CoinGecko: {e}")
+
+        if errors and not results:
+            # Не получено ничего только из‑за бюджета — это не сбой источника
+            if len(budget_errors) == len(errors):
+                raise budget_errors[0]
+            raise ApiRequestError(errors[0])
+        for error in errors:
+            # Часть списка не получена: её пары остаются из прежнего снимка
+            echo(error)
+
+        if results and all(chunk_rates is None for chunk_rates in results):
+            echo(f"Данные {self._source} не изменились")
+            raise RatesNotModified(self._source)
+
+        rates = [record for chunk_rates in results if chunk_rates for record in chunk_rates]
+        echo("Курсы валют от CoinGecko получены")
+        self._last_rates = rates
+        return rates
 
 
 
 class ExchangeRateApiClient(BaseApiClient):
     """Клиент для работы с API ExchangeRate."""
 
-    def __init__(self):
+    def __init__(self, budget: Optional[RequestBudget] = None):
+        super().__init__(budget)
         self.timeout = config.REQUEST_TIMEOUT
         self._source = "ExchangeRate-API"
         self._url = config.EXCHANGERATE_API_URL
 
     def fetch_rates(self) -> Dict[str, float]:
-        start_time = time.time()
         try:
-            print("Подключаюсь к ExchangeRate...")
-            response = requests.get(self._url, timeout=self.timeout)
-            request_ms = int((time.time() - start_time) * 1000)
-            status_code = response.status_code
-            etag = response.headers.get("ETag", "")
+            echo("Подключаюсь к ExchangeRate...")
+            response, attempts_ms = self._request(self._url, headers=self._conditional_headers())
+            self._check_cancelled()
+            self._check_not_modified(response)
             data = response.json()
             
             if data.get("result") != "success":
-                print(f"Ошибка API: {data.get('result')}")
-                return []
+                raise ApiRequestError(f"Ошибка API ExchangeRate: {data.get('error-type', data.get('result'))}")
             
             
             rates = []
             timestamp = datetime.now().isoformat()
+            batch = self._make_batch(response, attempts_ms, timestamp)
 
             for from_currency, rate in data['conversion_rates'].items():
                 temp = {"from_currency": from_currency,
@@ -123,20 +470,21 @@ class ExchangeRateApiClient(BaseApiClient):
                         "timestamp": timestamp,
                         "source":self._source,
                         "meta": {"raw_id": from_currency,
-                                "request_ms": request_ms,
-                                "status_code": status_code,
-                                "etag": etag or f"W/\"{hashlib.md5(response.text.encode()).hexdigest()[:5]}\""
-                        }
+                                "batch_id": batch["batch_id"]
+                        },
+                        "batch": batch
                 }
                 rates.append(temp)
-            print("Курсы валют от ExchangeRate получены")
+            echo("Курсы валют от ExchangeRate получены")
+            # Монеты с такими же символами больше не опрашиваются
+            config.exclude_fiat_codes(data['conversion_rates'])
+            self._remember_validators(response, rates)
             return rates
 
         except requests.exceptions.RequestException as e:
             raise ApiRequestError(f"Ошибка при запросе к ExchangeRate: {e}") from e            
-        except json.JSONDecodeError as e:
-            print(f"Ошибка парсинга JSON: {e}")
-            return []            
-        except Exception as e:
-                print(e)
+        except (json.JSONDecodeError, KeyError, TypeError, ZeroDivisionError) as e:
+            raise ApiRequestError(f"Некорректный ответ ExchangeRate: {e}") from e
+        except (ApiRequestError, FetchCancelledError, RatesNotModified):
+            raise
 
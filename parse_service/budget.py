@@ -0,0 +1,105 @@
+import json
+import time
+from typing import Any, Dict, Tuple
+from parse_service.config import config
+from parse_service.fileutils import atomic_write_json, file_lock
+
+
+class RequestBudget:
+    """
+    Бюджет запросов к внешним API — «ведро токенов» на каждый источник.
+
+    Ведро вмещает capacity токенов и пополняется равномерно: capacity
+    токенов за period секунд. Каждая попытка HTTP‑запроса расходует токен.
+    Состояние хранится в файле под межпроцессной блокировкой, поэтому
+    бюджет общий для всех процессов, работающих с одним каталогом data/.
+    Источники без настроенного лимита не ограничиваются, поэтому бюджет
+    с пустым limits (unlimited_budget) ничего не списывает и не трогает файл.
+    """
+
+    def __init__(self, state_path: str = None, limits: Dict[str, Tuple[int, float]] = None):
+        """
+        Args:
+            state_path: файл состояния (по умолчанию config.API_BUDGET_FILE_PATH).
+            limits: {источник: (capacity, period в секундах)} (по умолчанию config.API_BUDGETS).
+        """
+        self.state_path = state_path or config.API_BUDGET_FILE_PATH
+        self.limits = config.API_BUDGETS if limits is None else limits
+
+    def _load(self) -> Dict[str, Any]:
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _refill(self, state: Dict[str, Any], source: str, now: float) -> Dict[str, float]:
+        """Пополняет ведро источника на время, прошедшее с прошлого обращения."""
+        capacity, period = self.limits[source]
+        bucket = state.setdefault(source, {"tokens": float(capacity), "updated": now})
+        elapsed = max(now - bucket["updated"], 0.0)
+        bucket["tokens"] = min(float(capacity), bucket["tokens"] + elapsed * capacity / period)
+        bucket["updated"] = now
+        return bucket
+
+    def _retry_in(self, source: str, tokens: float) -> float:
+        """Через сколько секунд в ведре появится целый токен."""
+        capacity, period = self.limits[source]
+        return max(1.0 - tokens, 0.0) * period / capacity
+
+    def try_acquire(self, source: str, tokens: int = 1) -> Tuple[bool, float]:
+        """
+        Списывает токены, если их хватает.
+
+        Returns:
+            (получено ли разрешение, через сколько секунд появится следующий токен).
+        """
+        if not config.API_BUDGET_ENABLED or source not in self.limits:
+            return True, 0.0
+        with file_lock(self.state_path + ".lock"):
+            state = self._load()
+            bucket = self._refill(state, source, time.time())
+            allowed = bucket["tokens"] >= tokens
+            if allowed:
+                bucket["tokens"] -= tokens
+            atomic_write_json(self.state_path, state, fsync=False)
+        return allowed, self._retry_in(source, bucket["tokens"])
+
+    def available(self, source: str) -> float:
+        """Сколько токенов источника доступно сейчас (inf — без ограничения)."""
+        if not config.API_BUDGET_ENABLED or source not in self.limits:
+            return float("inf")
+        with file_lock(self.state_path + ".lock", shared=True):
+            state = self._load()
+        return self._refill(state, source, time.time())["tokens"]
+
+    def exhaust(self, source: str) -> None:
+        """Обнуляет ведро: источник сам ответил 429, ждём пополнения."""
+        if not config.API_BUDGET_ENABLED or source not in self.limits:
+            return
+        with file_lock(self.state_path + ".lock"):
+            state = self._load()
+            bucket = self._refill(state, source, time.time())
+            bucket["tokens"] = 0.0
+            atomic_write_json(self.state_path, state, fsync=False)
+
+    def status(self) -> Dict[str, Dict[str, float]]:
+        """Остаток бюджета по источникам — для мониторинга."""
+        with file_lock(self.state_path + ".lock", shared=True):
+            state = self._load()
+        now = time.time()
+        result = {}
+        for source, (capacity, period) in self.limits.items():
+            bucket = self._refill(state, source, now)
+            result[source] = {
+                "remaining": bucket["tokens"],
+                "capacity": capacity,
+                "period": period,
+                "retry_in": self._retry_in(source, bucket["tokens"])
+            }
+        return result
+
+
+request_budget = RequestBudget()
+# Для заменителя API (RATES_STANDIN_URL, замеры): настоящую квоту не расходует
+unlimited_budget = RequestBudget(limits={})
@@ -0,0 +1,105 @@
+import threading
+import time
+from datetime import datetime
+from typing import Optional
+from parse_service.console import echo
+
+
+class CircuitBreaker:
+    """
+    Предохранитель для одного источника курсов.
+
+    - closed: запросы идут как обычно, неудачи считаются подряд;
+    - open: после failure_threshold неудач подряд запросы к источнику не
+      выполняются cooldown секунд;
+    - half_open: по истечении паузы пропускается один пробный запрос —
+      успех закрывает предохранитель, неудача снова открывает его.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int, cooldown: float):
+        """
+        Args:
+            name: имя источника (для сообщений).
+            failure_threshold: число неудач подряд, после которого источник отключается.
+            cooldown: пауза в секундах до пробного запроса.
+        """
+        self.name = name
+        self.failure_threshold = max(failure_threshold, 1)
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        # Время (UTC, ISO 8601), с которого источник считается недоступным
+        self.failing_since: Optional[str] = None
+
+    @property
+    def state(self) -> str:
+        """Текущее состояние; открытый предохранитель после паузы считается полуоткрытым."""
+        with self._lock:
+            if self._state == self.OPEN and self._cooldown_passed():
+                return self.HALF_OPEN
+            return self._state
+
+    def _cooldown_passed(self) -> bool:
+        return time.monotonic() - self._opened_at >= self.cooldown
+
+    def retry_in(self) -> float:
+        """Сколько секунд осталось до пробного запроса (0 — можно пробовать)."""
+        with self._lock:
+            if self._state != self.OPEN:
+                return 0.0
+            return max(self.cooldown - (time.monotonic() - self._opened_at), 0.0)
+
+    def allow_request(self) -> bool:
+        """
+        Разрешает ли предохранитель запрос к источнику.
+        В полуоткрытом состоянии разрешается только один пробный запрос.
+        """
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN:
+                if not self._cooldown_passed():
+                    return False
+                self._state = self.HALF_OPEN
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+            return True
+
+    def record_success(self) -> None:
+        """Успешный ответ: предохранитель закрывается, счётчик неудач сбрасывается."""
+        with self._lock:
+            if self._state != self.CLOSED:
+                echo(f"{self.name}: источник снова доступен")
+            self._state = self.CLOSED
+            self._failures = 0
+            self._probe_in_flight = False
+            self.failing_since = None
+
+    def release(self) -> None:
+        """
+        Запрос не дошёл до источника (например, кончился бюджет запросов):
+        состояние и счётчик неудач не меняются, освобождается только место
+        пробного запроса.
+        """
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        """Неудачный запрос: при достижении порога (или неудачной пробе) предохранитель открывается."""
+        with self._lock:
+            self._failures += 1
+            self._probe_in_flight = False
+            if self.failing_since is None:
+                self.failing_since = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+                echo(f"{self.name}: источник отключён на {self.cooldown:.0f} с после {self._failures} неудач")
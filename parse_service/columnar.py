@@ -0,0 +1,296 @@
+import json
+import mmap
+import os
+import shutil
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from parse_service.config import config
+from parse_service.fileutils import InterProcessLock, atomic_write_json
+from parse_service.history import HistoryStore, history_store
+
+
+INDEX_NAME = "index.json"
+ITEM_SIZE = array('d').itemsize
+
+
+def parse_timestamp(value: str) -> float:
+    """Переводит метку вида 2026-10-17T12:00:00Z в секунды Unix (UTC)."""
+    return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+
+class PairColumns:
+    """
+    Столбцы истории одной пары, отображённые в память.
+
+    timestamps и rates — memoryview формата 'd' поверх mmap: срезы не копируют
+    данные. Объект держит отображения открытыми до вызова close().
+    """
+
+    def __init__(self, pair: str, timestamps: memoryview, rates: memoryview, maps: list, sparse: list):
+        self.pair = pair
+        self.timestamps = timestamps
+        self.rates = rates
+        self._maps = maps
+        self._sparse = sparse
+        self._sparse_keys = [entry[0] for entry in sparse]
+        # Каталог поколения столбцов: меняется при компакции
+        self.generation = pair
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self) -> None:
+        """
+        Освобождает отображения файлов. Если снаружи ещё живут срезы или
+        массивы NumPy поверх столбцов, отображение закроется сборщиком мусора.
+        """
+        try:
+            self.timestamps.release()
+            self.rates.release()
+            for mapped in self._maps:
+                mapped.close()
+        except BufferError:
+            pass
+        self._maps = []
+
+    def _bounds(self, ts: float) -> Tuple[int, int]:
+        """Границы блока разреженного индекса, в котором находится ts."""
+        block = bisect_right(self._sparse_keys, ts) - 1
+        lo = self._sparse[block][1] if block >= 0 else 0
+        hi = self._sparse[block + 1][1] + 1 if block + 1 < len(self._sparse) else len(self.timestamps)
+        return lo, min(hi, len(self.timestamps))
+
+    def position(self, ts: float, side: str = "right") -> int:
+        """
+        Бинарный поиск позиции ts в столбце времени (аналог bisect).
+        Сначала выбирается блок по разреженному индексу, затем поиск внутри него.
+        """
+        lo, hi = self._bounds(ts)
+        search = bisect_right if side == "right" else bisect_left
+        return search(self.timestamps, ts, lo, hi)
+
+    def slice(self, start_ts: float = None, end_ts: float = None) -> Tuple[memoryview, memoryview]:
+        """Срез столбцов [start_ts, end_ts] без копирования."""
+        lo = 0 if start_ts is None else self.position(start_ts, side="left")
+        hi = len(self.timestamps) if end_ts is None else self.position(end_ts, side="right")
+        return self.timestamps[lo:hi], self.rates[lo:hi]
+
+    def as_numpy(self):
+        """Столбцы как массивы NumPy без копирования (требуется numpy)."""
+        import numpy as np
+        return np.frombuffer(self.timestamps, dtype=np.float64), np.frombuffer(self.rates, dtype=np.float64)
+
+
+class ColumnarHistory:
+    """
+    Колоночное хранилище истории курсов.
+
+    Для каждой пары (BTC_USD, EUR_USD, ...) два файла float64 на дозапись:
+    ts.f64 (секунды Unix, по возрастанию) и rate.f64. index.json хранит
+    подтверждённое число строк каждой пары, её разреженный индекс времени
+    (каждая COLUMNAR_INDEX_STRIDE‑я метка и её смещение) и сколько записей
+    журнала истории уже перенесено. Индекс заменяется атомарно после записи
+    столбцов, поэтому прерванная запись отбрасывается при следующей.
+    """
+
+    def __init__(self, directory: str = None, stride: int = None):
+        self.directory = directory or config.COLUMNAR_DIR_PATH
+        self.stride = stride or config.COLUMNAR_INDEX_STRIDE
+        self._lock = InterProcessLock(os.path.join(self.directory, ".lock"))
+
+    @property
+    def index_path(self) -> str:
+        return os.path.join(self.directory, INDEX_NAME)
+
+    def load_index(self) -> Dict[str, Any]:
+        """Читает индекс хранилища; если его нет — возвращает пустой."""
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"version": 1, "history_count": 0, "pairs": {}}
+
+    def _save_index(self, index: Dict[str, Any]) -> None:
+        atomic_write_json(self.index_path, index)
+
+    def pairs(self) -> List[str]:
+        """Список пар, для которых есть история."""
+        return sorted(self.load_index()["pairs"])
+
+    def _column_path(self, meta: Dict[str, Any], column: str) -> str:
+        # После компакции столбцы пары лежат в каталоге нового поколения (meta["dir"])
+        return os.path.join(self.directory, meta["dir"], f"{column}.f64")
+
+    def _append_column(self, meta: Dict[str, Any], column: str, committed: int, values: array) -> None:
+        """Дописывает значения в столбец, отрезав неподтверждённый хвост."""
+        with open(self._column_path(meta, column), 'ab') as f:
+            if f.tell() != committed * ITEM_SIZE:
+                f.truncate(committed * ITEM_SIZE)
+                f.seek(committed * ITEM_SIZE)
+            values.tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def append_records(self, records: Iterable[Dict[str, Any]], index: Dict[str, Any] = None) -> int:
+        """
+        Дописывает нормализованные записи истории в столбцы пар.
+
+        Записи с меткой времени не новее последней в паре пропускаются:
+        столбец времени должен оставаться отсортированным.
+
+        Returns:
+            Число дописанных строк.
+        """
+        own_index = index is None
+        index = index or self.load_index()
+
+        batches: Dict[str, Tuple[array, array]] = {}
+        last_ts: Dict[str, float] = {}
+        for record in records:
+            pair = f"{record['from_currency']}_{record['to_currency']}"
+            ts = parse_timestamp(record['timestamp'])
+            meta = index["pairs"].get(pair)
+            previous = last_ts.get(pair, meta["last_ts"] if meta else float("-inf"))
+            if ts <= previous:
+                continue
+            last_ts[pair] = ts
+            ts_column, rate_column = batches.setdefault(pair, (array('d'), array('d')))
+            ts_column.append(ts)
+            rate_column.append(float(record['rate']))
+
+        written = 0
+        for pair, (ts_column, rate_column) in batches.items():
+            meta = index["pairs"].setdefault(
+                pair, {"dir": pair, "count": 0, "first_ts": ts_column[0], "last_ts": None, "sparse": []}
+            )
+            meta.setdefault("dir", pair)
+            os.makedirs(os.path.join(self.directory, meta["dir"]), exist_ok=True)
+            committed = meta["count"]
+            self._append_column(meta, "ts", committed, ts_column)
+            self._append_column(meta, "rate", committed, rate_column)
+
+            # Разреженный индекс: каждая stride‑я строка
+            for offset in range(committed, committed + len(ts_column)):
+                if offset % self.stride == 0:
+                    meta["sparse"].append([ts_column[offset - committed], offset])
+            meta["count"] = committed + len(ts_column)
+            meta["last_ts"] = ts_column[-1]
+            written += len(ts_column)
+
+        if own_index and batches:
+            self._save_index(index)
+        return written
+
+    def sync_from_history(self, store: HistoryStore = None) -> int:
+        """
+        Переносит в столбцы записи журнала истории, которых ещё нет в хранилище.
+        Читаются только новые сегменты журнала.
+
+        Returns:
+            Число дописанных строк.
+        """
+        store = store or history_store
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            index = self.load_index()
+            total = store.count()
+            if index["history_count"] >= total:
+                return 0
+            written = self.append_records(store.iter_records(start=index["history_count"]), index)
+            index["history_count"] = total
+            self._save_index(index)
+            return written
+
+    def open_pair(self, pair: str) -> Optional[PairColumns]:
+        """
+        Отображает столбцы пары в память.
+
+        Returns:
+            PairColumns или None, если истории по паре нет.
+        """
+        meta = self.load_index()["pairs"].get(pair)
+        if not meta or not meta["count"]:
+            return None
+
+        meta.setdefault("dir", pair)
+        length = meta["count"] * ITEM_SIZE
+        maps = []
+        views = []
+        for column in ("ts", "rate"):
+            with open(self._column_path(meta, column), 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), length, access=mmap.ACCESS_READ)
+            maps.append(mapped)
+            views.append(memoryview(mapped).cast('d'))
+        columns = PairColumns(pair, views[0], views[1], maps, meta["sparse"])
+        columns.generation = meta["dir"]
+        return columns
+
+    def drop_before(self, cutoff_ts: float) -> int:
+        """
+        Удаляет из столбцов всех пар строки старше cutoff_ts (секунды Unix),
+        кроме последней из них.
+
+        Оставшиеся строки пары копируются в каталог нового поколения, индекс
+        переключается на него атомарно, после чего старый каталог удаляется.
+        Сбой на любом шаге оставляет согласованное состояние.
+
+        Returns:
+            Число удалённых строк.
+        """
+        dropped = 0
+        with self._lock:
+            index = self.load_index()
+            stale_dirs = []
+            for pair, meta in index["pairs"].items():
+                meta.setdefault("dir", pair)
+                columns = self.open_pair(pair)
+                if columns is None:
+                    continue
+                with columns:
+                    # Последнее наблюдение до границы сохраняется: от него
+                    # отсчитывается LOCF для моментов после cutoff_ts
+                    cut = max(columns.position(cutoff_ts, side="left") - 1, 0)
+                    if cut == 0:
+                        continue
+                    ts_tail = array('d', columns.timestamps[cut:].tobytes())
+                    rate_tail = array('d', columns.rates[cut:].tobytes())
+
+                generation = int(meta["dir"].rsplit(".g", 1)[1]) + 1 if ".g" in meta["dir"] else 1
+                new_meta = {
+                    "dir": f"{pair}.g{generation}",
+                    "count": 0,
+                    "first_ts": ts_tail[0],
+                    "last_ts": meta["last_ts"],
+                    "sparse": []
+                }
+                os.makedirs(os.path.join(self.directory, new_meta["dir"]), exist_ok=True)
+                for column, values in (("ts", ts_tail), ("rate", rate_tail)):
+                    with open(self._column_path(new_meta, column), 'wb') as f:
+                        values.tofile(f)
+                        f.flush()
+                        os.fsync(f.fileno())
+                new_meta["count"] = len(ts_tail)
+                new_meta["sparse"] = [
+                    [ts_tail[offset], offset] for offset in range(0, len(ts_tail), self.stride)
+                ]
+                stale_dirs.append(meta["dir"])
+                index["pairs"][pair] = new_meta
+                dropped += cut
+
+            if not stale_dirs:
+                return 0
+            self._save_index(index)
+            for directory in stale_dirs:
+                shutil.rmtree(os.path.join(self.directory, directory), ignore_errors=True)
+        return dropped
+
+
+columnar_history = ColumnarHistory()
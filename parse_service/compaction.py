@@ -0,0 +1,210 @@
+import gzip
+import json
+import os
+from array import array
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List
+from parse_service.columnar import ColumnarHistory, columnar_history, parse_timestamp
+from parse_service.config import config
+from parse_service.fileutils import atomic_write_bytes, atomic_write_text
+from parse_service.history import ARCHIVE_DIR, STAGED_SUFFIX, HistoryStore, TIER_SECONDS, history_store
+from parse_service.rollups import CANDLE_FIELDS, aggregate_columns, merge_candles
+
+
+class HistoryCompactor:
+    """
+    Многоуровневое хранение и компакция истории курсов.
+
+    - сырые строки хранятся HISTORY_RAW_RETENTION_DAYS дней;
+    - более старые дни сворачиваются в часовые свечи (tiers/hourly/<день>.jsonl);
+    - часовые свечи старше HISTORY_HOURLY_RETENTION_DAYS — в дневные
+      (tiers/daily/<месяц>.jsonl);
+    - компактированные сегменты удаляются или, при HISTORY_ARCHIVE_COMPACTED,
+      сжимаются в archive/.
+
+    Работа идёт по одному дню. Новые свечи сливаются с уже лежащими в файле
+    уровня (день может встретиться снова: поздний сегмент после перехода
+    через полночь). Новая версия файла пишется рядом (<файл>.next), манифест
+    фиксирует переход и список подмен (pending_tiers), затем файл уровня
+    подменяется, и только после этого удаляются исходные файлы (список
+    pending_removal). Прерванный запуск безопасно продолжается следующим:
+    незафиксированная версия перезаписывается, зафиксированная — подменяется.
+    """
+
+    def __init__(
+        self,
+        store: HistoryStore = None,
+        columns: ColumnarHistory = None,
+        raw_days: int = None,
+        hourly_days: int = None,
+        archive: bool = None
+    ):
+        self.store = store or history_store
+        self.columns = columns or columnar_history
+        self.raw_days = config.HISTORY_RAW_RETENTION_DAYS if raw_days is None else raw_days
+        self.hourly_days = config.HISTORY_HOURLY_RETENTION_DAYS if hourly_days is None else hourly_days
+        self.archive = config.HISTORY_ARCHIVE_COMPACTED if archive is None else archive
+
+    @staticmethod
+    def _write_atomic(path: str, candles: List[Dict[str, Any]]) -> None:
+        atomic_write_text(path, "".join(json.dumps(candle, ensure_ascii=False) + "\n" for candle in candles))
+
+    @staticmethod
+    def _hourly_candles(records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Сворачивает сырые строки в часовые свечи по парам."""
+        columns: Dict[str, tuple] = {}
+        for record in records:
+            pair = f"{record['from_currency']}_{record['to_currency']}"
+            ts_column, rate_column = columns.setdefault(pair, (array('d'), array('d')))
+            ts_column.append(parse_timestamp(record['timestamp']))
+            rate_column.append(float(record['rate']))
+
+        candles = []
+        for pair, (ts_column, rate_column) in columns.items():
+            aggregated = aggregate_columns(ts_column, rate_column, TIER_SECONDS["hourly"])
+            for i in range(len(aggregated["t"])):
+                candle = {"pair": pair}
+                candle.update({name: aggregated[name][i] for name in CANDLE_FIELDS})
+                candles.append(candle)
+        return sorted(candles, key=lambda candle: (candle["t"], candle["pair"]))
+
+    def _stage_tier(self, manifest: Dict[str, Any], path: str, candles: List[Dict[str, Any]]) -> None:
+        """Пишет новую версию файла уровня рядом с ним; подмена — после фиксации манифеста."""
+        self._write_atomic(path + STAGED_SUFFIX, candles)
+        manifest.setdefault("pending_tiers", []).append(os.path.relpath(path, self.store.directory))
+
+    def _install_tiers(self, manifest: Dict[str, Any]) -> None:
+        """Подменяет файлы уровней, новые версии которых зафиксированы в манифесте (под lock)."""
+        pending = manifest.get("pending_tiers", [])
+        if not pending:
+            return
+        for item in pending:
+            path = os.path.join(self.store.directory, item)
+            if os.path.exists(path + STAGED_SUFFIX):
+                os.replace(path + STAGED_SUFFIX, path)
+        manifest["pending_tiers"] = []
+        self.store.save_manifest(manifest)
+
+    def _finish_pending(self) -> int:
+        """Удаляет (или архивирует) файлы, компакция которых уже зафиксирована."""
+        with self.store.lock:
+            manifest = self.store.load_manifest()
+            self._install_tiers(manifest)
+            pending = manifest.get("pending_removal", [])
+            if not pending:
+                return 0
+            for item in pending:
+                path = os.path.join(self.store.directory, item["path"])
+                if not os.path.exists(path):
+                    continue
+                if item.get("archive"):
+                    archive_dir = os.path.join(self.store.directory, ARCHIVE_DIR)
+                    os.makedirs(archive_dir, exist_ok=True)
+                    target = os.path.join(archive_dir, os.path.basename(path) + ".gz")
+                    with open(path, 'rb') as src:
+                        atomic_write_bytes(target, gzip.compress(src.read()))
+                os.remove(path)
+            manifest["pending_removal"] = []
+            self.store.save_manifest(manifest)
+            return len(pending)
+
+    def _compact_raw_day(self, manifest: Dict[str, Any], day: str) -> None:
+        """Сворачивает сырые сегменты дня в часовые свечи (вызывать под lock)."""
+        head = []
+        for segment in manifest["segments"]:
+            if segment["day"] != day:
+                break
+            head.append(segment)
+        records = [record for segment in head for record in self.store.read_segment(segment)]
+
+        # Свечи дня, свёрнутые раньше, объединяются с новыми по (пара, час)
+        tiers = manifest.setdefault("tiers", {"hourly": [], "daily": []})
+        hourly_path = self.store.tier_path("hourly", day)
+        existing = self.store.read_tier_file(hourly_path) if day in tiers["hourly"] else []
+        candles = merge_candles(existing + self._hourly_candles(records), TIER_SECONDS["hourly"])
+        self._stage_tier(manifest, hourly_path, candles)
+
+        if day not in tiers["hourly"]:
+            tiers["hourly"].append(day)
+        manifest["segments"] = manifest["segments"][len(head):]
+        manifest["compacted_records"] = manifest.get("compacted_records", 0) + sum(
+            segment["records"] for segment in head
+        )
+        manifest.setdefault("pending_removal", []).extend(
+            {"path": segment["name"], "archive": self.archive} for segment in head
+        )
+        self.store.save_manifest(manifest)
+        self._install_tiers(manifest)
+
+    def _roll_hourly_day(self, manifest: Dict[str, Any], day: str) -> None:
+        """Переносит часовые свечи дня в дневные свечи месяца (вызывать под lock)."""
+        hourly_path = self.store.tier_path("hourly", day)
+        daily_path = self.store.tier_path("daily", day)
+        # Дневная свеча дня, уже перенесённого раньше, объединяется с новой по (пара, день);
+        # файл месяца подменяется только после фиксации манифеста, поэтому повтор не создаёт дублей
+        candles = merge_candles(
+            self.store.read_tier_file(daily_path) + self.store.read_tier_file(hourly_path),
+            TIER_SECONDS["daily"]
+        )
+        self._stage_tier(manifest, daily_path, candles)
+
+        tiers = manifest["tiers"]
+        tiers["hourly"].remove(day)
+        if day not in tiers["daily"]:
+            tiers["daily"].append(day)
+        manifest.setdefault("pending_removal", []).append(
+            {"path": os.path.relpath(hourly_path, self.store.directory), "archive": False}
+        )
+        self.store.save_manifest(manifest)
+        self._install_tiers(manifest)
+
+    def run(self, now: datetime = None) -> Dict[str, int]:
+        """
+        Выполняет компакцию до текущих границ хранения.
+
+        Returns:
+            Сводка: сколько дней свёрнуто в часовые и дневные свечи,
+            сколько строк удалено из колоночного хранилища, сколько файлов убрано.
+        """
+        now = now or datetime.now(timezone.utc)
+        raw_cutoff = (now - timedelta(days=self.raw_days)).strftime("%Y-%m-%d")
+        hourly_cutoff = (now - timedelta(days=self.hourly_days)).strftime("%Y-%m-%d")
+        summary = {"raw_days": 0, "hourly_days": 0, "dropped_rows": 0, "removed_files": 0}
+        raw_days, hourly_days = set(), set()
+
+        summary["removed_files"] += self._finish_pending()
+        # Колоночная копия должна увидеть строки до того, как их сегменты будут свёрнуты
+        self.columns.sync_from_history(self.store)
+
+        # Сырые дни: только с головы журнала, чтобы сквозная нумерация записей не сбивалась
+        while True:
+            with self.store.lock:
+                manifest = self.store.load_manifest()
+                segments = manifest["segments"]
+                # Последний сегмент может быть активным — его не трогаем
+                if len(segments) < 2 or segments[0]["day"] >= raw_cutoff:
+                    break
+                raw_days.add(segments[0]["day"])
+                self._compact_raw_day(manifest, segments[0]["day"])
+            summary["raw_days"] = len(raw_days)
+            summary["removed_files"] += self._finish_pending()
+
+        while True:
+            with self.store.lock:
+                manifest = self.store.load_manifest()
+                old_days = sorted(
+                    day for day in manifest.get("tiers", {}).get("hourly", []) if day < hourly_cutoff
+                )
+                if not old_days:
+                    break
+                hourly_days.add(old_days[0])
+                self._roll_hourly_day(manifest, old_days[0])
+            summary["hourly_days"] = len(hourly_days)
+            summary["removed_files"] += self._finish_pending()
+
+        cutoff_ts = datetime.strptime(raw_cutoff, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp()
+        summary["dropped_rows"] = self.columns.drop_before(cutoff_ts)
+        return summary
+
+
+compactor = HistoryCompactor()
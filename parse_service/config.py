@@ -1,10 +1,57 @@
+import json
 import os
 from dataclasses import dataclass, field
+from typing import Dict, Iterable, Set
 from dotenv import load_dotenv
-from constants import RATES_FILE, HISTORY_RATES_FILE
+from constants import RATES_FILE, HISTORY_RATES_FILE, HISTORY_DIR, COLUMNAR_DIR, ROLLUPS_DIR, COINS_FILE, API_BUDGET_FILE
 
 load_dotenv()
 
+
+def load_coin_universe(path: str) -> Dict[str, str]:
+    """
+    Читает список отслеживаемых монет.
+
+    Поддерживаются два формата JSON:
+    - объект {"BTC": "bitcoin", ...} (код → id CoinGecko);
+    - список [{"symbol": "btc", "id": "bitcoin"}, ...] — формат /coins/list
+      CoinGecko; при повторе символа берётся первая запись.
+
+    Returns:
+        Словарь {код: id CoinGecko}; пустой, если файла нет.
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except json.JSONDecodeError as e:
+        print(f"Ошибка парсинга списка монет {path}: {e}")
+        return {}
+
+    if isinstance(data, dict):
+        return {code.upper(): cg_id for code, cg_id in data.items()}
+    universe = {}
+    for coin in data:
+        universe.setdefault(coin["symbol"].upper(), coin["id"])
+    return universe
+
+
+def load_fiat_codes(rates_file: str, source: str) -> Set[str]:
+    """
+    Коды валют, курсы которых в rates.json получены от фиатного источника.
+
+    Returns:
+        Множество кодов; пустое, если снимка ещё нет.
+    """
+    try:
+        with open(rates_file, 'r', encoding='utf-8') as f:
+            pairs = json.load(f).get("pairs", {})
+    except (FileNotFoundError, json.JSONDecodeError, AttributeError):
+        return set()
+    return {code for code, info in pairs.items() if info.get("source") == source}
+
+
 @dataclass
 class ParserConfig:
     # Ключ загружается из переменной окружения
@@ -23,18 +70,136 @@ class ParserConfig:
             }
     )
     
+    # Файл со списком монет (дополняет CRYPTO_ID_MAP), см. load_coin_universe
+    CRYPTO_UNIVERSE_FILE: str = os.getenv("CRYPTO_UNIVERSE_FILE", COINS_FILE)
+    # Источник фиатных курсов и известные ему коды: монеты с такими символами
+    # не опрашиваются, чтобы не затереть курс фиатной валюты в rates.json
+    FIAT_SOURCE: str = "ExchangeRate-API"
+    FIAT_CODES: set = field(default_factory=set)
+
     # Время жизни кеша (5 минут)
     CACHE_TTL = 300  
+    # Как часто (секунды) проверять, не заменил ли rates.json другой процесс
+    RATES_RELOAD_MIN_INTERVAL: float = 1.0
+
+    # Фоновый планировщик: интервал обновления каждого источника (секунды)
+    SCHEDULER_ENABLED: bool = True
+    SOURCE_REFRESH_INTERVALS: dict = field(
+        default_factory=lambda: {
+            "CoinGecko": 300,
+            "ExchangeRate-API": 300
+            }
+    )
+    # Случайный сдвиг интервала (доля), чтобы источники не опрашивались синхронно
+    SCHEDULER_JITTER: float = 0.1
     
     # Эндпоинты
     COINGECKO_URL: str = "https://api.coingecko.com/api/v3/simple/price"
     EXCHANGERATE_API_URL: str = f"https://v6.exchangerate-api.com/v6/{EXCHANGERATE_API_KEY}/latest/{BASE_CURRENCY}"
+    # Локальный заменитель API (python -m parse_service.standin_server):
+    # если адрес задан, оба источника опрашиваются через него
+    RATES_STANDIN_URL: str = os.getenv("RATES_STANDIN_URL", "")
 
     # Пути
     RATES_FILE_PATH: str = RATES_FILE
     HISTORY_FILE_PATH: str = HISTORY_RATES_FILE
+    HISTORY_DIR_PATH: str = HISTORY_DIR
+
+    # История: новый сегмент открывается каждый день или по достижении размера
+    HISTORY_SEGMENT_MAX_BYTES: int = 8 * 1024 * 1024
+    # Дельта‑режим: строка пишется, только если курс изменился больше чем на EPSILON (доля)
+    HISTORY_DELTA_MODE: bool = True
+    HISTORY_DELTA_EPSILON: float = 0.0
+
+    # Многоуровневое хранение: сырые строки → часовые свечи → дневные свечи
+    HISTORY_RAW_RETENTION_DAYS: int = 7
+    HISTORY_HOURLY_RETENTION_DAYS: int = 90
+    # Сжимать компактированные сегменты в archive/ вместо удаления
+    HISTORY_ARCHIVE_COMPACTED: bool = False
+    # Период фоновой компакции (секунды)
+    COMPACTION_INTERVAL: float = 6 * 3600
+
+    # Колоночная история: шаг разреженного индекса времени (строк)
+    COLUMNAR_DIR_PATH: str = COLUMNAR_DIR
+    COLUMNAR_INDEX_STRIDE: int = 256
+
+    # Кеш свечей OHLC по интервалам
+    ROLLUPS_DIR_PATH: str = ROLLUPS_DIR
 
     # Сетевые параметры
-    REQUEST_TIMEOUT: int = 10 
-    
+    REQUEST_TIMEOUT: int = 10
+
+    # CoinGecko: ids делятся на части так, чтобы URL не превышал COINGECKO_MAX_URL_LENGTH
+    # и в части было не больше COINGECKO_CHUNK_SIZE монет; части запрашиваются
+    # параллельно (до COINGECKO_MAX_PARALLEL), не больше COINGECKO_REQUEST_BUDGET
+    # запросов за обновление — остальные части переходят на следующее
+    COINGECKO_MAX_URL_LENGTH: int = 2000
+    COINGECKO_CHUNK_SIZE: int = 250
+    COINGECKO_MAX_PARALLEL: int = 4
+    COINGECKO_REQUEST_BUDGET: int = 8
+
+    # Бюджет запросов к API (общий для всех процессов): источник → (ёмкость, период в секундах).
+    # Бесплатные тарифы: CoinGecko — 30 запросов в минуту, ExchangeRate-API — 1500 в месяц
+    API_BUDGET_ENABLED: bool = True
+    API_BUDGET_FILE_PATH: str = API_BUDGET_FILE
+    API_BUDGETS: dict = field(
+        default_factory=lambda: {
+            "CoinGecko": (30, 60),
+            "ExchangeRate-API": (50, 86400)
+            }
+    )
+
+    # Пул HTTP-соединений и повторы (429/5xx) с экспоненциальной задержкой
+    HTTP_POOL_SIZE: int = 10
+    HTTP_MAX_RETRIES: int = 3
+    HTTP_BACKOFF_BASE: float = 0.5
+    HTTP_BACKOFF_MAX: float = 8.0
+
+    # Предохранитель источника: после стольких неудачных опросов подряд
+    # (каждый уже включает повторы HTTP) источник отключается на CIRCUIT_COOLDOWN секунд
+    CIRCUIT_FAILURE_THRESHOLD: int = 1
+    CIRCUIT_COOLDOWN: float = 120.0
+
+    # Параллельный опрос источников
+    CONCURRENT_FETCH: bool = True
+    # Общий дедлайн обновления (секунды): результаты, не успевшие к нему, отбрасываются
+    REFRESH_DEADLINE: float = 12.0
+
+    # Обновление выполняет один процесс за раз: остальные ждут не дольше
+    # REFRESH_LOCK_TIMEOUT секунд и не опрашивают источники, опрошенные
+    # другим процессом за последние REFRESH_SINGLE_FLIGHT_WINDOW секунд
+    REFRESH_LOCK_TIMEOUT: float = 30.0
+    REFRESH_SINGLE_FLIGHT_WINDOW: float = 60.0
+
+    def __post_init__(self):
+        universe = load_coin_universe(self.CRYPTO_UNIVERSE_FILE)
+        if universe:
+            # Встроенные id важнее файла: в формате /coins/list символ может
+            # принадлежать другой монете с тем же тикером
+            self.CRYPTO_ID_MAP = {**universe, **self.CRYPTO_ID_MAP}
+            self.CRYPTO_CURRENCIES = tuple(self.CRYPTO_ID_MAP)
+            self.exclude_fiat_codes(
+                load_fiat_codes(self.RATES_FILE_PATH, self.FIAT_SOURCE) | {self.BASE_CURRENCY}
+            )
+        if self.RATES_STANDIN_URL:
+            base = self.RATES_STANDIN_URL.rstrip("/")
+            self.COINGECKO_URL = f"{base}/api/v3/simple/price"
+            self.EXCHANGERATE_API_URL = f"{base}/v6/standin/latest/{self.BASE_CURRENCY}"
+
+
+    def exclude_fiat_codes(self, codes: Iterable[str]) -> None:
+        """
+        Запоминает фиатные коды и убирает монеты с такими символами из
+        CRYPTO_ID_MAP. Словарь подменяется целиком — опрос в другом потоке
+        не застанет его посреди изменения.
+        """
+        self.FIAT_CODES = self.FIAT_CODES | {code.upper() for code in codes}
+        clashing = [code for code in self.CRYPTO_ID_MAP if code in self.FIAT_CODES]
+        if clashing:
+            self.CRYPTO_ID_MAP = {
+                code: cg_id for code, cg_id in self.CRYPTO_ID_MAP.items() if code not in self.FIAT_CODES
+            }
+            self.CRYPTO_CURRENCIES = tuple(self.CRYPTO_ID_MAP)
+
+
 config = ParserConfig()
@@ -0,0 +1,43 @@
+import contextvars
+import logging
+from concurrent.futures import Executor, Future
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator
+
+
+logger = logging.getLogger("parse_service")
+
+# Код выполняется фоновым обновлением (планировщиком), а не командой пользователя
+_background: contextvars.ContextVar = contextvars.ContextVar("parse_service_background", default=False)
+
+
+def echo(message: Any = "") -> None:
+    """
+    Сообщение обновления курсов.
+
+    Для команды пользователя печатается в stdout; из фонового обновления
+    уходит в журнал logging (logger parse_service), чтобы не вклиниваться
+    в вывод команд и приглашение ввода.
+    """
+    if _background.get():
+        logger.info("%s", message)
+    else:
+        print(message)
+
+
+@contextmanager
+def background() -> Iterator[None]:
+    """Помечает код внутри блока как фоновый: echo пишет в журнал, а не в stdout."""
+    token = _background.set(True)
+    try:
+        yield
+    finally:
+        _background.reset(token)
+
+
+def submit(executor: Executor, fn: Callable, *args: Any) -> Future:
+    """
+    executor.submit в контексте вызывающего потока: опрос, запущенный
+    из фона, остаётся фоновым и в рабочих потоках пула.
+    """
+    return executor.submit(contextvars.copy_context().run, fn, *args)
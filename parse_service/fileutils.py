@@ -0,0 +1,136 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional
+
+try:
+    import fcntl
+except ImportError:  # не POSIX: межпроцессная блокировка недоступна, остаётся блокировка потоков
+    fcntl = None
+
+
+def _try_flock(fd: int, shared: bool) -> bool:
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(fd, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        return False
+
+
+@contextmanager
+def file_lock(
+    path: str,
+    shared: bool = False,
+    blocking: bool = True,
+    timeout: Optional[float] = None
+) -> Iterator[bool]:
+    """
+    Межпроцессная блокировка на файле (flock). Файл блокировки создаётся при
+    необходимости и не удаляется; блокировка снимается при выходе из блока
+    или при завершении процесса.
+
+    Args:
+        path: путь к файлу блокировки.
+        shared: разделяемая блокировка (для читателей) вместо исключительной.
+        blocking: ждать освобождения; False — только одна попытка.
+        timeout: наибольшее время ожидания в секундах (None — без ограничения).
+
+    Yields:
+        True, если блокировка получена; False — если нет (занято или истёк timeout).
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    acquired = False
+    try:
+        if blocking and timeout is None and fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            acquired = True
+        else:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            acquired = _try_flock(fd, shared)
+            while not acquired and blocking and (deadline is None or time.monotonic() < deadline):
+                time.sleep(0.05)
+                acquired = _try_flock(fd, shared)
+        yield acquired
+    finally:
+        if acquired and fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+class InterProcessLock:
+    """
+    Блокировка одновременно для потоков процесса и для других процессов.
+
+    Повторный вход из того же потока допускается (как у threading.RLock);
+    файловая блокировка берётся при первом входе и снимается при последнем выходе.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._lock_cm = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        if self._depth == 0:
+            try:
+                self._lock_cm = file_lock(self.path)
+                self._lock_cm.__enter__()
+            except BaseException:
+                self._lock_cm = None
+                self._thread_lock.release()
+                raise
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._depth -= 1
+        try:
+            if self._depth == 0:
+                lock_cm, self._lock_cm = self._lock_cm, None
+                lock_cm.__exit__(None, None, None)
+        finally:
+            self._thread_lock.release()
+
+
+def atomic_write_bytes(path: str, data: bytes, fsync: bool = True) -> None:
+    """
+    Атомарно заменяет файл: уникальный временный файл в том же каталоге →
+    (fsync) → rename. Одновременные писатели не мешают друг другу:
+    у каждого свой временный файл, читатели видят старое или новое содержимое.
+    """
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_file = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        # mkstemp создаёт файл с правами 0600 — выставляем обычные для данных
+        os.chmod(temp_file, 0o644)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(temp_file, path)
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+
+
+def atomic_write_text(path: str, text: str, fsync: bool = True) -> None:
+    """Атомарно записывает текст (UTF‑8), см. atomic_write_bytes."""
+    atomic_write_bytes(path, text.encode('utf-8'), fsync)
+
+
+def atomic_write_json(path: str, data: Any, fsync: bool = True, **dump_kwargs) -> None:
+    """Атомарно записывает JSON (ensure_ascii=False), см. atomic_write_bytes."""
+    atomic_write_text(path, json.dumps(data, ensure_ascii=False, **dump_kwargs), fsync)
@@ -0,0 +1,438 @@
+import json
+import os
+from array import array
+from datetime import datetime
+from bisect import bisect_right
+from typing import Any, Dict, Iterator, List, Optional
+from parse_service.config import config
+from parse_service.console import echo
+from parse_service.fileutils import InterProcessLock, atomic_write_json
+
+
+MANIFEST_NAME = "manifest.json"
+BATCHES_NAME = "batches.jsonl"
+TIERS_DIR = "tiers"
+ARCHIVE_DIR = "archive"
+# Новая версия файла уровня, зафиксированная манифестом, но ещё не подменённая
+STAGED_SUFFIX = ".next"
+LOCK_NAME = ".lock"
+# Длина свечи каждого уровня хранения после компакции (секунды)
+TIER_SECONDS = {"hourly": 3600, "daily": 86400}
+
+
+class HistoryStore:
+    """
+    Журнал истории курсов только на дозапись.
+
+    Записи хранятся в JSONL‑сегментах (по строке на запись), сегмент
+    закрывается при смене дня или по достижении HISTORY_SEGMENT_MAX_BYTES.
+    manifest.json перечисляет сегменты и число подтверждённых байт в каждом
+    и заменяется атомарно, поэтому обновление стоит O(новых записей):
+    старые сегменты не читаются и не переписываются.
+
+    Хвост активного сегмента за пределами подтверждённой длины (запись,
+    прерванная сбоем до обновления манифеста) читателями игнорируется и
+    отрезается перед следующей дозаписью.
+
+    Метаданные запросов к API (источник, время, задержка, статус, ETag)
+    пишутся один раз на ответ в batches.jsonl; строки курсов ссылаются на
+    них по batch_id.
+
+    В дельта‑режиме (HISTORY_DELTA_MODE) строка пишется, только если курс
+    пары изменился больше чем на HISTORY_DELTA_EPSILON (относительно).
+    Читатели восстанавливают значения по правилу «последнее наблюдение
+    действует до следующего» (LOCF): курс на момент t — последняя строка
+    пары не позже t.
+    """
+
+    def __init__(
+        self,
+        directory: str = None,
+        legacy_file: str = None,
+        segment_max_bytes: int = None,
+        delta_mode: bool = None,
+        delta_epsilon: float = None
+    ):
+        """
+        Args:
+            directory: каталог сегментов (по умолчанию config.HISTORY_DIR_PATH).
+            legacy_file: старый exchange_rates.json для однократной миграции.
+            segment_max_bytes: размер, после которого открывается новый сегмент.
+            delta_mode: писать только изменившиеся курсы (по умолчанию config.HISTORY_DELTA_MODE).
+            delta_epsilon: порог относительного изменения для дельта‑режима.
+        """
+        self.directory = directory or config.HISTORY_DIR_PATH
+        self.legacy_file = legacy_file if legacy_file is not None else config.HISTORY_FILE_PATH
+        self.segment_max_bytes = segment_max_bytes or config.HISTORY_SEGMENT_MAX_BYTES
+        self.delta_mode = config.HISTORY_DELTA_MODE if delta_mode is None else delta_mode
+        self.delta_epsilon = config.HISTORY_DELTA_EPSILON if delta_epsilon is None else delta_epsilon
+        # Журнал может писать несколько процессов (CLI, фоновая компакция)
+        self._lock = InterProcessLock(os.path.join(self.directory, LOCK_NAME))
+        # Столбцы свечей уровней по парам, действительны для одного поколения манифеста
+        self._tier_cache: Dict[str, Any] = {"generation": None, "series": {}}
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.directory, MANIFEST_NAME)
+
+    def load_manifest(self) -> Dict[str, Any]:
+        """Читает манифест; если его нет — возвращает пустой."""
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {
+                "version": 1,
+                "segments": [],
+                "batches": {"records": 0, "bytes": 0},
+                "compacted_records": 0,
+                "tiers": {"hourly": [], "daily": []},
+                "pending_removal": []
+            }
+
+    def _save_manifest(self, manifest: Dict[str, Any]) -> None:
+        """
+        Атомарно заменяет манифест: временный файл → fsync → rename.
+        Каждая фиксация увеличивает поколение — по нему читатели сбрасывают кеши.
+        """
+        manifest["generation"] = manifest.get("generation", 0) + 1
+        atomic_write_json(self.manifest_path, manifest, indent=2)
+
+    def save_manifest(self, manifest: Dict[str, Any]) -> None:
+        """Фиксирует манифест (вызывать под lock)."""
+        self._save_manifest(manifest)
+
+    def _ensure_ready(self) -> Dict[str, Any]:
+        """Создаёт каталог и при первом обращении переносит старый файл истории."""
+        os.makedirs(self.directory, exist_ok=True)
+        manifest = self.load_manifest()
+        if not manifest["segments"] and self.legacy_file and os.path.exists(self.legacy_file):
+            manifest = self._migrate_legacy(manifest)
+        return manifest
+
+    def _new_segment(self, manifest: Dict[str, Any], day: str) -> Dict[str, Any]:
+        """Регистрирует в манифесте новый пустой сегмент за указанный день."""
+        # Номер не переиспользуется: файл с тем же именем может ещё ждать
+        # удаления после компакции или лежать в архиве
+        taken = {s["name"] for s in manifest["segments"]}
+        taken.update(item["path"] for item in manifest.get("pending_removal", []))
+        number = sum(1 for s in manifest["segments"] if s["day"] == day) + 1
+        while True:
+            name = f"{day}-{number:04d}.jsonl"
+            if name not in taken and not os.path.exists(os.path.join(self.directory, name)) \
+                    and not os.path.exists(os.path.join(self.directory, ARCHIVE_DIR, name + ".gz")):
+                break
+            number += 1
+        segment = {
+            "name": name,
+            "day": day,
+            "records": 0,
+            "bytes": 0,
+            "first_ts": None,
+            "last_ts": None
+        }
+        manifest["segments"].append(segment)
+        return segment
+
+    def _open_segment(self, segment: Dict[str, Any]):
+        """Открывает сегмент на дозапись, отрезая неподтверждённый хвост после сбоя."""
+        f = open(os.path.join(self.directory, segment["name"]), 'ab')
+        if f.tell() != segment["bytes"]:
+            f.truncate(segment["bytes"])
+            f.seek(segment["bytes"])
+        return f
+
+    @staticmethod
+    def _close_segment(f) -> None:
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+
+    def _write_lines(self, manifest: Dict[str, Any], records: List[Dict[str, Any]]) -> None:
+        """Дописывает записи в сегменты по дням, не обновляя манифест."""
+        segment = manifest["segments"][-1] if manifest["segments"] else None
+        f = None
+        try:
+            for record in records:
+                day = record["timestamp"][:10]
+                line = (json.dumps(record, ensure_ascii=False) + "\n").encode('utf-8')
+
+                rollover = (
+                    segment is None
+                    or segment["day"] != day
+                    or (segment["records"] and segment["bytes"] + len(line) > self.segment_max_bytes)
+                )
+                if rollover:
+                    if f is not None:
+                        self._close_segment(f)
+                        f = None
+                    segment = self._new_segment(manifest, day)
+                if f is None:
+                    f = self._open_segment(segment)
+
+                f.write(line)
+                segment["records"] += 1
+                segment["bytes"] += len(line)
+                segment["first_ts"] = segment["first_ts"] or record["timestamp"]
+                segment["last_ts"] = record["timestamp"]
+        finally:
+            if f is not None:
+                self._close_segment(f)
+
+    def _write_batches(self, manifest: Dict[str, Any], batches: List[Dict[str, Any]]) -> None:
+        """Дописывает метаданные запросов в batches.jsonl, не обновляя манифест."""
+        committed = manifest.setdefault("batches", {"records": 0, "bytes": 0})
+        data = b"".join(
+            (json.dumps(batch, ensure_ascii=False) + "\n").encode('utf-8') for batch in batches
+        )
+        with open(os.path.join(self.directory, BATCHES_NAME), 'ab') as f:
+            if f.tell() != committed["bytes"]:
+                f.truncate(committed["bytes"])
+                f.seek(committed["bytes"])
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        committed["records"] += len(batches)
+        committed["bytes"] += len(data)
+
+    def _changed_only(self, manifest: Dict[str, Any], records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Оставляет записи, курс которых изменился относительно последнего
+        записанного больше чем на delta_epsilon. Последние значения пар
+        хранятся в манифесте и обновляются вместе с ним.
+        """
+        last_values = manifest.setdefault("last_values", {})
+        changed = []
+        for record in records:
+            pair = f"{record['from_currency']}_{record['to_currency']}"
+            previous = last_values.get(pair)
+            rate = record["rate"]
+            if previous is not None and abs(rate - previous) <= self.delta_epsilon * abs(previous):
+                continue
+            last_values[pair] = rate
+            changed.append(record)
+        return changed
+
+    def append(self, records: List[Dict[str, Any]], batches: List[Dict[str, Any]] = None) -> int:
+        """
+        Дописывает нормализованные записи в конец истории.
+
+        Args:
+            records: записи в формате exchange_rates.json (с id и timestamp ...Z).
+            batches: метаданные запросов, на которые ссылаются записи по batch_id.
+
+        Returns:
+            Число фактически записанных строк (в дельта‑режиме — только изменившиеся).
+        """
+        if not records and not batches:
+            return 0
+        with self._lock:
+            manifest = self._ensure_ready()
+            if self.delta_mode:
+                records = self._changed_only(manifest, records)
+            if batches:
+                self._write_batches(manifest, batches)
+            self._write_lines(manifest, records)
+            self._save_manifest(manifest)
+            return len(records)
+
+    def iter_batches(self) -> Iterator[Dict[str, Any]]:
+        """Читает подтверждённые метаданные запросов (например, для анализа задержек источников)."""
+        committed = self._ensure_ready().get("batches", {"bytes": 0})
+        try:
+            with open(os.path.join(self.directory, BATCHES_NAME), 'rb') as f:
+                data = f.read(committed["bytes"])
+        except FileNotFoundError:
+            return
+        for line in data.splitlines():
+            if line:
+                yield json.loads(line)
+
+    def source_latency(self) -> Dict[str, Dict[str, float]]:
+        """Сводка задержек по источникам: число запросов, среднее и максимум request_ms."""
+        stats: Dict[str, Dict[str, float]] = {}
+        for batch in self.iter_batches():
+            entry = stats.setdefault(batch["source"], {"requests": 0, "avg_ms": 0.0, "max_ms": 0})
+            entry["requests"] += 1
+            entry["avg_ms"] += (batch["request_ms"] - entry["avg_ms"]) / entry["requests"]
+            entry["max_ms"] = max(entry["max_ms"], batch["request_ms"])
+        return stats
+
+    @property
+    def lock(self) -> InterProcessLock:
+        """Блокировка манифеста для потоков и процессов (используется компактором истории)."""
+        return self._lock
+
+    def segment_path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def read_segment(self, segment: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Читает подтверждённые записи одного сегмента."""
+        try:
+            with open(self.segment_path(segment["name"]), 'rb') as f:
+                data = f.read(segment["bytes"])
+        except FileNotFoundError:
+            echo(f"Сегмент истории {segment['name']} не найден, пропускаем")
+            return []
+        return [json.loads(line) for line in data.splitlines() if line]
+
+    def iter_records(self, start: int = 0) -> Iterator[Dict[str, Any]]:
+        """
+        Последовательно читает подтверждённые записи истории.
+
+        Args:
+            start: сквозной порядковый номер первой записи; сегменты целиком
+                до него пропускаются по манифесту без чтения. Нумерация не
+                сбивается при компакции: удалённые записи учитываются в
+                compacted_records.
+        """
+        manifest = self._ensure_ready()
+        position = manifest.get("compacted_records", 0)
+        for segment in manifest["segments"]:
+            segment_start = position
+            position += segment["records"]
+            if position <= start:
+                continue
+            for offset, record in enumerate(self.read_segment(segment)):
+                if segment_start + offset >= start:
+                    yield record
+
+    def count(self) -> int:
+        """
+        Сквозное число записей в истории, включая уже компактированные
+        (по манифесту, без чтения сегментов).
+        """
+        manifest = self._ensure_ready()
+        return manifest.get("compacted_records", 0) + sum(
+            segment["records"] for segment in manifest["segments"]
+        )
+
+    def tier_path(self, tier: str, day: str) -> str:
+        """Файл уровня хранения: hourly — по дню, daily — по месяцу."""
+        key = day if tier == "hourly" else day[:7]
+        return os.path.join(self.directory, TIERS_DIR, tier, f"{key}.jsonl")
+
+    @staticmethod
+    def read_tier_file(path: str) -> List[Dict[str, Any]]:
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return [json.loads(line) for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def _tier_files(self, tier: str) -> List[str]:
+        days = sorted(self._ensure_ready().get("tiers", {}).get(tier, []))
+        paths = []
+        for day in days:
+            path = self.tier_path(tier, day)
+            if not paths or paths[-1] != path:
+                paths.append(path)
+        return paths
+
+    def iter_tier_candles(self, tier: str, pair: str) -> Iterator[Dict[str, Any]]:
+        """Свечи пары из уровня хранения (hourly / daily) по возрастанию времени."""
+        for path in self._tier_files(tier):
+            for candle in self.read_tier_file(path):
+                if candle["pair"] == pair:
+                    yield candle
+
+    def _read_committed_tier(self, manifest: Dict[str, Any], path: str) -> List[Dict[str, Any]]:
+        """Файл уровня в версии, зафиксированной манифестом (включая ещё не подменённую .next)."""
+        if os.path.relpath(path, self.directory) in manifest.get("pending_tiers", []) \
+                and os.path.exists(path + STAGED_SUFFIX):
+            return self.read_tier_file(path + STAGED_SUFFIX)
+        return self.read_tier_file(path)
+
+    def _tier_series(self, manifest: Dict[str, Any], tier: str, pair: str) -> Dict[str, array]:
+        """
+        Столбцы t / open / close свечей пары по всем файлам уровня.
+        Читаются один раз и кешируются до смены поколения манифеста.
+        """
+        cache = self._tier_cache
+        if cache["generation"] != manifest.get("generation", 0):
+            cache = {"generation": manifest.get("generation", 0), "series": {}}
+            self._tier_cache = cache
+        series = cache["series"].get((tier, pair))
+        if series is not None:
+            return series
+
+        candles = []
+        paths = []
+        for day in sorted(manifest.get("tiers", {}).get(tier, [])):
+            path = self.tier_path(tier, day)
+            if not paths or paths[-1] != path:
+                paths.append(path)
+        for path in paths:
+            candles.extend(candle for candle in self._read_committed_tier(manifest, path) if candle["pair"] == pair)
+        candles.sort(key=lambda candle: candle["t"])
+        series = {
+            "t": array('d', (candle["t"] for candle in candles)),
+            "open": array('d', (candle["open"] for candle in candles)),
+            "close": array('d', (candle["close"] for candle in candles))
+        }
+        cache["series"][(tier, pair)] = series
+        return series
+
+    def tier_values_as_of(self, pair: str, epochs: List[float]) -> List[Optional[float]]:
+        """
+        Курсы пары на моменты epochs по компактированным уровням (LOCF).
+
+        Манифест читается один раз, свечи пары — один раз на поколение
+        манифеста; поиск — бинарный, O(log n) на момент. Последняя свеча не
+        позже момента действует, сколько бы файлов назад она ни лежала.
+        Точность ограничена длиной свечи уровня: для момента внутри свечи
+        берётся её открытие, после свечи — закрытие. Часовые свечи свежее
+        дневных, поэтому дневные используются, только если часовых до момента нет.
+        """
+        manifest = self._ensure_ready()
+        tiers = [(tier, self._tier_series(manifest, tier, pair)) for tier in ("hourly", "daily")]
+        result = []
+        for epoch in epochs:
+            value = None
+            for tier, series in tiers:
+                position = bisect_right(series["t"], epoch) - 1
+                if position >= 0:
+                    inside = epoch < series["t"][position] + TIER_SECONDS[tier]
+                    value = series["open"][position] if inside else series["close"][position]
+                    break
+            result.append(value)
+        return result
+
+    def tier_value_as_of(self, pair: str, epoch: float) -> Optional[float]:
+        """Курс пары на момент epoch по компактированным уровням (LOCF)."""
+        return self.tier_values_as_of(pair, [epoch])[0]
+
+    def _migrate_legacy(self, manifest: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Однократно переносит старый exchange_rates.json (JSON‑массив) в сегменты.
+        Исходный файл переименовывается в *.migrated, чтобы миграция не повторялась.
+        """
+        try:
+            with open(self.legacy_file, 'r', encoding='utf-8') as f:
+                legacy_records = json.load(f)
+        except (json.JSONDecodeError, IOError) as e:
+            echo(f"Предупреждение: не удалось прочитать {self.legacy_file} для миграции: {e}")
+            return manifest
+
+        legacy_records.sort(key=lambda record: record.get("timestamp", ""))
+        self._write_lines(manifest, legacy_records)
+        manifest["migrated_from"] = self.legacy_file
+        manifest["migrated_at"] = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+        self._save_manifest(manifest)
+        os.replace(self.legacy_file, self.legacy_file + ".migrated")
+        echo(f"История перенесена: {len(legacy_records)} записей из {self.legacy_file} в {self.directory}")
+        return manifest
+
+
+def migrate_legacy_history(legacy_file: str = None, directory: str = None) -> int:
+    """
+    Явная миграция старого exchange_rates.json в сегментированный журнал.
+
+    Returns:
+        Число записей в журнале после миграции.
+    """
+    store = HistoryStore(directory=directory, legacy_file=legacy_file)
+    return store.count()
+
+
+history_store = HistoryStore()
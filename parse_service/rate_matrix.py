@@ -0,0 +1,105 @@
+from typing import Dict, List, Optional, Sequence, Union
+
+try:
+    import numpy as np
+except ImportError:  # numpy необязателен: без него курсы пересчитываются в цикле
+    np = None
+
+
+class RateMatrix:
+    """
+    Снимок курсов, проиндексированный целыми идентификаторами валют.
+
+    vector[i] — курс валюты i к базовой валюте снимка; кросс‑курс i→j равен
+    vector[i] / vector[j] и считается по вектору при запросе — матрица N×N
+    не строится. Идентификаторы стабильны между снимками: при пересборке из
+    нового снимка прежние валюты сохраняют свои номера, новые добавляются
+    в конец, а исчезнувшие получают курс NaN.
+    """
+
+    def __init__(self, rates: Dict[str, float], previous: Optional["RateMatrix"] = None):
+        """
+        Args:
+            rates: {код валюты: курс к базовой валюте}.
+            previous: матрица прошлого снимка — для сохранения идентификаторов.
+        """
+        # Словарь, из которого построена матрица: по нему владелец узнаёт смену снимка
+        self.source = rates
+        self.codes: List[str] = list(previous.codes) if previous is not None else []
+        self.index: Dict[str, int] = dict(previous.index) if previous is not None else {}
+        for code in rates:
+            if code not in self.index:
+                self.index[code] = len(self.codes)
+                self.codes.append(code)
+        values = [float(rates.get(code, float("nan"))) for code in self.codes]
+        self.vector = np.array(values, dtype=np.float64) if np is not None else values
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def __contains__(self, code: str) -> bool:
+        i = self.index.get(code)
+        return i is not None and self.vector[i] == self.vector[i]  # NaN — валюты нет в снимке
+
+    def id_of(self, code: str) -> int:
+        """Идентификатор валюты; KeyError, если её нет в снимке."""
+        if code not in self:
+            raise KeyError(f"Курс для {code} не найден.")
+        return self.index[code]
+
+    def ids_of(self, codes: Sequence[str]):
+        """Идентификаторы списка валют (массив int64, если доступен numpy)."""
+        ids = [self.id_of(code) for code in codes]
+        return np.array(ids, dtype=np.int64) if np is not None else ids
+
+    def rate(self, from_code: str, to_code: str) -> float:
+        """Кросс‑курс from_code → to_code."""
+        i, j = self.id_of(from_code), self.id_of(to_code)
+        return float(self.vector[i] / self.vector[j])
+
+    def convert_many(
+        self,
+        amounts: Sequence[float],
+        from_codes: Union[str, Sequence[str], Sequence[int]],
+        to_code: str
+    ):
+        """
+        Векторный перевод сумм в валюту to_code.
+
+        Args:
+            amounts: суммы.
+            from_codes: код валюты каждой суммы, один код для всех сумм
+                или массив целых идентификаторов (см. ids_of).
+            to_code: целевая валюта.
+
+        Returns:
+            Суммы в валюте to_code (numpy‑массив или список без numpy).
+        """
+        target = self.id_of(to_code)
+        if isinstance(from_codes, str):
+            ids = None
+            factor = self.vector[self.id_of(from_codes)] / self.vector[target]
+        elif np is not None and isinstance(from_codes, np.ndarray) and from_codes.dtype.kind in "iu":
+            ids = from_codes
+        else:
+            ids = self.ids_of(from_codes)
+
+        if np is not None:
+            values = np.asarray(amounts, dtype=np.float64)
+            if ids is None:
+                return values * factor
+            if len(ids) != len(values):
+                raise ValueError("Число сумм и кодов валют должно совпадать.")
+            return values * (self.vector[ids] / self.vector[target])
+
+        if ids is None:
+            return [float(amount) * factor for amount in amounts]
+        if len(ids) != len(amounts):
+            raise ValueError("Число сумм и кодов валют должно совпадать.")
+        base = self.vector[target]
+        return [float(amount) * self.vector[i] / base for amount, i in zip(amounts, ids)]
+
+    def total(self, amounts: Sequence[float], from_codes, to_code: str) -> float:
+        """Суммарная стоимость сумм в валюте to_code, см. convert_many."""
+        converted = self.convert_many(amounts, from_codes, to_code)
+        return float(converted.sum()) if np is not None else float(sum(converted))
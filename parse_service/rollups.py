@@ -0,0 +1,344 @@
+import json
+import os
+import re
+import threading
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+from parse_service.columnar import ColumnarHistory, columnar_history
+from parse_service.config import config
+from parse_service.fileutils import atomic_write_json
+from parse_service.history import TIER_SECONDS, history_store
+
+try:
+    import numpy as np
+except ImportError:  # numpy необязателен: без него работает построчная агрегация
+    np = None
+
+
+INTERVAL_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+CANDLE_FIELDS = ("t", "open", "high", "low", "close", "sum", "count")
+
+
+def parse_interval(value: str) -> int:
+    """Переводит интервал вида 30s, 5m, 1h, 1d, 1w в секунды."""
+    match = re.fullmatch(r'(\d+)\s*([smhdw])', value.strip().lower())
+    if not match or int(match.group(1)) <= 0:
+        raise ValueError(f"Некорректный интервал '{value}'. Примеры: 5m, 1h, 1d")
+    return int(match.group(1)) * INTERVAL_UNITS[match.group(2)]
+
+
+def pair_key(pair: str) -> str:
+    """BTC → BTC_USD; пары с явной второй валютой (BTC_USD, BTC/USD) нормализуются."""
+    pair = pair.strip().upper().replace("/", "_")
+    return pair if "_" in pair else f"{pair}_{config.BASE_CURRENCY}"
+
+
+def _empty_candles() -> Dict[str, list]:
+    return {name: [] for name in CANDLE_FIELDS}
+
+
+def _aggregate_numpy(timestamps, rates, interval: int) -> Dict[str, list]:
+    """Векторная группировка: столбец времени отсортирован, группы — непрерывные отрезки."""
+    ts = np.frombuffer(timestamps, dtype=np.float64)
+    values = np.frombuffer(rates, dtype=np.float64)
+    buckets = (ts // interval).astype(np.int64)
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(buckets)) + 1))
+    ends = np.append(starts[1:], len(values))
+    return {
+        "t": (buckets[starts] * interval).tolist(),
+        "open": values[starts].tolist(),
+        "high": np.maximum.reduceat(values, starts).tolist(),
+        "low": np.minimum.reduceat(values, starts).tolist(),
+        "close": values[ends - 1].tolist(),
+        "sum": np.add.reduceat(values, starts).tolist(),
+        "count": (ends - starts).tolist()
+    }
+
+
+def _aggregate_python(timestamps, rates, interval: int) -> Dict[str, list]:
+    """Построчная группировка для окружения без numpy."""
+    candles = _empty_candles()
+    current = None
+    for ts, rate in zip(timestamps, rates):
+        bucket = int(ts // interval) * interval
+        if bucket != current:
+            current = bucket
+            candles["t"].append(bucket)
+            candles["open"].append(rate)
+            candles["high"].append(rate)
+            candles["low"].append(rate)
+            candles["close"].append(rate)
+            candles["sum"].append(rate)
+            candles["count"].append(1)
+            continue
+        candles["high"][-1] = max(candles["high"][-1], rate)
+        candles["low"][-1] = min(candles["low"][-1], rate)
+        candles["close"][-1] = rate
+        candles["sum"][-1] += rate
+        candles["count"][-1] += 1
+    return candles
+
+
+def aggregate_columns(timestamps, rates, interval: int) -> Dict[str, list]:
+    """
+    Агрегирует отсортированные по времени столбцы в свечи заданного интервала.
+
+    Returns:
+        Столбцы свечей: t (начало интервала, секунды Unix), open, high, low,
+        close, sum и count (среднее = sum / count).
+    """
+    if not len(timestamps):
+        return _empty_candles()
+    if np is not None:
+        return _aggregate_numpy(timestamps, rates, interval)
+    return _aggregate_python(timestamps, rates, interval)
+
+
+def carry_forward(candles: Dict[str, list], interval: int, until: Optional[float] = None) -> Dict[str, list]:
+    """
+    Восстанавливает свечи по правилу LOCF для истории в дельта‑режиме.
+
+    Интервалы без строк заполняются закрытием предыдущего (count = 0), а
+    открытие каждого следующего интервала — закрытие предыдущего, потому
+    что до первой новой строки действует прежний курс.
+
+    Args:
+        until: довести ряд до этого момента (секунды Unix).
+    """
+    filled = _empty_candles()
+    previous_close = None
+
+    def add_flat(bucket: int, value: float) -> None:
+        for name, item in (("t", bucket), ("open", value), ("high", value), ("low", value),
+                           ("close", value), ("sum", 0.0), ("count", 0)):
+            filled[name].append(item)
+
+    for i, bucket in enumerate(candles["t"]):
+        if previous_close is not None:
+            gap = filled["t"][-1] + interval
+            while gap < bucket:
+                add_flat(gap, previous_close)
+                gap += interval
+        opening = candles["open"][i] if previous_close is None else previous_close
+        filled["t"].append(bucket)
+        filled["open"].append(opening)
+        filled["high"].append(max(candles["high"][i], opening))
+        filled["low"].append(min(candles["low"][i], opening))
+        filled["close"].append(candles["close"][i])
+        filled["sum"].append(candles["sum"][i])
+        filled["count"].append(candles["count"][i])
+        previous_close = candles["close"][i]
+
+    if until is not None and previous_close is not None:
+        gap = filled["t"][-1] + interval
+        while gap <= until:
+            add_flat(gap, previous_close)
+            gap += interval
+    return filled
+
+
+def merge_candles(candles: List[Dict[str, Any]], interval: int) -> List[Dict[str, Any]]:
+    """
+    Объединяет свечи (отсортированные по времени) в свечи более длинного интервала
+    отдельно для каждой пары.
+    """
+    merged: Dict[tuple, Dict[str, Any]] = {}
+    for candle in candles:
+        bucket = int(candle["t"] // interval) * interval
+        key = (candle["pair"], bucket)
+        current = merged.get(key)
+        if current is None:
+            merged[key] = dict(candle, t=bucket)
+            continue
+        current["high"] = max(current["high"], candle["high"])
+        current["low"] = min(current["low"], candle["low"])
+        current["close"] = candle["close"]
+        current["sum"] += candle["sum"]
+        current["count"] += candle["count"]
+    return sorted(merged.values(), key=lambda candle: (candle["t"], candle["pair"]))
+
+
+def _row_mean(candles: Dict[str, list], i: int, locf: bool) -> Optional[float]:
+    """
+    Среднее свечи. В режиме LOCF строки — только изменения курса, и sum / count
+    усредняет их без учёта того, сколько держалось каждое значение; такое
+    среднее расходится с полной историей, поэтому не выдаётся (None). Точно
+    оно известно лишь для интервала без изменений — это его курс.
+    """
+    if not candles["count"][i]:
+        return candles["close"][i]
+    if locf:
+        return None
+    return candles["sum"][i] / candles["count"][i]
+
+
+def candles_to_rows(candles: Dict[str, list], locf: bool = False) -> List[Dict[str, Any]]:
+    """
+    Столбцы свечей → список словарей с OHLC, средним и последним значением.
+
+    Args:
+        locf: свечи восстановлены по LOCF из дельта‑истории (см. _row_mean).
+    """
+    rows = []
+    for i, start in enumerate(candles["t"]):
+        rows.append({
+            "start": datetime.fromtimestamp(start, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "open": candles["open"][i],
+            "high": candles["high"][i],
+            "low": candles["low"][i],
+            "close": candles["close"][i],
+            "mean": _row_mean(candles, i, locf),
+            "last": candles["close"][i],
+            "count": candles["count"][i]
+        })
+    return rows
+
+
+class RollupCache:
+    """
+    Кеш материализованных свечей по интервалам.
+
+    data/rollups/<интервал в секундах>/<пара>.json хранит свечи и число уже
+    учтённых строк колоночной истории. При новых записях пересчитывается
+    только последняя (возможно, незавершённая) свеча и хвост после неё.
+    """
+
+    def __init__(self, directory: str = None, columns: ColumnarHistory = None):
+        self.directory = directory or config.ROLLUPS_DIR_PATH
+        self.columns = columns or columnar_history
+        self._lock = threading.Lock()
+
+    def _path(self, pair: str, interval: int) -> str:
+        return os.path.join(self.directory, str(interval), f"{pair}.json")
+
+    @staticmethod
+    def _empty_cache(interval: int) -> Dict[str, Any]:
+        return {"interval": interval, "rows": 0, "last_start_row": 0, "candles": _empty_candles()}
+
+    def _load(self, pair: str, interval: int) -> Dict[str, Any]:
+        try:
+            with open(self._path(pair, interval), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return self._empty_cache(interval)
+
+    def _save(self, pair: str, interval: int, cache: Dict[str, Any]) -> None:
+        # Кеш восстановим из столбцов, fsync не нужен
+        atomic_write_json(self._path(pair, interval), cache, fsync=False)
+
+    def get(self, pair: str, interval: int) -> Dict[str, list]:
+        """
+        Возвращает свечи пары, дополнив кеш новыми строками истории.
+
+        Args:
+            pair: ключ пары (BTC_USD).
+            interval: интервал в секундах.
+        """
+        with self._lock:
+            cache = self._load(pair, interval)
+            columns = self.columns.open_pair(pair)
+            if columns is None:
+                return cache["candles"]
+            with columns:
+                if cache.get("generation", columns.generation) != columns.generation:
+                    # Столбцы компактированы — кеш недействителен
+                    cache = self._empty_cache(interval)
+                cache["generation"] = columns.generation
+                if len(columns) == cache["rows"]:
+                    return cache["candles"]
+
+                # Последняя свеча могла быть неполной: пересчитываем с её первой строки
+                start_row = cache["last_start_row"]
+                fresh = aggregate_columns(
+                    columns.timestamps[start_row:], columns.rates[start_row:], interval
+                )
+                candles = cache["candles"]
+                if candles["t"]:
+                    for name in CANDLE_FIELDS:
+                        del candles[name][-1]
+                for name in CANDLE_FIELDS:
+                    candles[name].extend(fresh[name])
+
+                cache["rows"] = len(columns)
+                last_count = candles["count"][-1] if candles["count"] else 0
+                cache["last_start_row"] = cache["rows"] - last_count
+
+            self._save(pair, interval, cache)
+            return candles
+
+
+rollup_cache = RollupCache()
+
+
+def _tier_candles(pair: str, seconds: int) -> Dict[str, list]:
+    """
+    Свечи пары из уровней компакции, перегруппированные в интервал seconds.
+    Часовые свечи подходят для интервалов, кратных часу, дневные — кратных суткам.
+    """
+    source = []
+    if seconds % TIER_SECONDS["daily"] == 0:
+        source.extend(history_store.iter_tier_candles("daily", pair))
+    if seconds % TIER_SECONDS["hourly"] == 0:
+        source.extend(history_store.iter_tier_candles("hourly", pair))
+    candles = _empty_candles()
+    for candle in merge_candles(source, seconds):
+        for name in CANDLE_FIELDS:
+            candles[name].append(candle[name])
+    return candles
+
+
+def history_candles(
+    pair: str,
+    interval: str,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+    use_cache: bool = True,
+    locf: bool = None
+) -> List[Dict[str, Any]]:
+    """
+    Свечи OHLC, средние и последние значения пары за интервалы заданной длины.
+
+    Args:
+        pair: код валюты (BTC) или пара (BTC_USD).
+        interval: длина интервала (5m, 1h, 1d ...).
+        start, end: границы по времени (секунды Unix), включительно.
+        use_cache: брать и продлевать материализованные свечи из кеша.
+        locf: восстанавливать пропущенные интервалы последним значением
+            (по умолчанию — если история пишется в дельта‑режиме).
+    """
+    key = pair_key(pair)
+    seconds = parse_interval(interval)
+
+    # Дочитываем новые записи журнала в колоночное хранилище
+    columnar_history.sync_from_history()
+
+    if use_cache:
+        candles = rollup_cache.get(key, seconds)
+    else:
+        columns = columnar_history.open_pair(key)
+        if columns is None:
+            return []
+        with columns:
+            candles = aggregate_columns(columns.timestamps, columns.rates, seconds)
+
+    # Диапазон старше сырой истории дополняется компактированными свечами
+    older = _tier_candles(key, seconds)
+    if older["t"]:
+        first_raw = candles["t"][0] if candles["t"] else float("inf")
+        keep = [i for i, bucket in enumerate(older["t"]) if bucket < first_raw]
+        candles = {
+            name: [older[name][i] for i in keep] + list(candles[name])
+            for name in CANDLE_FIELDS
+        }
+
+    locf = config.HISTORY_DELTA_MODE if locf is None else locf
+    if locf:
+        candles = carry_forward(candles, seconds, until=end)
+
+    if start is not None or end is not None:
+        keep = [
+            i for i, bucket in enumerate(candles["t"])
+            if (start is None or bucket + seconds > start) and (end is None or bucket <= end)
+        ]
+        candles = {name: [candles[name][i] for i in keep] for name in CANDLE_FIELDS}
+    return candles_to_rows(candles, locf=locf)
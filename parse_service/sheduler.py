@@ -0,0 +1,181 @@
+import random
+import threading
+import time
+from typing import Dict, List, Optional
+from parse_service.api_clients import BaseApiClient
+from parse_service.compaction import HistoryCompactor, compactor
+from parse_service.config import config
+from parse_service.console import background, echo
+from parse_service.updater import RatesUpdater, er, rates_updates
+
+
+class RefreshScheduler:
+    """
+    Фоновое обновление курсов (stale-while-revalidate).
+
+    - каждый источник обновляется в фоновом daemon‑потоке по своему интервалу
+      (config.SOURCE_REFRESH_INTERVALS) со случайным джиттером;
+    - команды пользователя читают текущий снимок сразу и лишь просят
+      перепроверку через request_revalidation(): одновременно в очереди
+      или в работе находится не более одной такой перепроверки;
+    - раз в COMPACTION_INTERVAL в том же потоке выполняется компакция истории;
+    - сообщения фоновых обновлений и компакции пишутся в журнал logging
+      (см. valutatrade_hub.logging_config), а не в stdout.
+    """
+
+    def __init__(self, updater: RatesUpdater, jitter: float = None, history_compactor: HistoryCompactor = None):
+        """
+        Args:
+            updater: координатор обновления курсов.
+            jitter: доля интервала для случайного сдвига (по умолчанию config.SCHEDULER_JITTER).
+            history_compactor: задача компакции истории (по умолчанию общий compactor).
+        """
+        self._updater = updater
+        self._compactor = history_compactor or compactor
+        self._next_compaction = 0.0
+        self._jitter = config.SCHEDULER_JITTER if jitter is None else jitter
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = False
+        self._revalidation_pending = False
+        self._next_due: Dict[str, float] = {}
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def interval_for(self, client: BaseApiClient) -> float:
+        """Интервал обновления источника в секундах."""
+        return config.SOURCE_REFRESH_INTERVALS.get(client.source, config.CACHE_TTL)
+
+    def _jittered(self, interval: float) -> float:
+        """Интервал со случайным сдвигом ±jitter, чтобы источники не синхронизировались."""
+        return interval * (1 + random.uniform(-self._jitter, self._jitter))
+
+    def start(self) -> None:
+        """Запускает фоновый поток планировщика (повторный вызов ничего не делает)."""
+        with self._cond:
+            if self.running:
+                return
+            self._stopped = False
+            now = time.monotonic()
+            # Устаревший снимок обновляем сразу, свежий — по расписанию
+            first_delay = 0.0 if er.is_stale() else None
+            for client in self._updater.clients:
+                delay = first_delay if first_delay is not None else self._jittered(self.interval_for(client))
+                self._next_due[client.source] = now + delay
+            # Первая компакция — после первого цикла обновления
+            self._next_compaction = now + self._jittered(60.0)
+            self._thread = threading.Thread(
+                target=self._loop,
+                name="rates-scheduler",
+                daemon=True
+            )
+            self._thread.start()
+
+    def stop(self, timeout: float = None) -> None:
+        """Останавливает планировщик; текущее обновление дорабатывает до конца."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def request_revalidation(self) -> bool:
+        """
+        Просит обновить все источники в фоне, не дожидаясь результата.
+
+        Returns:
+            True, если перепроверка запущена; False, если она уже в очереди или в работе.
+        """
+        with self._cond:
+            if self._revalidation_pending:
+                return False
+            self._revalidation_pending = True
+            if self.running:
+                self._cond.notify_all()
+                return True
+
+        # Планировщик не запущен — выполняем разовую перепроверку в отдельном потоке
+        threading.Thread(
+            target=self._run_background_revalidation,
+            name="rates-revalidate",
+            daemon=True
+        ).start()
+        return True
+
+    def revalidate_if_stale(self) -> bool:
+        """Запускает фоновую перепроверку, если снимок старше CACHE_TTL."""
+        if er.is_stale():
+            return self.request_revalidation()
+        return False
+
+    def _run_background_revalidation(self) -> None:
+        with background():
+            self._run_revalidation()
+
+    def _run_revalidation(self) -> None:
+        try:
+            self._refresh(self._updater.clients)
+        finally:
+            with self._cond:
+                self._revalidation_pending = False
+
+    def _refresh(self, clients: List[BaseApiClient]) -> None:
+        """Обновляет указанные источники и переносит их следующий срок."""
+        try:
+            # Источник, только что опрошенный другим процессом, повторно не опрашивается
+            self._updater.run_update(clients, force=False)
+        except Exception as e:
+            echo(f"Фоновое обновление курсов завершилось ошибкой: {e}")
+        finally:
+            now = time.monotonic()
+            with self._cond:
+                for client in clients:
+                    self._next_due[client.source] = now + self._jittered(self.interval_for(client))
+
+    def _compact(self) -> None:
+        """Компакция истории курсов; ошибка не останавливает планировщик."""
+        try:
+            self._compactor.run()
+        except Exception as e:
+            echo(f"Компакция истории курсов завершилась ошибкой: {e}")
+        finally:
+            with self._cond:
+                self._next_compaction = time.monotonic() + self._jittered(config.COMPACTION_INTERVAL)
+
+    def _loop(self) -> None:
+        # Сообщения фонового обновления не вклиниваются в вывод команд (см. console.echo)
+        with background():
+            self._run_loop()
+
+    def _run_loop(self) -> None:
+        while True:
+            with self._cond:
+                if self._stopped:
+                    return
+                now = time.monotonic()
+                revalidate = self._revalidation_pending
+                due = [
+                    client for client in self._updater.clients
+                    if self._next_due.get(client.source, now) <= now
+                ]
+                compact = self._next_compaction <= now
+                if not revalidate and not due and not compact:
+                    wake_at = min(
+                        min(self._next_due.values(), default=now + config.CACHE_TTL),
+                        self._next_compaction
+                    )
+                    self._cond.wait(max(wake_at - now, 0))
+                    continue
+
+            if revalidate:
+                self._run_revalidation()
+            elif due:
+                self._refresh(due)
+            else:
+                self._compact()
+
+
+refresh_scheduler = RefreshScheduler(rates_updates)
@@ -0,0 +1,371 @@
+"""
+Локальный заменитель API курсов для тестов и замеров без сети.
+
+Сервер отвечает в форматах CoinGecko (/api/v3/simple/price) и
+ExchangeRate-API (/v6/<ключ>/latest/<база>) синтетическими или записанными
+данными. Задержка, доля ошибок, поведение ETag/304 и размер ответа
+настраиваются.
+
+Запуск:
+    python -m parse_service.standin_server --port 8099 --pairs 5000 --latency 0.05
+    RATES_STANDIN_URL=http://127.0.0.1:8099 make project
+
+Замер опроса:
+    python -m parse_service.standin_server --benchmark 100 --latency 0.02 --error-rate 0.05
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+import requests
+from parse_service.config import config
+
+
+COINGECKO_PATH = "/api/v3/simple/price"
+EXCHANGERATE_PATH = re.compile(r"^/v6/(?P<key>[^/]*)/latest/(?P<base>[A-Za-z]+)$")
+
+# Ориентиры для правдоподобных курсов (единиц валюты за 1 USD / USD за монету)
+FIAT_ANCHORS = {"USD": 1.0, "EUR": 0.92, "GBP": 0.79, "RUB": 92.5, "JPY": 149.0, "CNY": 7.2}
+CRYPTO_ANCHORS = {"bitcoin": 67000.0, "ethereum": 3500.0, "solana": 150.0}
+
+
+@dataclass
+class StandinOptions:
+    """Поведение заменителя API."""
+    # Задержка ответа: latency ± latency_jitter секунд
+    latency: float = 0.0
+    latency_jitter: float = 0.0
+    # Доля ответов 503 (повторяемые клиентом ошибки)
+    error_rate: float = 0.0
+    # Отвечать ETag и 304 на If-None-Match
+    etag: bool = True
+    # Данные меняются раз в change_every запросов к эндпоинту (0 — никогда)
+    change_every: int = 1
+    # Число синтетических валют в ответе ExchangeRate-API и монет CoinGecko без ids
+    pairs: int = 160
+    # JSON с записанными ответами {"coingecko": {...}, "exchangerate": {...}}
+    fixture: Optional[str] = None
+    seed: int = 0
+
+
+def synthetic_codes(count: int) -> List[str]:
+    """Детерминированные трёхбуквенные коды: сначала реальные ориентиры, затем AAA, AAB, ..."""
+    codes = list(FIAT_ANCHORS)
+    alphabet = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    i = 0
+    while len(codes) < count:
+        code = alphabet[i // 676 % 26] + alphabet[i // 26 % 26] + alphabet[i % 26]
+        if code not in FIAT_ANCHORS:
+            codes.append(code)
+        i += 1
+    return codes[:max(count, 1)]
+
+
+class StandinState:
+    """Общее состояние сервера: версии данных, счётчики и генератор случайностей."""
+
+    def __init__(self, options: StandinOptions):
+        self.options = options
+        self._lock = threading.Lock()
+        self._random = random.Random(options.seed)
+        self._requests: Dict[str, int] = {"coingecko": 0, "exchangerate": 0}
+        self.stats: Dict[str, int] = {"200": 0, "304": 0, "503": 0, "404": 0}
+        self.fixture: Dict[str, Any] = {}
+        if options.fixture:
+            with open(options.fixture, 'r', encoding='utf-8') as f:
+                self.fixture = json.load(f)
+        self._fiat_codes = synthetic_codes(options.pairs)
+
+    def next_request(self, endpoint: str) -> Dict[str, Any]:
+        """Регистрирует запрос: возвращает версию данных, задержку и признак ошибки."""
+        with self._lock:
+            number = self._requests[endpoint]
+            self._requests[endpoint] += 1
+            delay = self.options.latency
+            if self.options.latency_jitter:
+                delay += self._random.uniform(-self.options.latency_jitter, self.options.latency_jitter)
+            fail = self._random.random() < self.options.error_rate
+        version = number // self.options.change_every if self.options.change_every else 0
+        return {"version": version, "delay": max(delay, 0.0), "fail": fail}
+
+    def count(self, status: int) -> None:
+        with self._lock:
+            self.stats[str(status)] = self.stats.get(str(status), 0) + 1
+
+    @staticmethod
+    def _drift(name: str, version: int) -> float:
+        """Детерминированное колебание курса в пределах ±1% для версии данных."""
+        digest = hashlib.md5(f"{name}:{version}".encode()).digest()
+        return 1 + (int.from_bytes(digest[:4], "big") / 0xFFFFFFFF - 0.5) / 50
+
+    def coingecko_payload(self, ids: List[str], vs: str, version: int) -> Dict[str, Any]:
+        if "coingecko" in self.fixture:
+            recorded = self.fixture["coingecko"]
+            return {cg_id: recorded[cg_id] for cg_id in (ids or recorded) if cg_id in recorded}
+        if not ids:
+            ids = list(CRYPTO_ANCHORS) + [f"coin-{i:05d}" for i in range(self.options.pairs)]
+        payload = {}
+        for cg_id in ids:
+            anchor = CRYPTO_ANCHORS.get(cg_id)
+            if anchor is None:
+                anchor = 1 + int(hashlib.md5(cg_id.encode()).hexdigest()[:6], 16) % 1000
+            payload[cg_id] = {vs: round(anchor * self._drift(cg_id, version), 8)}
+        return payload
+
+    def exchangerate_payload(self, base: str, version: int) -> Dict[str, Any]:
+        if "exchangerate" in self.fixture:
+            return self.fixture["exchangerate"]
+        rates = {}
+        for code in self._fiat_codes:
+            anchor = FIAT_ANCHORS.get(code)
+            if anchor is None:
+                anchor = 0.01 + int(hashlib.md5(code.encode()).hexdigest()[:6], 16) % 5000 / 10
+            rates[code] = 1.0 if code == base else round(anchor * self._drift(code, version), 6)
+        now = datetime.now(timezone.utc)
+        return {
+            "result": "success",
+            "base_code": base,
+            "time_last_update_unix": int(now.timestamp()),
+            "time_last_update_utc": now.strftime("%a, %d %b %Y %H:%M:%S +0000"),
+            "conversion_rates": rates
+        }
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    """Обработчик запросов в форматах CoinGecko и ExchangeRate-API."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        # Журнал запросов не нужен: статистика считается в StandinState
+        pass
+
+    @property
+    def state(self) -> StandinState:
+        return self.server.state
+
+    def _send(self, status: int, body: bytes = b"", headers: Dict[str, str] = None) -> None:
+        self.state.count(status)
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == COINGECKO_PATH:
+            endpoint = "coingecko"
+        elif EXCHANGERATE_PATH.match(url.path):
+            endpoint = "exchangerate"
+        else:
+            self._send(404, b'{"error": "not found"}', {"Content-Type": "application/json"})
+            return
+
+        request = self.state.next_request(endpoint)
+        if request["delay"]:
+            time.sleep(request["delay"])
+        if request["fail"]:
+            self._send(503, b'{"error": "service unavailable"}', {"Content-Type": "application/json"})
+            return
+
+        if endpoint == "coingecko":
+            query = parse_qs(url.query)
+            ids = [cg_id for cg_id in query.get("ids", [""])[0].split(",") if cg_id]
+            vs = query.get("vs_currencies", [config.BASE_CURRENCY.lower()])[0]
+            payload = self.state.coingecko_payload(ids, vs, request["version"])
+        else:
+            base = EXCHANGERATE_PATH.match(url.path).group("base").upper()
+            payload = self.state.exchangerate_payload(base, request["version"])
+
+        body = json.dumps(payload).encode()
+        headers = {"Content-Type": "application/json"}
+        if self.state.options.etag:
+            etag = f"\"{hashlib.md5(body).hexdigest()[:16]}\""
+            headers["ETag"] = etag
+            if self.headers.get("If-None-Match") == etag:
+                self._send(304, headers={"ETag": etag})
+                return
+        self._send(200, body, headers)
+
+
+class StandinServer:
+    """
+    Заменитель API в фоновом потоке.
+
+    Пример:
+        with StandinServer(StandinOptions(latency=0.05, pairs=5000)) as server:
+            client = ExchangeRateApiClient(unlimited_budget)
+            client._url = server.exchangerate_url
+    """
+
+    def __init__(self, options: StandinOptions = None, host: str = "127.0.0.1", port: int = 0):
+        self.options = options or StandinOptions()
+        self._httpd = ThreadingHTTPServer((host, port), StandinHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.state = StandinState(self.options)
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def state(self) -> StandinState:
+        return self._httpd.state
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def coingecko_url(self) -> str:
+        return f"{self.url}{COINGECKO_PATH}"
+
+    @property
+    def exchangerate_url(self) -> str:
+        return f"{self.url}/v6/standin/latest/{config.BASE_CURRENCY}"
+
+    def start(self) -> "StandinServer":
+        self._thread = threading.Thread(
+            target=self._httpd.serve_forever,
+            name="rates-standin",
+            daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def record_fixture(path: str) -> None:
+    """Сохраняет текущие ответы настоящих API в файл для воспроизведения (--fixture)."""
+    ids = ",".join(config.CRYPTO_ID_MAP.values())
+    params = {"ids": ids, "vs_currencies": config.BASE_CURRENCY.lower()}
+    fixture = {
+        "coingecko": requests.get(config.COINGECKO_URL, params=params, timeout=config.REQUEST_TIMEOUT).json(),
+        "exchangerate": requests.get(config.EXCHANGERATE_API_URL, timeout=config.REQUEST_TIMEOUT).json()
+    }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(fixture, f, ensure_ascii=False, indent=2)
+    print(f"Ответы API записаны в {path}")
+
+
+def _percentile(values: List[float], share: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * share), len(ordered) - 1)] if ordered else 0.0
+
+
+def benchmark(rounds: int = 50, options: StandinOptions = None) -> Dict[str, float]:
+    """
+    Замеряет этап опроса обновления курсов на заменителе API.
+
+    Каждый раунд опрашивает оба источника так же, как RatesUpdater (параллельно,
+    с дедлайном, повторами и предохранителями). Клиенты работают с бюджетом
+    без ограничений: общий бюджет запросов (data/api_budget.json) и другие
+    файлы данных не изменяются.
+
+    Returns:
+        Раунды в секунду, перцентили длительности раунда (мс) и статистика ответов.
+    """
+    # Импорт здесь: модуль updater при загрузке читает снимок курсов
+    from parse_service.api_clients import CoinGeckoClient, ExchangeRateApiClient
+    from parse_service.budget import unlimited_budget
+    from parse_service.updater import RatesUpdater
+
+    with StandinServer(options) as server:
+        coingecko = CoinGeckoClient(unlimited_budget)
+        coingecko.url = server.coingecko_url
+        exchangerate = ExchangeRateApiClient(unlimited_budget)
+        exchangerate._url = server.exchangerate_url
+        updater = RatesUpdater([coingecko, exchangerate])
+
+        durations = []
+        records = 0
+        started = time.perf_counter()
+        for _ in range(rounds):
+            round_started = time.perf_counter()
+            rates, _unchanged, _failed = updater._fetch_concurrent(updater.clients, config.REFRESH_DEADLINE)
+            durations.append((time.perf_counter() - round_started) * 1000)
+            records += len(rates)
+        elapsed = time.perf_counter() - started
+
+        result = {
+            "rounds": rounds,
+            "rounds_per_s": rounds / elapsed if elapsed else 0.0,
+            "records": records,
+            "p50_ms": _percentile(durations, 0.50),
+            "p95_ms": _percentile(durations, 0.95),
+            "p99_ms": _percentile(durations, 0.99),
+            "max_ms": max(durations, default=0.0)
+        }
+        result.update({f"http_{status}": count for status, count in server.state.stats.items()})
+        return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Локальный заменитель API курсов")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа, с")
+    parser.add_argument("--latency-jitter", type=float, default=0.0, help="разброс задержки, с")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 503")
+    parser.add_argument("--no-etag", action="store_true", help="не отвечать ETag и 304")
+    parser.add_argument("--change-every", type=int, default=1, help="менять данные раз в N запросов (0 — никогда)")
+    parser.add_argument("--pairs", type=int, default=160, help="число валют в ответе")
+    parser.add_argument("--fixture", help="JSON с записанными ответами API")
+    parser.add_argument("--record", metavar="PATH", help="записать ответы настоящих API в файл и выйти")
+    parser.add_argument("--benchmark", type=int, metavar="ROUNDS", help="выполнить замер опроса и выйти")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.record:
+        record_fixture(args.record)
+        return
+
+    options = StandinOptions(
+        latency=args.latency,
+        latency_jitter=args.latency_jitter,
+        error_rate=args.error_rate,
+        etag=not args.no_etag,
+        change_every=args.change_every,
+        pairs=args.pairs,
+        fixture=args.fixture,
+        seed=args.seed
+    )
+    if args.benchmark:
+        for name, value in benchmark(args.benchmark, options).items():
+            print(f"{name:>14}: {value:.2f}" if isinstance(value, float) else f"{name:>14}: {value}")
+        return
+
+    server = StandinServer(options, args.host, args.port)
+    print(f"Заменитель API запущен: {server.url}")
+    print(f"RATES_STANDIN_URL={server.url}")
+    try:
+        server._httpd.serve_forever()
+    except KeyboardInterrupt:
+        print("\nОстановлен")
+    finally:
+        server._httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,21 @@
-from datetime import datetime
-from typing import List, Dict, Any
-from parse_service.api_clients import BaseApiClient, CoinGeckoClient, ExchangeRateApiClient
+from datetime import datetime, timezone
+from typing import List, Dict, Any, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor, wait
+from parse_service.api_clients import (
+    BaseApiClient, BudgetExhaustedError, CircuitOpenError, CoinGeckoClient, ExchangeRateApiClient,
+    RatesNotModified
+)
+from parse_service.config import config
+from parse_service.console import echo, submit
+from parse_service.fileutils import atomic_write_json, file_lock
+from parse_service.history import HistoryStore, history_store
+from parse_service.columnar import columnar_history
+from parse_service.rate_matrix import RateMatrix
 import json
 import os
-from constants import RATES_FILE, HISTORY_RATES_FILE
+import threading
+import time
+from constants import RATES_FILE
 
 CG = CoinGeckoClient()
 ER_api = ExchangeRateApiClient()
@@ -31,45 +43,92 @@ def load_rates_as_dict(json_file: str) -> Dict[str, float]:
         return rates_dict, data['last_refresh']
 
     except FileNotFoundError:
-        print(f"Файл {json_file} не найден.")
+        echo(f"Файл {json_file} не найден.")
         return {}
     except KeyError as e:
-        print(f"Ошибка: отсутствует ключ {e} в JSON.")
+        echo(f"Ошибка: отсутствует ключ {e} в JSON.")
         return {}
     except json.JSONDecodeError as e:
-        print(f"Ошибка парсинга JSON: {e}")
+        echo(f"Ошибка парсинга JSON: {e}")
         return {}
     except Exception as e:
-        print(f"Неожиданная ошибка: {e}")
+        echo(f"Неожиданная ошибка: {e}")
         return {}
 
 
-def append_exchange_rates(data: List[Dict[str, Any]], output_file: str = HISTORY_RATES_FILE) -> None:
-    # Читаем существующие данные (если файл есть)
-    existing_records = []
-    if os.path.exists(output_file):
-        try:
-            with open(output_file, 'r', encoding='utf-8') as f:
-                existing_records = json.load(f)
-        except (json.JSONDecodeError, IOError) as e:
-            print(f"Предупреждение: не удалось прочитать существующий файл {output_file}: {e}")
-            existing_records = []
+def _read_snapshot(json_file: str) -> Dict[str, Any]:
+    """Читает rates.json целиком; если файла нет или он повреждён — пустой снимок."""
+    try:
+        with open(json_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {"pairs": {}}
+
+
+def refresh_meta_path(json_file: str) -> str:
+    """Файл служебных полей снимка рядом с ним: data/rates.json → data/rates.meta.json."""
+    root, ext = os.path.splitext(json_file)
+    return f"{root}.meta{ext}"
+
+
+def load_refresh_meta(json_file: str) -> Optional[Dict[str, Any]]:
+    """
+    Читает служебные поля снимка (last_refresh, stale_sources) из файла
+    рядом с rates.json.
+
+    Returns:
+        Словарь полей или None, если файла ещё нет.
+    """
+    try:
+        with open(refresh_meta_path(json_file), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def load_snapshot_meta(json_file: str) -> Tuple[Dict[str, str], Dict[str, str]]:
+    """
+    Читает из rates.json источник каждой пары и недоступные источники.
+
+    Returns:
+        ({пара: источник}, {источник: с какого времени недоступен}).
+    """
+    data = _read_snapshot(json_file)
+    pair_sources = {
+        pair_key: pair_info.get('source', '') for pair_key, pair_info in data.get('pairs', {}).items()
+    }
+    return pair_sources, data.get('stale_sources', {})
+
+
+def append_exchange_rates(data: List[Dict[str, Any]], store: HistoryStore = None) -> None:
+    """
+    Дописывает новые записи в журнал истории курсов.
+
+    Стоимость — O(новых записей): существующая история не читается и не
+    переписывается (см. HistoryStore).
+
+    Args:
+        data: записи API‑клиентов.
+        store: журнал истории (по умолчанию общий history_store).
+    """
+    store = store or history_store
 
     # Обрабатываем новые записи
     new_records = []
+    batches = {}
     for record in data:
         # Валидация обязательных полей
         required_fields = {'from_currency', 'to_currency', 'rate', 'timestamp', 'source', 'meta'}
         if not all(field in record for field in required_fields):
-            print(f"Пропускаем запись: отсутствуют обязательные поля — {record}")
+            echo(f"Пропускаем запись: отсутствуют обязательные поля — {record}")
             continue
 
         # Проверка типов
         if not isinstance(record['rate'], (int, float)) or record['rate'] < 0:
-            print(f"Пропускаем запись: некорректный rate — {record}")
+            echo(f"Пропускаем запись: некорректный rate — {record}")
             continue
         if not isinstance(record['timestamp'], str):
-            print(f"Пропускаем запись: timestamp не строка — {record}")
+            echo(f"Пропускаем запись: timestamp не строка — {record}")
             continue
 
         # Нормализация: коды валют в верхний регистр
@@ -92,35 +151,47 @@ def append_exchange_rates(data: List[Dict[str, Any]], output_file: str = HISTORY
         }
         new_records.append(processed_record)
 
-    # Объединяем существующие и новые записи
-    all_records = existing_records + new_records
+        # Метаданные запроса сохраняются один раз на ответ, записи ссылаются на них по batch_id
+        batch = record.get('batch')
+        if batch is not None and batch['batch_id'] not in batches:
+            batches[batch['batch_id']] = batch
 
-    # Атомарная запись: временный файл → rename
-    temp_file = output_file + ".tmp"
     try:
-        with open(temp_file, 'w', encoding='utf-8') as f:
-            json.dump(all_records, f, ensure_ascii=False, indent=2)
-        # Атомарное переименование
-        os.replace(temp_file, output_file)
-        print(f"Успешно добавлено {len(new_records)} новых записей (всего {len(all_records)} в {output_file})")
+        written = store.append(new_records, list(batches.values()))
+        echo(f"Успешно добавлено {written} новых записей из {len(new_records)} в {store.directory}")
     except Exception as e:
-        print(f"Ошибка при записи файла: {e}")
-        if os.path.exists(temp_file):
-            os.remove(temp_file)
+        echo(f"Ошибка при записи истории: {e}")
+        return
+
+    # Колоночное представление достраивается из новых сегментов журнала
+    try:
+        columnar_history.sync_from_history(store)
+    except Exception as e:
+        echo(f"Ошибка при обновлении колоночной истории: {e}")
 
 
 def save_rates_as_pairs(
     data: List[Dict[str, Any]],
     output_file: str = RATES_FILE,
-    last_refresh: str = None
+    last_refresh: str = None,
+    stale_sources: Dict[str, str] = None
 ) -> None:
     """
-    Сохраняет курсы валют 
+    Сливает курсы валют в снимок rates.json.
+
+    Меняются только пары, курс (или источник) которых изменился: у такой
+    пары увеличивается version и обновляется updated_at (время наблюдения
+    у источника). Пары, которых нет в data (например, источник недоступен),
+    остаются из прежнего снимка. Если не изменилось ничего, rates.json не
+    переписывается — отметка last_refresh и недоступные источники
+    обновляются в rates.meta.json (см. touch_last_refresh).
 
     Args:
         data: список словарей с данными о курсах.
         output_file: путь к выходному файлу.
         last_refresh: timestamp для поля last_refresh (если None — берётся сейчас).
+        stale_sources: недоступные источники {источник: с какого времени}
+            (None — оставить как в снимке).
     """
     # Валидация и нормализация входных данных
     valid_records = []
@@ -128,15 +199,15 @@ def save_rates_as_pairs(
         # Проверка обязательных полей
         required_fields = {'from_currency', 'to_currency', 'rate', 'timestamp', 'source'}
         if not all(field in record for field in required_fields):
-            print(f"Пропускаем запись: отсутствуют обязательные поля — {record}")
+            echo(f"Пропускаем запись: отсутствуют обязательные поля — {record}")
             continue
 
         # Проверка типов
         if not isinstance(record['rate'], (int, float)) or record['rate'] < 0:
-            print(f"Пропускаем запись: некорректный rate — {record}")
+            echo(f"Пропускаем запись: некорректный rate — {record}")
             continue
         if not isinstance(record['timestamp'], str):
-            print(f"Пропускаем запись: timestamp не строка — {record}")
+            echo(f"Пропускаем запись: timestamp не строка — {record}")
             continue
 
         # Нормализация: валюты в верхний регистр
@@ -155,40 +226,125 @@ def save_rates_as_pairs(
             "source": record['source']
         })
 
-    # Сбор актуальных записей (по свежему updated_at)
-    pairs = {}
+    # Свежайшая запись каждой пары в пачке
+    latest = {}
     for record in valid_records:
         pair_key = record["pair"]
-        # Если пары ещё нет или новая запись свежее — обновляем
-        if pair_key not in pairs or record["updated_at"] > pairs[pair_key]["updated_at"]:
-            pairs[pair_key] = {
-                "rate": record["rate"],
-                "updated_at": record["updated_at"],
-                "source": record["source"]
-            }
-
-    # Формирование итогового объекта
-    result = {
-        "pairs": pairs,
-        "last_refresh": last_refresh or datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
-    }
+        if pair_key not in latest or record["updated_at"] > latest[pair_key]["updated_at"]:
+            latest[pair_key] = record
+
+    # Слияние с текущим снимком: пары, которых нет в пачке, остаются как есть
+    snapshot = _read_snapshot(output_file)
+    pairs = snapshot.setdefault("pairs", {})
+    changed = {}
+    for pair_key, record in latest.items():
+        current = pairs.get(pair_key)
+        if current is not None:
+            # Запоздавшее наблюдение не затирает более новое
+            if record["updated_at"] < current["updated_at"]:
+                continue
+            if record["rate"] == current["rate"] and record["source"] == current["source"]:
+                continue
+        pairs[pair_key] = {
+            "rate": record["rate"],
+            "updated_at": record["updated_at"],
+            "source": record["source"],
+            "version": (current or {}).get("version", 0) + 1
+        }
+        changed[pair_key] = pairs[pair_key]
 
-    # Атомарная запись: временный файл → rename
-    temp_file = output_file + ".tmp"
+    if not changed:
+        # Курсы не изменились — rates.json не переписывается, отметка свежести
+        # и недоступные источники обновляются в служебном файле
+        touch_last_refresh(output_file, last_refresh, stale_sources)
+        return
+
+    snapshot["version"] = snapshot.get("version", 0) + 1
+    snapshot["last_refresh"] = last_refresh or datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+    if stale_sources is not None:
+        snapshot["stale_sources"] = stale_sources
+
+    # Атомарная запись: уникальный временный файл → rename
     try:
-        with open(temp_file, 'w', encoding='utf-8') as f:
-            json.dump(result, f, ensure_ascii=False, indent=2)
-        os.replace(temp_file, output_file)
-        
-            
-        er.exchange_rate_default, er.last_refresh = {pair_key: pair_info['rate'] for pair_key, pair_info in result['pairs'].items()},  result["last_refresh"]
-        print(f"Успешно сохранено {len(pairs)} пар в {output_file}")
+        atomic_write_json(output_file, snapshot, indent=2)
+        er.mark_written(output_file)
+    except Exception as e:
+        echo(f"Ошибка при записи файла: {e}")
+        return
+    _write_refresh_meta(output_file, {
+        "last_refresh": snapshot["last_refresh"],
+        "stale_sources": snapshot.get("stale_sources", {})
+    })
+
+    # В снимке в памяти меняются только изменившиеся пары; словари подменяются
+    # целиком, чтобы читатели в других потоках не застали их посреди изменения
+    rates = dict(er.exchange_rate_default)
+    pair_sources = dict(er.pair_sources)
+    for pair_key, pair_info in changed.items():
+        rates[pair_key] = pair_info["rate"]
+        pair_sources[pair_key] = pair_info["source"]
+    er.exchange_rate_default, er.pair_sources = rates, pair_sources
+    er.last_refresh = snapshot["last_refresh"]
+    er.stale_sources = snapshot.get("stale_sources", {})
+    echo(f"Изменилось {len(changed)} пар из {len(latest)}, снимок сохранён в {output_file}")
+
+
+def _write_refresh_meta(output_file: str, fields: Dict[str, Any]) -> bool:
+    """
+    Обновляет служебные поля снимка (last_refresh, stale_sources) в небольшом
+    файле рядом с rates.json; сам снимок с парами не переписывается.
+    """
+    meta = load_refresh_meta(output_file)
+    if meta is None:
+        # Первый раз: поля переносятся из rates.json
+        snapshot = _read_snapshot(output_file)
+        meta = {
+            "last_refresh": snapshot.get("last_refresh", ""),
+            "stale_sources": snapshot.get("stale_sources", {})
+        }
+    meta.update(fields)
 
+    path = refresh_meta_path(output_file)
+    try:
+        # Отметку свежести восстановит следующее обновление, fsync не нужен
+        atomic_write_json(path, meta, indent=2, fsync=False)
+        er.mark_written(path)
+        return True
     except Exception as e:
-        print(f"Ошибка при записи файла: {e}")
-        if os.path.exists(temp_file):
-            os.remove(temp_file)
-            
+        echo(f"Ошибка при записи файла {path}: {e}")
+        return False
+
+
+def touch_last_refresh(
+    output_file: str = RATES_FILE,
+    last_refresh: str = None,
+    stale_sources: Dict[str, str] = None
+) -> None:
+    """
+    Обновляет только отметку last_refresh (и список недоступных источников),
+    не трогая rates.json. Используется, когда курсы не изменились или
+    источники ответили 304 Not Modified.
+    """
+    last_refresh = last_refresh or datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+    fields = {"last_refresh": last_refresh}
+    if stale_sources is not None:
+        fields["stale_sources"] = stale_sources
+    if _write_refresh_meta(output_file, fields):
+        er.last_refresh = last_refresh
+        if stale_sources is not None:
+            er.stale_sources = stale_sources
+        echo(f"Курсы не изменились, отметка свежести обновлена: {last_refresh}")
+
+
+def mark_stale_sources(stale_sources: Dict[str, str], output_file: str = RATES_FILE) -> None:
+    """
+    Отмечает недоступные источники, не меняя пары и last_refresh:
+    их курсы остаются из последнего успешного снимка.
+    """
+    if _write_refresh_meta(output_file, {"stale_sources": stale_sources}):
+        er.stale_sources = stale_sources
+
+
 class RatesUpdater:
     """
     Координирует процесс обновления курсов валют:
@@ -205,41 +361,323 @@ class RatesUpdater:
             storage: экземпляр хранилища для сохранения данных.
         """
         self.clients = clients
+        self._lock = threading.RLock()
+        # Межпроцессная блокировка обновления и время последнего опроса каждого источника
+        self.lock_path = RATES_FILE + ".lock"
+        self.state_path = os.path.join(os.path.dirname(RATES_FILE), "refresh_state.json")
 
-    def run_update(self) -> None:
+    def run_update(self, clients: Optional[List[BaseApiClient]] = None, force: bool = True) -> None:
         """
         Основной метод: выполняет полный цикл обновления.
+
+        Обновление выполняет один процесс за раз (single-flight): остальные
+        процессы ждут его завершения на файловой блокировке и берут результат
+        из rates.json, опрашивая только источники, которые никто не опрашивал
+        последние REFRESH_SINGLE_FLIGHT_WINDOW секунд.
+
+        Args:
+            clients: опрашиваемые клиенты (по умолчанию — все). Пары остальных
+                источников переносятся из текущего снимка.
+            force: опрашивать источники, даже если другой процесс опросил их
+                только что (команда update). Фоновые обновления передают False.
         """
-        all_rates = []
+        targets = clients if clients is not None else self.clients
+        # Обновления из фонового планировщика и команды update не должны пересекаться
+        with self._lock:
+            with file_lock(self.lock_path, blocking=False) as acquired:
+                if acquired:
+                    self._run_locked(targets, waited=False, force=force)
+                    return
+
+            echo("Курсы обновляет другой процесс, ожидаю результат...")
+            with file_lock(self.lock_path, timeout=config.REFRESH_LOCK_TIMEOUT) as acquired:
+                if not acquired:
+                    echo(f"Другой процесс не завершил обновление за {config.REFRESH_LOCK_TIMEOUT} с")
+                    return
+                self._run_locked(targets, waited=True, force=force)
+
+    def _load_state(self) -> Dict[str, Any]:
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {"sources": {}}
+
+    def _run_locked(self, targets: List[BaseApiClient], waited: bool, force: bool) -> None:
+        """Обновление под межпроцессной блокировкой."""
+        # Снимок мог записать другой процесс — дальше работаем от его версии
+        er.reload()
+        state = self._load_state()
+        if waited or not force:
+            now = time.time()
+            recent = [
+                client for client in targets
+                if now - state["sources"].get(client.source, 0) < config.REFRESH_SINGLE_FLIGHT_WINDOW
+            ]
+            if recent:
+                echo(f"Уже обновлено другим процессом: {', '.join(client.source for client in recent)}")
+                targets = [client for client in targets if client not in recent]
+            if not targets:
+                return
+
+        try:
+            self._update(targets)
+        finally:
+            # Отмечаем и неудачные опросы: другие процессы не должны сразу повторять их
+            now = time.time()
+            for client in targets:
+                state["sources"][client.source] = now
+            try:
+                atomic_write_json(self.state_path, state, fsync=False)
+            except OSError as e:
+                echo(f"Не удалось сохранить {self.state_path}: {e}")
+
+    def _update(self, targets: List[BaseApiClient]) -> None:
+        """Опрос источников и запись истории и снимка."""
+        if config.CONCURRENT_FETCH and len(targets) > 1:
+            all_rates, unchanged, failed = self._fetch_concurrent(targets, config.REFRESH_DEADLINE)
+        else:
+            all_rates, unchanged, failed = self._fetch_sequential(targets)
+
+        polled = {client.source for client in targets}
+        stale_sources = self._stale_sources(polled, failed)
+        # Монета с символом фиатной валюты (например, из одного обновления с
+        # первым ответом фиатного источника) не затирает фиатный курс
+        all_rates = [
+            record for record in all_rates
+            if record['source'] == config.FIAT_SOURCE or record['from_currency'].upper() not in config.FIAT_CODES
+        ]
+
+        if all_rates:
+            append_exchange_rates(all_rates)
+            # Пары источников, ответивших 304, недоступных или не опрошенных сейчас,
+            # остаются в снимке как были
+            save_rates_as_pairs(all_rates, stale_sources=stale_sources)
+        elif unchanged:
+            # Ничего не изменилось: разбор, запись истории и снимка пропускаются,
+            # обновляется только отметка свежести
+            touch_last_refresh(stale_sources=stale_sources)
+        elif stale_sources != er.stale_sources:
+            # Ответа нет ни от кого: курсы остаются из последнего снимка
+            mark_stale_sources(stale_sources)
+
+    @staticmethod
+    def _stale_sources(polled: set, failed: List[BaseApiClient]) -> Dict[str, str]:
+        """
+        Недоступные источники после опроса: неудачные сейчас плюс ранее
+        недоступные, которые в этот раз не опрашивались.
+        """
+        now = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+        stale = {source: since for source, since in er.stale_sources.items() if source not in polled}
+        for client in failed:
+            stale[client.source] = (
+                er.stale_sources.get(client.source) or client.breaker.failing_since or now
+            )
+        return stale
+
+    def _fetch_sequential(
+        self,
+        clients: List[BaseApiClient]
+    ) -> Tuple[List[Dict[str, Any]], List[BaseApiClient], List[BaseApiClient]]:
+        """
+        Опрашивает клиентов по очереди.
 
+        Returns:
+            Полученные записи, клиенты, ответившие 304 Not Modified,
+            и клиенты, опрос которых не удался (или отключённые предохранителем).
+        """
+        all_rates = []
+        unchanged = []
+        failed = []
 
-        # Вызываем fetch_rates() у каждого клиента
-        for client in self.clients:
+        # Вызываем fetch() у каждого клиента (через его предохранитель)
+        for client in clients:
+            client.reset_cancel()
             try:
-                rates = client.fetch_rates()
+                rates = client.fetch()
                 all_rates += rates
-                
+
+            except RatesNotModified:
+                unchanged.append(client)
+            except BudgetExhaustedError as e:
+                # Бюджет запросов исчерпан: пары источника остаются из снимка
+                echo(e)
+            except CircuitOpenError as e:
+                echo(e)
+                failed.append(client)
             except Exception as e:
-                print(f"Клиент {client.source} упал, {e}")
-                
+                echo(f"Клиент {client.source} упал, {e}")
+                failed.append(client)
+
+        return all_rates, unchanged, failed
+
+    def _fetch_concurrent(
+        self,
+        clients: List[BaseApiClient],
+        deadline: Optional[float] = None
+    ) -> Tuple[List[Dict[str, Any]], List[BaseApiClient], List[BaseApiClient]]:
+        """
+        Опрашивает клиентов параллельно в пуле потоков.
+
+        Время обновления определяется самым медленным источником, а не суммой.
+        Клиенты, не уложившиеся в общий дедлайн, отменяются; объединяются
+        результаты тех, кто успел.
+
+        Args:
+            clients: список API‑клиентов.
+            deadline: общий дедлайн в секундах (None — без ограничения).
+
+        Returns:
+            Полученные записи, клиенты, ответившие 304 Not Modified,
+            и клиенты, опрос которых не удался или не уложился в дедлайн.
+        """
+        all_rates = []
+        unchanged = []
+        failed = []
+        started = time.monotonic()
+
+        executor = ThreadPoolExecutor(
+            max_workers=len(clients),
+            thread_name_prefix="rates-fetch"
+        )
+        futures = {}
+        for client in clients:
+            client.reset_cancel()
+            futures[submit(executor, client.fetch)] = client
+
+        try:
+            done, not_done = wait(futures, timeout=deadline)
+
+            # Отменяем опоздавших: их результаты будут отброшены
+            for future in not_done:
+                client = futures[future]
+                client.cancel()
+                future.cancel()
+                echo(f"Клиент {client.source} не уложился в дедлайн {deadline} с, результат отброшен")
+
+            # Объединяем результаты в порядке clients, чтобы слияние было детерминированным
+            for future, client in futures.items():
+                if future not in done:
+                    failed.append(client)
+                    continue
+                try:
+                    rates = future.result()
+                    all_rates += rates
+
+                except RatesNotModified:
+                    unchanged.append(client)
+                except BudgetExhaustedError as e:
+                    # Бюджет запросов исчерпан: пары источника остаются из снимка
+                    echo(e)
+                except CircuitOpenError as e:
+                    echo(e)
+                    failed.append(client)
+                except Exception as e:
+                    echo(f"Клиент {client.source} упал, {e}")
+                    failed.append(client)
+        finally:
+            # Не ждём зависшие запросы: они завершатся по REQUEST_TIMEOUT в фоне
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        elapsed_ms = int((time.monotonic() - started) * 1000)
+        echo(f"Опрос {len(clients)} источников занял {elapsed_ms} мс")
+        return all_rates, unchanged, failed
+
+def _file_stamp(path: str) -> Optional[Tuple[int, int, int]]:
+    """Отпечаток файла для проверки изменений: (mtime в нс, inode, размер)."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_ino, st.st_size
 
 
-        append_exchange_rates(all_rates)
-        save_rates_as_pairs(all_rates)
+def _snapshot_stamp() -> Tuple[Optional[Tuple[int, int, int]], Optional[Tuple[int, int, int]]]:
+    """Отпечатки rates.json и файла его служебных полей."""
+    return _file_stamp(RATES_FILE), _file_stamp(refresh_meta_path(RATES_FILE))
+
 
 class ExchangeRates:
+    """
+    Снимок курсов из rates.json (синглтон).
+
+    Снимок перечитывается, если файл заменил другой процесс: при обращении
+    к курсам проверяются mtime, inode и размер файла — не чаще раза в
+    RATES_RELOAD_MIN_INTERVAL секунд, а разбор JSON выполняется только
+    при изменении отпечатка. Отметка свежести и недоступные источники
+    берутся из rates.meta.json (его переписывает каждое обновление),
+    а если его нет или он старше снимка — из самого rates.json.
+    """
+
     _instance = None  # Для синглтон‑паттерна
 
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super().__new__(cls)
             # Инициализация при первом создании
+            cls._instance._reload_lock = threading.Lock()
+            cls._instance._stamp = _snapshot_stamp()
+            cls._instance._checked_at = time.monotonic()
             cls._instance._exchange_rate_default, cls._instance._last_refresh = load_rates_as_dict(RATES_FILE)
+            cls._instance.pair_sources, cls._instance.stale_sources = load_snapshot_meta(RATES_FILE)
+            cls._instance._apply_refresh_meta()
+            cls._instance._rate_matrix = None
         return cls._instance
 
+    def _apply_refresh_meta(self) -> None:
+        """Берёт last_refresh и stale_sources из служебного файла, если он не старше снимка."""
+        meta = load_refresh_meta(RATES_FILE)
+        if meta is not None and meta.get("last_refresh", "") >= (self._last_refresh or ""):
+            self._last_refresh = meta.get("last_refresh", "")
+            self.stale_sources = meta.get("stale_sources", {})
+
+    def reload(self) -> None:
+        """Перечитывает снимок курсов из rates.json (например, записанный другим процессом)."""
+        with self._reload_lock:
+            # Отпечаток берётся до чтения: замена файла во время чтения будет замечена следующей проверкой
+            self._stamp = _snapshot_stamp()
+            self._checked_at = time.monotonic()
+            loaded = load_rates_as_dict(RATES_FILE)
+            if loaded:
+                self._exchange_rate_default, self._last_refresh = loaded
+            self.pair_sources, self.stale_sources = load_snapshot_meta(RATES_FILE)
+            self._apply_refresh_meta()
+
+    def reload_if_changed(self) -> bool:
+        """
+        Перечитывает снимок, если rates.json изменился с прошлой проверки.
+        Сам файл проверяется не чаще раза в RATES_RELOAD_MIN_INTERVAL секунд.
+
+        Returns:
+            True, если снимок перечитан.
+        """
+        now = time.monotonic()
+        if now - self._checked_at < config.RATES_RELOAD_MIN_INTERVAL:
+            return False
+        self._checked_at = now
+        if _snapshot_stamp() == self._stamp:
+            return False
+        self.reload()
+        return True
+
+    def mark_written(self, path: str) -> None:
+        """Запоминает отпечаток файла, только что записанного этим процессом (перечитывать не нужно)."""
+        if os.path.abspath(path) in (os.path.abspath(RATES_FILE), os.path.abspath(refresh_meta_path(RATES_FILE))):
+            self._stamp = _snapshot_stamp()
+
+    def stale_source_for(self, code: str) -> Optional[str]:
+        """
+        Источник курса валюты, если он сейчас недоступен
+        (курс взят из последнего успешного снимка); иначе None.
+        """
+        self.reload_if_changed()
+        source = self.pair_sources.get(code)
+        return source if source in self.stale_sources else None
+
     @property
     def exchange_rate_default(self) -> dict:
         """Геттер для словаря курсов валют."""
+        self.reload_if_changed()
         return self._exchange_rate_default
 
     @exchange_rate_default.setter
@@ -249,11 +687,46 @@ class ExchangeRates:
             raise TypeError("exchange_rate_default должен быть словарем")
         self._exchange_rate_default = value
 
+    @property
+    def rate_matrix(self) -> RateMatrix:
+        """
+        Текущий снимок в виде вектора курсов по идентификаторам валют.
+        Пересобирается только при смене снимка: словарь курсов не меняется
+        на месте, а заменяется целиком.
+        """
+        rates = self.exchange_rate_default
+        matrix = self._rate_matrix
+        if matrix is None or matrix.source is not rates:
+            matrix = RateMatrix(rates, previous=matrix)
+            self._rate_matrix = matrix
+        return matrix
+
+    def cross_rate(self, from_code: str, to_code: str) -> float:
+        """Кросс‑курс from_code → to_code по текущему снимку."""
+        return self.rate_matrix.rate(from_code, to_code)
+
+    def convert_many(self, amounts, from_codes, to_code: str):
+        """Векторный перевод сумм в валюту to_code, см. RateMatrix.convert_many."""
+        return self.rate_matrix.convert_many(amounts, from_codes, to_code)
+
     @property
     def last_refresh(self) -> str:
         """Геттер для времени последнего обновления."""
+        self.reload_if_changed()
         return self._last_refresh
 
+    def age_seconds(self) -> float:
+        """Сколько секунд прошло с последнего обновления (inf, если данных нет)."""
+        self.reload_if_changed()
+        if not self._last_refresh:
+            return float("inf")
+        refreshed = datetime.fromisoformat(self._last_refresh.replace('Z', '+00:00'))
+        return (datetime.now(timezone.utc) - refreshed).total_seconds()
+
+    def is_stale(self, ttl: float = None) -> bool:
+        """Проверяет, что снимок старше ttl (по умолчанию config.CACHE_TTL)."""
+        return self.age_seconds() > (config.CACHE_TTL if ttl is None else ttl)
+
     @last_refresh.setter
     def last_refresh(self, value: str) -> None:
         """Сеттер для времени последнего обновления."""
@@ -261,5 +734,81 @@ class ExchangeRates:
             raise TypeError("last_refresh должен быть строкой в формате ISO 8601")
         self._last_refresh = value
 
+
+def _to_epoch(timestamp) -> float:
+    """Приводит метку времени (ISO‑строка, datetime или секунды Unix) к секундам Unix."""
+    if isinstance(timestamp, (int, float)):
+        return float(timestamp)
+    if isinstance(timestamp, datetime):
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+        return timestamp.timestamp()
+    if isinstance(timestamp, str):
+        value = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value.timestamp()
+    raise TypeError("timestamp должен быть строкой ISO 8601, datetime или числом")
+
+
+def _base_rates_as_of(code: str, epochs: List[float]) -> List[Optional[float]]:
+    """
+    Курсы code→BASE_CURRENCY на каждый момент из epochs: последнее наблюдение
+    не позже момента (бинарный поиск по индексу времени пары).
+    """
+    if code == config.BASE_CURRENCY:
+        return [1.0] * len(epochs)
+    pair = f"{code}_{config.BASE_CURRENCY}"
+    columns = columnar_history.open_pair(pair)
+    result = []
+    if columns is None:
+        result = [None] * len(epochs)
+    else:
+        with columns:
+            for epoch in epochs:
+                position = columns.position(epoch) - 1
+                result.append(columns.rates[position] if position >= 0 else None)
+
+    # Моменты старше сырой истории ищем в компактированных свечах — одним проходом
+    missing = [i for i, value in enumerate(result) if value is None]
+    if missing:
+        older = history_store.tier_values_as_of(pair, [epochs[i] for i in missing])
+        for i, value in zip(missing, older):
+            result[i] = value
+    return result
+
+
+def as_of_many(from_curr: str, to_curr: str, timestamps: List[Any]) -> List[Optional[float]]:
+    """
+    Курс from_curr→to_curr на несколько моментов времени.
+
+    Кросс‑курс считается так же, как в usecases.get_rate: через курсы
+    обеих валют к базовой. Каждая пара открывается один раз, поиск —
+    O(log n) на момент. Моменты за пределами сырой истории берутся из
+    часовых / дневных свечей после компакции.
+
+    Returns:
+        Курсы в порядке timestamps; None, если на момент нет наблюдений.
+    """
+    from_curr = from_curr.upper()
+    to_curr = to_curr.upper()
+    epochs = [_to_epoch(ts) for ts in timestamps]
+
+    # Дочитываем записи, добавленные в журнал другими процессами
+    columnar_history.sync_from_history()
+
+    from_rates = _base_rates_as_of(from_curr, epochs)
+    to_rates = _base_rates_as_of(to_curr, epochs)
+    return [
+        a / b if a is not None and b else None
+        for a, b in zip(from_rates, to_rates)
+    ]
+
+
+def as_of(from_curr: str, to_curr: str, timestamp: Any) -> Optional[float]:
+    """Курс from_curr→to_curr на момент timestamp (None, если данных нет)."""
+    return as_of_many(from_curr, to_curr, [timestamp])[0]
+
+
 er = ExchangeRates()
 rates_updates = RatesUpdater(clients_lst)
@@ -0,0 +1,159 @@
+import json
+import multiprocessing
+import os
+import threading
+import pytest
+from valutatrade_hub.core.exceptions import ConcurrentModificationError
+from valutatrade_hub.infra import journal as journal_module
+from valutatrade_hub.infra.journal import PortfolioJournal
+
+
+def make_journal(tmp_path, **kwargs) -> PortfolioJournal:
+    return PortfolioJournal(
+        str(tmp_path / "portfolios.json"),
+        str(tmp_path / "portfolios.journal.jsonl"),
+        str(tmp_path / "journal"),
+        **kwargs
+    )
+
+
+def entry(user_id: int, balance: float) -> dict:
+    return {"user_id": user_id, "balances": {"USD": balance}}
+
+
+def test_torn_last_line_is_dropped(tmp_path):
+    journal = make_journal(tmp_path)
+    journal.append([entry(1, 10.0)])
+    journal.append([entry(1, 20.0)])
+    # Сбой посреди записи: последняя строка без перевода строки
+    with open(journal.journal_file, 'ab') as f:
+        f.write(b'{"user_id": 1, "balances": {"USD": 99')
+
+    fresh = make_journal(tmp_path)
+    assert fresh.load(1) == ({"USD": 20.0}, 2)
+    with open(journal.journal_file, 'rb') as f:
+        assert f.read().endswith(b"}\n")
+
+    # Следующая запись ложится на целую строку и читается
+    fresh.append([entry(1, 30.0)], expected_versions={1: 2})
+    assert make_journal(tmp_path).load(1) == ({"USD": 30.0}, 3)
+
+
+def test_crash_between_snapshot_and_archive_does_not_double_count(tmp_path, monkeypatch):
+    journal = make_journal(tmp_path)
+    for balance in (1.0, 2.0, 3.0):
+        journal.append([entry(1, balance)])
+    journal.append([entry(2, 5.0)])
+
+    replace = os.replace
+
+    def crash(src, dst):
+        # Снимок записывается, перенос журнала в архив обрывается
+        if src == journal.journal_file:
+            raise OSError("сбой до переноса журнала в архив")
+        replace(src, dst)
+
+    monkeypatch.setattr(journal_module.os, "replace", crash)
+    with pytest.raises(OSError):
+        journal.snapshot()
+    monkeypatch.undo()
+
+    # Снимок записан, журнал остался на месте: версии не должны удвоиться
+    assert os.path.exists(journal.snapshot_file)
+    assert os.path.exists(journal.journal_file)
+    fresh = make_journal(tmp_path)
+    assert fresh.load(1) == ({"USD": 3.0}, 3)
+    assert fresh.load(2) == ({"USD": 5.0}, 1)
+
+    # Записи после сбоя применяются ровно один раз, и следующий снимок их сохраняет
+    fresh.append([entry(1, 4.0)], expected_versions={1: 3})
+    assert make_journal(tmp_path).load(1) == ({"USD": 4.0}, 4)
+    fresh.snapshot()
+    assert not os.path.exists(journal.journal_file)
+    assert make_journal(tmp_path).load(1) == ({"USD": 4.0}, 4)
+
+
+def test_legacy_list_snapshot_is_loaded(tmp_path):
+    journal = make_journal(tmp_path)
+    with open(journal.snapshot_file, 'w', encoding='utf-8') as f:
+        json.dump([{"user_id": 1, "version": 2, "wallets": {"USD": {"balance": 7.0}}}], f)
+    journal.append([entry(1, 8.0)])
+    assert make_journal(tmp_path).load(1) == ({"USD": 8.0}, 3)
+
+
+def test_concurrent_threads_share_group_commit(tmp_path):
+    journal = make_journal(tmp_path)
+    threads, per_thread = 8, 25
+
+    def worker(user_id):
+        for i in range(per_thread):
+            journal.append([entry(user_id, float(i))])
+
+    pool = [threading.Thread(target=worker, args=(user_id,)) for user_id in range(1, threads + 1)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+
+    fresh = make_journal(tmp_path)
+    for user_id in range(1, threads + 1):
+        assert fresh.load(user_id) == ({"USD": float(per_thread - 1)}, per_thread)
+
+
+def test_concurrent_versioned_appends_lose_no_updates(tmp_path):
+    journal = make_journal(tmp_path)
+    journal.append([entry(1, 0.0)])
+    threads, per_thread = 6, 10
+
+    def worker():
+        done = 0
+        while done < per_thread:
+            wallets, version = journal.load(1)
+            try:
+                journal.append([entry(1, wallets["USD"] + 1)], expected_versions={1: version})
+            except ConcurrentModificationError:
+                continue
+            done += 1
+
+    pool = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+
+    total = threads * per_thread
+    assert make_journal(tmp_path).load(1) == ({"USD": float(total)}, total + 1)
+
+
+def _append_from_process(directory: str, user_id: int, count: int) -> None:
+    journal = PortfolioJournal(
+        os.path.join(directory, "portfolios.json"),
+        os.path.join(directory, "portfolios.journal.jsonl"),
+        os.path.join(directory, "journal"),
+        snapshot_every=7
+    )
+    for i in range(count):
+        journal.append([entry(user_id, float(i))])
+
+
+def test_concurrent_processes_with_snapshots(tmp_path):
+    processes, per_process = 4, 20
+    context = multiprocessing.get_context("fork")
+    pool = [
+        context.Process(target=_append_from_process, args=(str(tmp_path), user_id, per_process))
+        for user_id in range(1, processes + 1)
+    ]
+    for process in pool:
+        process.start()
+    for process in pool:
+        process.join()
+        assert process.exitcode == 0
+
+    fresh = make_journal(tmp_path)
+    for user_id in range(1, processes + 1):
+        assert fresh.load(user_id) == ({"USD": float(per_process - 1)}, per_process)
+    # Все строки журнала целые
+    if os.path.exists(fresh.journal_file):
+        with open(fresh.journal_file, 'rb') as f:
+            for line in f:
+                json.loads(line)
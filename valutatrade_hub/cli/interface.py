@@ -1,7 +1,41 @@
 import re
+import signal
 from parse_service.updater import ExchangeRates, rates_updates
-from valutatrade_hub.core.usecases import register_user, login_user, show_portfolio, buy, sell, get_rate
+from parse_service.sheduler import refresh_scheduler
+from parse_service.config import config
+from valutatrade_hub.core.usecases import (
+    register_user, login_user, show_portfolio, buy, sell, get_rate, show_history,
+    compact_history, show_budget, run_orders_file
+)
 from constants import HELP_TEXT
+from valutatrade_hub.logging_config import setup_logging
+
+
+# Сеанс вошедшего пользователя — его сохраняет main при любом завершении
+_active = {"session": None}
+
+
+def close_session(session) -> None:
+    """Сохраняет несохранённые сделки сеанса перед выходом или logout."""
+    if session is None or not session.dirty:
+        return
+    try:
+        count = session.flush()
+        print(f"Сохранено сделок: {count}")
+    except Exception as e:
+        print(f"Не удалось сохранить сделки сеанса: {e}")
+
+
+def _terminate(signum, frame) -> None:
+    """SIGTERM / SIGHUP: завершаем цикл команд через SystemExit, сеанс сохранит finally."""
+    raise SystemExit(128 + signum)
+
+
+def _install_signal_handlers() -> None:
+    """Закрытие терминала или kill не должны терять несохранённые сделки сеанса."""
+    for name in ("SIGTERM", "SIGHUP"):
+        if hasattr(signal, name):
+            signal.signal(getattr(signal, name), _terminate)
 
 
 def parse_command(command: str):
@@ -14,6 +48,12 @@ def parse_command(command: str):
     amount_match = re.search(r'--amount\s+(\S+)', command)
     from_match = re.search(r'--from\s+(\S+)', command)
     to_match = re.search(r'--to\s+(\S+)', command)       
+    at_match = re.search(r'--at\s+(\S+)', command)
+    pair_match = re.search(r'--pair\s+(\S+)', command)
+    interval_match = re.search(r'--interval\s+(\S+)', command)
+    limit_match = re.search(r'--limit\s+(\S+)', command)
+    file_match = re.search(r'--file\s+(\S+)', command)
+    mode_match = re.search(r'--mode\s+(\S+)', command)
 
 
     if username_match:
@@ -30,6 +70,18 @@ def parse_command(command: str):
         args['from'] = from_match.group(1)
     if to_match:
         args['to'] = to_match.group(1)
+    if at_match:
+        args['at'] = at_match.group(1)
+    if pair_match:
+        args['pair'] = pair_match.group(1)
+    if interval_match:
+        args['interval'] = interval_match.group(1)
+    if limit_match:
+        args['limit'] = limit_match.group(1)
+    if file_match:
+        args['file'] = file_match.group(1)
+    if mode_match:
+        args['mode'] = mode_match.group(1)
 
     return args
 
@@ -42,11 +94,27 @@ def main():
 
     print(HELP_TEXT)
     
+    # Курсы обновляются в фоне, команды читают текущий снимок без сетевых запросов;
+    # сообщения фонового обновления пишутся в журнал, а не в консоль
+    setup_logging()
+    if config.SCHEDULER_ENABLED:
+        refresh_scheduler.start()
+    _install_signal_handlers()
+
+    try:
+        _command_loop()
+    finally:
+        # Любой выход (exit, конец ввода, Ctrl-C, SIGTERM) сохраняет сделки сеанса
+        close_session(_active["session"])
+
+
+def _command_loop() -> None:
+    """Цикл команд CLI до exit, конца ввода или Ctrl-C."""
     active_obj_user = None
-    active_obj_portfolio = None
+    active_session = None
     base_currency = None
     er = ExchangeRates()
-    
+
     while True:
         
         try:
@@ -76,38 +144,66 @@ def main():
                 if 'password' not in args:
                     print("Ошибка: не указан --password")
                     continue
-                active_obj_user, active_obj_portfolio = login_user(args['username'], args['password'])
+                close_session(active_session)
+                active_obj_user, active_session = login_user(args['username'], args['password'])
+                _active["session"] = active_session
                 base_currency = input("Введите базовую валюту для операций: ").strip().upper()
                 print(f"Установлена базовая валюта: {base_currency}")
                 
             elif command.startswith('show-portfolio'):
 
                 base = args.get('base', base_currency)  # по умолчанию USD
-                show_portfolio(active_obj_user, active_obj_portfolio, er, base)
+                portfolio = None
+                if active_session is not None:
+                    # Портфель сеанса; перечитывается, только если его изменил другой процесс
+                    active_session.refresh_if_changed()
+                    portfolio = active_session.portfolio
+                show_portfolio(active_obj_user, portfolio, er, base)
             
             elif command.startswith('buy'):
                 
                 amount = args.get('amount', None)
                 currency = args.get('currency', None)
-                portfolio = buy(active_obj_user, currency, amount, base_currency)
-                active_obj_portfolio = portfolio
+                buy(active_obj_user, currency, amount, base_currency, active_session)
                 
             elif command.startswith('sell'):
                 
                 amount = args.get('amount', None)
                 currency = args.get('currency', None)
-                portfolio = sell(active_obj_user, currency, amount, base_currency)               
-                active_obj_portfolio = portfolio
+                sell(active_obj_user, currency, amount, base_currency, active_session)
+                
+            elif command.startswith('orders'):
+                print(run_orders_file(
+                    active_obj_user,
+                    args.get('file', None),
+                    base_currency,
+                    args.get('mode', 'all'),
+                    active_session
+                ))
                 
             elif command.startswith('get-rate'):
                 
                 from_  = args.get('from', None)
                 to_ = args.get('to', None)
-                get_rate(from_, to_, er)
+                at = args.get('at', None)
+                message = get_rate(from_, to_, er, at)
+                if message:
+                    print(message)
+                
+            elif command.startswith('history'):
+                message = show_history(
+                    args.get('pair', None),
+                    args.get('interval', '1h'),
+                    args.get('limit', 24)
+                )
+                if message:
+                    print(message)
                 
             elif command.startswith('logout'):
+                close_session(active_session)
                 active_obj_user = None
-                active_obj_portfolio = None
+                active_session = None
+                _active["session"] = None
                 base_currency = None
                 
                 print("Сессия завершена")
@@ -115,13 +211,19 @@ def main():
             elif command.startswith('update'):
                 rates_updates.run_update()
                 
+            elif command.startswith('compact'):
+                print(compact_history())
+                
+            elif command.startswith('budget'):
+                show_budget()
+                
             elif command.startswith('help'):
                 print(HELP_TEXT)
             
             else:
                 print("Неизвестная команда. Для справки введите help")
 
-        except KeyboardInterrupt:
+        except (KeyboardInterrupt, EOFError):
             print("\nДо свидания!")
             break
         except Exception as e:
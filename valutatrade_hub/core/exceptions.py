@@ -30,3 +30,17 @@ class ApiRequestError(Exception):
         self.reason = reason
         super().__init__(f"Ошибка при обращении к внешнему API: {reason}")
 
+
+
+class ConcurrentModificationError(Exception):
+    """
+    Возникает, когда портфель изменён в хранилище другим процессом или сеансом
+    после того, как был загружен (версия в хранилище не совпала с ожидаемой).
+    """
+    def __init__(self, user_id: int, expected: int, actual: int):
+        self.user_id = user_id
+        self.expected = expected
+        self.actual = actual
+        super().__init__(
+            f"Портфель пользователя {user_id} изменён другим сеансом: ожидалась версия {expected}, в хранилище {actual}"
+        )
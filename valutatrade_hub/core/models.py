@@ -212,15 +212,16 @@ class Portfolio:
 
 
 
-    def __init__(self, user_id: int, wallets: Optional[Dict[str, Wallet]] = None):
+    def __init__(self, user_id: int, wallets: Optional[Dict[str, Wallet]] = None, version: int = 0):
         """
         Инициализация портфеля.
         :param user_id: уникальный ID пользователя
         :param wallets: словарь кошельков (по умолчанию пустой)
+        :param version: версия записи портфеля в хранилище (0 — ещё не сохранялся)
         """
         self._user_id = user_id
         self._wallets: Dict[str, Wallet] = wallets or {}
-        self.EXCHANGE_RATES = er.exchange_rate_default
+        self.version = version
         #{
      #           "USD_USD": 1.0,
      #           "EUR_USD": 1.1,    # 1 EUR = 1.1 USD
@@ -229,6 +230,11 @@ class Portfolio:
       #          "JPY_USD": 0.007
       #      }
 
+    @property
+    def EXCHANGE_RATES(self) -> Dict[str, float]:
+        """Актуальные курсы (снимок перечитывается, если rates.json изменился)."""
+        return er.exchange_rate_default
+
     @property
     def user(self) -> int:
         """Геттер для user_id (только чтение)."""
@@ -281,20 +287,15 @@ class Portfolio:
         """
         base_currency = base_currency.upper()
 
-        if base_currency not in self.EXCHANGE_RATES:
+        rates = er.rate_matrix
+        if base_currency not in rates:
             raise ValueError(f"Базовая валюта {base_currency} не поддерживается.")
 
-        total = 0.0
-        for currency, wallet in self._wallets.items():
-            if currency in self.EXCHANGE_RATES:
-                # Конвертация баланса в базовую валюту
-                rate_to_base = self.EXCHANGE_RATES[currency] / self.EXCHANGE_RATES[base_currency]
-                total += wallet.balance * rate_to_base
-            else:
-                # Валюта без курса — игнорируем (можно добавить логирование)
-                pass
-
-        return total
+        # Валюты без курса игнорируем (можно добавить логирование)
+        codes = [currency for currency in self._wallets if currency in rates]
+        balances = [self._wallets[currency].balance for currency in codes]
+        # Конвертация всех балансов в базовую валюту одной векторной операцией
+        return rates.total(balances, codes, base_currency)
 
     def to_dict(self) -> Dict:
         """
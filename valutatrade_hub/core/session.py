@@ -0,0 +1,136 @@
+from typing import Any, Dict, List, Optional
+from constants import SESSION_FLUSH_EVERY, SESSION_FLUSH_RETRIES
+from valutatrade_hub.core.exceptions import ConcurrentModificationError
+from valutatrade_hub.core.models import Portfolio, User
+from valutatrade_hub.infra.database import Storage, storage
+
+
+class Session:
+    """
+    Единица работы сеанса пользователя.
+
+    Держит загруженные User и Portfolio как единственный источник правды
+    между командами: сделки меняют кошельки в памяти, а сеанс запоминает
+    изменения балансов (дельты) и записи о сделках. flush сохраняет только
+    изменённые кошельки и накопленные сделки одной записью хранилища с
+    проверкой версии портфеля. Если портфель тем временем изменил другой
+    процесс, дельты переносятся на свежую версию и запись повторяется.
+    """
+
+    def __init__(self, user: User, store: Optional[Storage] = None, flush_every: int = SESSION_FLUSH_EVERY):
+        """
+        Args:
+            user: вошедший пользователь.
+            store: хранилище (по умолчанию общее для приложения).
+            flush_every: сохранять после стольких сделок (0 — только явным flush).
+        """
+        self.user = user
+        self.store = store or storage
+        self.flush_every = flush_every
+        self.portfolio: Optional[Portfolio] = self.store.load_portfolio(user.user_id)
+        self._deltas: Dict[str, float] = {}
+        self._trades: List[Dict[str, Any]] = []
+
+    @property
+    def dirty(self) -> bool:
+        """Есть несохранённые изменения."""
+        return bool(self._trades or self._deltas)
+
+    @property
+    def pending(self) -> int:
+        """Число несохранённых сделок."""
+        return len(self._trades)
+
+    def record_trade(self, trade: Dict[str, Any], deltas: Dict[str, float]) -> None:
+        """
+        Регистрирует сделку, уже применённую к self.portfolio.
+
+        Args:
+            trade: запись о сделке (side, currency, amount, base_currency, rate, cost, timestamp).
+            deltas: изменения балансов {код валюты: +/- сумма}.
+        """
+        self.record_trades([trade], deltas)
+        if self.flush_every and len(self._trades) >= self.flush_every:
+            self.flush()
+
+    def record_trades(self, trades: List[Dict[str, Any]], deltas: Dict[str, float]) -> None:
+        """
+        Регистрирует пакет сделок с суммарными изменениями балансов, уже
+        применёнными к self.portfolio. Автосохранения нет — пакет сохраняет flush.
+        """
+        for code, delta in deltas.items():
+            self._deltas[code] = self._deltas.get(code, 0.0) + delta
+        self._trades.extend(trades)
+
+    def refresh_if_changed(self) -> bool:
+        """
+        Перечитывает портфель, если версия в хранилище сменилась. Пока есть
+        несохранённые изменения, портфель не перечитывается — расхождение
+        разрешит flush.
+
+        Returns:
+            True, если портфель перечитан.
+        """
+        if self.dirty:
+            return False
+        version = self.store.portfolio_version(self.user.user_id)
+        if self.portfolio is not None and version == self.portfolio.version:
+            return False
+        self.portfolio = self.store.load_portfolio(self.user.user_id)
+        return True
+
+    def _rebase(self) -> None:
+        """Переносит несохранённые дельты на свежую версию портфеля из хранилища."""
+        fresh = self.store.load_portfolio(self.user.user_id) or Portfolio(self.user.user_id)
+        for code, delta in self._deltas.items():
+            wallet = fresh.get_wallet(code)
+            if wallet is None:
+                fresh.add_currency(code)
+                wallet = fresh.get_wallet(code)
+            balance = wallet.balance + delta
+            if balance < 0:
+                # Сделки сеанса несовместимы с новым состоянием: отбрасываем их
+                count = len(self._trades)
+                self.discard(fresh)
+                raise ValueError(
+                    f"Портфель изменён другим сеансом, несохранённые сделки ({count}) "
+                    f"отменены: не хватает {code} ({wallet.balance} + {delta} < 0)"
+                )
+            wallet.balance = balance
+        self.portfolio = fresh
+
+    def discard(self, portfolio: Optional[Portfolio] = None) -> None:
+        """Отбрасывает несохранённые изменения и перечитывает портфель (или берёт переданный)."""
+        self._deltas.clear()
+        self._trades.clear()
+        self.portfolio = portfolio or self.store.load_portfolio(self.user.user_id)
+
+    def flush(self) -> int:
+        """
+        Сохраняет изменённые кошельки и накопленные сделки одной записью.
+
+        Returns:
+            Число сохранённых сделок.
+
+        Raises:
+            ConcurrentModificationError: конфликт версий не разрешился за SESSION_FLUSH_RETRIES попыток.
+            ValueError: после переноса на свежую версию баланс стал бы отрицательным.
+        """
+        if not self.dirty:
+            return 0
+        for attempt in range(SESSION_FLUSH_RETRIES + 1):
+            balances = {code: self.portfolio.get_wallet(code).balance for code in self._deltas}
+            try:
+                self.portfolio.version = self.store.save_wallets(
+                    self.user.user_id, balances, self._trades, expected_version=self.portfolio.version
+                )
+            except ConcurrentModificationError:
+                if attempt == SESSION_FLUSH_RETRIES:
+                    raise
+                self._rebase()
+                continue
+            count = len(self._trades)
+            self._deltas.clear()
+            self._trades = []
+            return count
+        return 0
@@ -1,23 +1,26 @@
 import hashlib
-from datetime import datetime, timezone
-from typing import Dict
+import json
+import time
+from datetime import datetime
+from typing import Any, Dict, List
 from valutatrade_hub.core.exceptions import InsufficientFundsError
-from constants import PORTFOLIOS_FILE
 from parse_service.config import config
 from valutatrade_hub.core.models import User, Portfolio, Wallet
-from parse_service.updater import rates_updates
-from valutatrade_hub.core.utils import save_users, load_portfolios, save_portfolios, generate_salt
+from valutatrade_hub.core.session import Session
+from parse_service.sheduler import refresh_scheduler
+from parse_service.updater import as_of, er
+from parse_service.rollups import history_candles
+from parse_service.compaction import compactor
+from parse_service.budget import request_budget
+from valutatrade_hub.core.utils import generate_salt
+from valutatrade_hub.infra.database import storage
 
 
 
 def register_user(username: str, password: str):
     """Регистрирует нового пользователя."""
-    # Шаг 1: Загружаем существующих пользователей
-    users = User.load_users()
-
-
     # Проверяем уникальность username
-    if any(user.username == username for user in users.values()):
+    if storage.find_user(username) is not None:
         raise ValueError(f"Имя пользователя '{username}' уже занято")
         
 
@@ -26,31 +29,16 @@ def register_user(username: str, password: str):
         raise ValueError("Пароль должен быть не короче 4 символов")
 
 
-    # Генерируем user_id (автоинкремент)
-    user_id = max(users.keys()) + 1 if users else 1
-
     # Генерируем соль и хешируем пароль
     salt = generate_salt()
     password_salt = password + salt
     hashed_password = hashlib.sha256(password_salt.encode()).hexdigest()
 
-    # Создаём объект User
-    user = User(
-        user_id=user_id,
-        username=username,
-        hashed_password=hashed_password,
-        salt=salt,
-        registration_date=datetime.now()
-    )
-
-
-    users[user_id] = user
-
-    # Сохраняем пользователей
-    save_users(users)
+    # Создаём пользователя, user_id выдаёт хранилище (автоинкремент)
+    user = storage.create_user(username, hashed_password, salt, datetime.now())
+    user_id = user.user_id
 
     # Cоздаём пустой портфель
-    portfolios = load_portfolios()
     currency = input("Введите валюту: ").strip().upper()
     amount = input("Введите баланс: ")
     
@@ -67,8 +55,7 @@ def register_user(username: str, password: str):
     wallet_new_user = Wallet(currency, value)
     
     user_portfolio = Portfolio(user_id, {"USD":  wallet_new_user})
-    portfolios.append(user_portfolio.to_dict())
-    save_portfolios(portfolios)
+    storage.save_portfolio(user_portfolio)
 
     # Выводим сообщение об успехе
     print(f"Пользователь '{username}' зарегистрирован (id={user_id}). Войдите: login --username {username} --password ****")
@@ -77,31 +64,21 @@ def register_user(username: str, password: str):
     
 def login_user(username: str, password: str):
     """Выполняет вход пользователя в систему."""
-    users = User.load_users()
-    portfolios = Portfolio.load_from_file(PORTFOLIOS_FILE)
-    
     # Найти пользователя по username
-    user = None
-    for u in users.values():
-        if u.username == username:
-            user = u
-            break
+    user = storage.find_user(username)
     
     if not user:
         raise ValueError(f"Пользователь '{username}' не найден")
         
         
-    for i, p in enumerate(portfolios):
-        if p.user == user.user_id:
-            portfolio = p    
-    
-    
     # Сравнить хеш пароля
     if user.verify_password(password):
         print(f"Вы вошли как '{username}'")
     else:
         raise ValueError("Неверный пароль")
-    return user, portfolio
+
+    # Портфель загружается один раз и дальше живёт в сеансе
+    return user, Session(user)
         
         
 def show_portfolio(user: User, portfolio: Portfolio, er: Dict, base_currency: str):
@@ -129,9 +106,11 @@ def show_portfolio(user: User, portfolio: Portfolio, er: Dict, base_currency: st
     print(f"\nПортфель пользователя '{user.username}' (база: {base_currency}):")
     
 
-    for code, wallet in  portfolio.wallets.items():
-        rate = er.exchange_rate_default[code] / er.exchange_rate_default[base_currency]
-        print(f"- {code}: {wallet.balance} -> {rate*wallet.balance} {base_currency}")
+    codes = list(portfolio.wallets)
+    balances = [portfolio.wallets[code].balance for code in codes]
+    converted = er.convert_many(balances, codes, base_currency)
+    for code, balance, value in zip(codes, balances, converted):
+        print(f"- {code}: {balance} -> {float(value)} {base_currency}")
 
     total_in_base = portfolio.get_total_value(base_currency)
 
@@ -141,7 +120,49 @@ def show_portfolio(user: User, portfolio: Portfolio, er: Dict, base_currency: st
     print(f"ИТОГО: {total_in_base:.2f} {base_currency}\n")
     
     
-def buy(user: User, currency: str, amount: float, base_currency: str = "USD"):
+def _record_trade(
+    session: Session,
+    side: str,
+    currency: str,
+    amount: float,
+    base_currency: str,
+    rate: float,
+    cost: float
+) -> None:
+    """Регистрирует сделку в сеансе: изменённые кошельки и запись сохранит flush."""
+    sign = 1 if side == "buy" else -1
+    # Дельты складываются: при совпадении кодов ключ не должен затирать другой
+    deltas = {currency: sign * amount}
+    deltas[base_currency] = deltas.get(base_currency, 0.0) - sign * cost
+    session.record_trade(
+        {
+            "side": side,
+            "currency": currency,
+            "amount": amount,
+            "base_currency": base_currency,
+            "rate": rate,
+            "cost": cost,
+            "timestamp": datetime.now().isoformat()
+        },
+        deltas
+    )
+    if session.pending:
+        every = f"каждые {session.flush_every} сделок, " if session.flush_every else ""
+        print(
+            f"Сделка ещё не сохранена (ожидают сохранения: {session.pending}); "
+            f"сохранение — {every}при logout, exit и завершении программы"
+        )
+
+
+def _session_for(user: User, session: Session = None) -> Session:
+    """Сеанс команды: переданный (с проверкой версии портфеля) или разовый."""
+    if session is None:
+        return Session(user, flush_every=1)
+    session.refresh_if_changed()
+    return session
+
+
+def buy(user: User, currency: str, amount: float, base_currency: str = "USD", session: Session = None):
     
     """
      Команда покупки валюты.
@@ -150,27 +171,29 @@ def buy(user: User, currency: str, amount: float, base_currency: str = "USD"):
     - currency: код валюты (например, 'BTC')
     - amount: количество валюты для покупки (должно быть > 0)
     - base_currency: базовая валюта для расчёта стоимости (по умолчанию USD)
-    
+    - session: сеанс пользователя; без него портфель загружается и сохраняется сразу
+
     return: строка с результатом выполнения команды
     """
     if not user:
         return "Пожалуйста, авторизуйтесь."
 
-    index = None
-    portfolios = Portfolio.load_from_file(PORTFOLIOS_FILE)
-    for i, p in enumerate(portfolios):
-        if p.user == user.user_id:
-            index = i
-            portfolio = p            
+    # Работаем по текущему снимку; устаревший обновляется в фоне
+    refresh_scheduler.revalidate_if_stale()
+
+    session = _session_for(user, session)
+    portfolio = session.portfolio
 
     if portfolio is None:
-        raise "Портфель пуст"
+        raise ValueError(f"Портфель пользователя '{user.username}' пуст")
 
     # Валидировать аргументы
     if not isinstance(currency, str) or not currency.strip():
         raise ValueError("Ошибка: код валюты не может быть пустым.")
     
     currency = currency.strip().upper()
+    if currency == base_currency:
+        raise ValueError("Ошибка: валюта сделки совпадает с базовой.")
     amount = float(amount)
     
     if not isinstance(amount, (int, float)):
@@ -197,7 +220,7 @@ def buy(user: User, currency: str, amount: float, base_currency: str = "USD"):
     if base_currency not in portfolio.EXCHANGE_RATES:
         raise KeyError(f"Базовая валюта {base_currency} не поддерживается.")
         
-    rate = portfolio.EXCHANGE_RATES[currency] / portfolio.EXCHANGE_RATES[base_currency]
+    rate = er.cross_rate(currency, base_currency)
     cost = amount * rate
     current_balance =  wallet_base_currency.balance
     if current_balance < cost:
@@ -220,14 +243,13 @@ def buy(user: User, currency: str, amount: float, base_currency: str = "USD"):
     except ValueError as e:
         return f"Ошибка при обновлении баланса: {str(e)}"
     
-    portfolios[index] = portfolio.to_dict()
-    portfolios_as_dicts = [p.to_dict() if isinstance(p, Portfolio) else p for p in portfolios]
-    save_portfolios(portfolios_as_dicts)
+    # Два изменённых кошелька и запись о сделке сохранит сеанс
+    _record_trade(session, "buy", currency, amount, base_currency, rate, cost)
     
     return portfolio
 
     
-def sell(user: User, currency: str, amount: float, base_currency: str = "USD"):
+def sell(user: User, currency: str, amount: float, base_currency: str = "USD", session: Session = None):
     
     """
      Команда продажи валюты.
@@ -236,28 +258,28 @@ def sell(user: User, currency: str, amount: float, base_currency: str = "USD"):
     :param currency: код валюты (например, 'BTC')
     :param amount: количество валюты для покупки (должно быть > 0)
     :param base_currency: базовая валюта для расчёта стоимости (по умолчанию USD)
+    :param session: сеанс пользователя; без него портфель загружается и сохраняется сразу
     :return: строка с результатом выполнения команды
     """
     if not user:
         return "Пожалуйста, авторизуйтесь."
 
-    index = None
-    portfolios = Portfolio.load_from_file(PORTFOLIOS_FILE)
-    for i, p in enumerate(portfolios):
-        if p.user == user.user_id:
-            index = i
-            portfolio = p  
-
+    # Работаем по текущему снимку; устаревший обновляется в фоне
+    refresh_scheduler.revalidate_if_stale()
 
+    session = _session_for(user, session)
+    portfolio = session.portfolio
 
     if portfolio is None:
-        raise "Портфель пуст"
+        raise ValueError(f"Портфель пользователя '{user.username}' пуст")
 
     # Валидировать аргументы
     if not isinstance(currency, str) or not currency.strip():
         raise ValueError("Ошибка: код валюты не может быть пустым.")
     
     currency = currency.strip().upper()
+    if currency == base_currency:
+        raise ValueError("Ошибка: валюта сделки совпадает с базовой.")
     amount = float(amount)
     
     if not isinstance(amount, (int, float)):
@@ -284,7 +306,7 @@ def sell(user: User, currency: str, amount: float, base_currency: str = "USD"):
     if base_currency not in portfolio.EXCHANGE_RATES:
         raise KeyError(f"Базовая валюта {base_currency} не поддерживается.")
         
-    rate = portfolio.EXCHANGE_RATES[currency] / portfolio.EXCHANGE_RATES[base_currency]
+    rate = er.cross_rate(currency, base_currency)
     cost = amount * rate
 
     
@@ -309,17 +331,186 @@ def sell(user: User, currency: str, amount: float, base_currency: str = "USD"):
     except ValueError as e:
         return f"Ошибка при обновлении баланса: {str(e)}"
     
-    portfolios[index] = portfolio.to_dict()
-    portfolios_as_dicts = [p.to_dict() if isinstance(p, Portfolio) else p for p in portfolios]
-    save_portfolios(portfolios_as_dicts)
+    # Два изменённых кошелька и запись о сделке сохранит сеанс
+    _record_trade(session, "sell", currency, amount, base_currency, rate, cost)
 
     return portfolio
     
     
-def get_rate(from_curr, to_curr, er) -> str:
+def load_orders(path: str) -> List[Dict[str, Any]]:
+    """
+    Читает ордера из JSONL‑файла: по одному объекту на строку,
+    {"side": "buy"|"sell", "currency": ..., "amount": ..., "base_currency"?: ...}.
+    """
+    orders = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                orders.append(json.loads(line))
+            except json.JSONDecodeError:
+                raise ValueError(f"{path}, строка {number}: некорректный JSON")
+    return orders
+
+
+def execute_orders(
+    user: User,
+    orders: List[Dict[str, Any]],
+    base_currency: str = "USD",
+    mode: str = "all",
+    session: Session = None
+) -> Dict[str, Any]:
+    """
+    Исполняет пакет ордеров buy/sell за один цикл: портфель загружается
+    один раз, все ордера считаются по одному снимку курсов, проверяются и
+    применяются к балансам в памяти, а результат сохраняется одной записью
+    хранилища (изменённые кошельки и все сделки).
+
+    Args:
+        user: пользователь.
+        orders: ордера {"side", "currency", "amount", "base_currency"?}.
+        base_currency: базовая валюта ордеров без base_currency.
+        mode: "all" — всё или ничего (первая ошибка отменяет пакет),
+            "best-effort" — ошибочные ордера пропускаются.
+        session: сеанс пользователя; без него создаётся разовый.
+
+    Returns:
+        {"executed": число исполненных, "failed": [{"order": номер с 1, "error": текст}],
+         "elapsed_ms": время исполнения и сохранения}.
+    """
+    if not user:
+        raise ValueError("Пожалуйста, авторизуйтесь.")
+    if mode not in ("all", "best-effort"):
+        raise ValueError(f"Неизвестный режим '{mode}': используйте all или best-effort")
+
+    started = time.perf_counter()
+    refresh_scheduler.revalidate_if_stale()
+    session = _session_for(user, session)
+    portfolio = session.portfolio
+    if portfolio is None:
+        raise ValueError(f"Портфель пользователя '{user.username}' пуст")
+
+    # Один снимок курсов на весь пакет
+    rates = er.rate_matrix
+    cross: Dict[tuple, float] = {}
+    balances = {code: wallet.balance for code, wallet in portfolio.wallets.items()}
+    deltas: Dict[str, float] = {}
+    trades: List[Dict[str, Any]] = []
+    failed: List[Dict[str, Any]] = []
+    timestamp = datetime.now().isoformat()
+    default_base = base_currency.upper()
+
+    for number, order in enumerate(orders, 1):
+        try:
+            side = str(order.get("side", "")).lower()
+            if side not in ("buy", "sell"):
+                raise ValueError(f"неизвестная операция '{order.get('side')}'")
+            currency = str(order.get("currency") or "").strip().upper()
+            if not currency:
+                raise ValueError("код валюты не может быть пустым.")
+            base = str(order.get("base_currency") or default_base).strip().upper()
+            try:
+                amount = float(order.get("amount"))
+            except (TypeError, ValueError):
+                raise ValueError("'amount' должен быть числом.")
+            if not amount > 0:
+                raise ValueError("'amount' должен быть положительным числом.")
+            if currency == base:
+                raise ValueError("валюта ордера совпадает с базовой.")
+
+            pair = (currency, base)
+            rate = cross.get(pair)
+            if rate is None:
+                if currency not in rates:
+                    raise KeyError(f"Курс для {currency} не найден.")
+                if base not in rates:
+                    raise KeyError(f"Базовая валюта {base} не поддерживается.")
+                rate = cross[pair] = rates.rate(currency, base)
+            cost = amount * rate
+
+            if side == "buy":
+                spent, spent_amount, got, got_amount = base, cost, currency, amount
+            else:
+                spent, spent_amount, got, got_amount = currency, amount, base, cost
+            available = balances.get(spent, 0.0)
+            if available < spent_amount:
+                raise InsufficientFundsError(available=available, required=spent_amount, code=spent)
+        except (ValueError, KeyError, InsufficientFundsError) as e:
+            failed.append({"order": number, "error": str(e).strip("'\"")})
+            if mode == "all":
+                break
+            continue
+
+        balances[spent] = available - spent_amount
+        balances[got] = balances.get(got, 0.0) + got_amount
+        deltas[spent] = deltas.get(spent, 0.0) - spent_amount
+        deltas[got] = deltas.get(got, 0.0) + got_amount
+        trades.append({
+            "side": side,
+            "currency": currency,
+            "amount": amount,
+            "base_currency": base,
+            "rate": rate,
+            "cost": cost,
+            "timestamp": timestamp
+        })
+
+    if mode == "all" and failed:
+        # Всё или ничего: портфель не тронут
+        trades = []
+    if trades:
+        for code in deltas:
+            if portfolio.get_wallet(code) is None:
+                portfolio.add_currency(code)
+            portfolio.get_wallet(code).balance = balances[code]
+        session.record_trades(trades, deltas)
+        session.flush()
+
+    return {
+        "executed": len(trades),
+        "failed": failed,
+        "elapsed_ms": (time.perf_counter() - started) * 1000
+    }
+
+
+def run_orders_file(user: User, path: str, base_currency: str = "USD", mode: str = "all", session: Session = None) -> str:
+    """
+    Обрабатывает команду orders: исполняет ордера из JSONL‑файла и
+    возвращает сводку.
+    """
+    if not user:
+        return "Пожалуйста, авторизуйтесь."
+    if not path:
+        return "Ошибка: не указан --file"
+    try:
+        orders = load_orders(path)
+    except FileNotFoundError:
+        return f"Ошибка: файл '{path}' не найден"
+    except ValueError as e:
+        return f"Ошибка: {e}"
+    if not orders:
+        return f"В файле '{path}' нет ордеров"
+
+    result = execute_orders(user, orders, base_currency or "USD", mode, session)
+    lines = [f"ордер {item['order']}: {item['error']}" for item in result["failed"][:10]]
+    if len(result["failed"]) > 10:
+        lines.append(f"... ещё ошибок: {len(result['failed']) - 10}")
+    if mode == "all" and result["failed"]:
+        lines.append(f"Пакет отменён целиком: ордеров {len(orders)}, ни один не исполнен")
+    else:
+        lines.append(
+            f"Исполнено ордеров: {result['executed']} из {len(orders)} "
+            f"за {result['elapsed_ms']:.1f} мс"
+        )
+    return "\n".join(lines)
+
+
+def get_rate(from_curr, to_curr, er, at: str = None) -> str:
     """
     Обрабатывает команду get-rate.
     args — список аргументов после имени команды (например, ["--from", "USD", "--to", "BTC"]).
+    at — момент времени ISO 8601 для исторического курса (например, 2026-09-01T12:00Z).
     """
 
     # Bалидация кодов валют
@@ -331,23 +522,102 @@ def get_rate(from_curr, to_curr, er) -> str:
     from_curr = from_curr.upper()
     to_curr = to_curr.upper()
 
-    rate = er.exchange_rate_default[from_curr]/er.exchange_rate_default[to_curr]
+    if at:
+        try:
+            rate = as_of(from_curr, to_curr, at)
+        except ValueError:
+            return f"Ошибка: некорректная метка времени '{at}'."
+        if rate is None:
+            print(f"Нет данных о курсе {from_curr}→{to_curr} на {at}")
+            return
+        reverse_rate = 1 / rate if rate != 0 else 0
+        print(
+                f"Курс {from_curr}→{to_curr} на {at}: {rate}\n"
+                f"Обратный курс {to_curr}→{from_curr}: {reverse_rate}"
+            )
+        return
+
+    rate = er.cross_rate(from_curr, to_curr)
 
     reverse_rate = 1 / rate if rate != 0 else 0
     
-    last_refresh_seconds_ago = (datetime.now(timezone.utc)-datetime.fromisoformat(er._last_refresh.replace('Z', '+00:00'))).total_seconds()
     print(
             f"Курс {from_curr}→{to_curr}: {rate} (обновлено: {er._last_refresh})\n"
             f"Обратный курс {to_curr}→{from_curr}: {reverse_rate}"
         )
-    if last_refresh_seconds_ago >  config.CACHE_TTL:
-        print("Данные устарели. Запускаю процесс обновления")
-        rates_updates.run_update()
-        rate = er.exchange_rate_default[from_curr]/er.exchange_rate_default[to_curr]
-        reverse_rate = 1 / rate if rate != 0 else 0  
+    for code in (from_curr, to_curr):
+        source = er.stale_source_for(code)
+        if source:
+            print(
+                f"Внимание: источник {source} недоступен с {er.stale_sources[source]}, "
+                f"курс {code} — из последнего успешного обновления"
+            )
+    if er.age_seconds() >  config.CACHE_TTL:
+        # Отвечаем по текущему снимку, обновление идёт в фоне
+        if refresh_scheduler.request_revalidation():
+            print("Данные устарели. Обновление запущено в фоне")
+        else:
+            print("Данные устарели. Обновление уже выполняется")
+
+
+def show_history(pair: str, interval: str = "1h", limit: int = 24) -> str:
+    """
+    Обрабатывает команду history: свечи OHLC пары за последние limit интервалов.
+    """
+    if not pair:
+        return "Ошибка: не указан --pair"
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return "Ошибка: --limit должен быть целым числом."
+    if limit <= 0:
+        return "Ошибка: --limit должен быть положительным числом."
+
+    try:
+        rows = history_candles(pair, interval)
+    except ValueError as e:
+        return f"Ошибка: {e}"
+
+    if not rows:
+        return f"Нет истории курса для {pair.upper()}"
+
+    print(f"\nИстория {pair.upper()} (интервал {interval}):")
+    print(f"{'начало':<21}{'open':>14}{'high':>14}{'low':>14}{'close':>14}{'mean':>14}{'n':>6}")
+    for row in rows[-limit:]:
+        # В дельта‑режиме среднее интервала с изменениями курса не определено
+        mean = f"{row['mean']:>14.6g}" if row['mean'] is not None else f"{'—':>14}"
         print(
-                f"Курс {from_curr}→{to_curr}: {rate} (обновлено: {er._last_refresh})\n"
-                f"Обратный курс {to_curr}→{from_curr}: {reverse_rate}"
-        
+            f"{row['start']:<21}{row['open']:>14.6g}{row['high']:>14.6g}{row['low']:>14.6g}"
+            f"{row['close']:>14.6g}{mean}{row['count']:>6}"
         )
 
+
+def compact_history() -> str:
+    """
+    Обрабатывает команду compact: сворачивает старую историю курсов в часовые
+    и дневные свечи согласно срокам хранения.
+    """
+    summary = compactor.run()
+    if not any(summary.values()):
+        return "Компакция не требуется: вся история в пределах сроков хранения"
+    return (
+        f"Компакция завершена: дней в часовые свечи — {summary['raw_days']}, "
+        f"в дневные — {summary['hourly_days']}, удалено строк из колонок — {summary['dropped_rows']}, "
+        f"убрано файлов — {summary['removed_files']}"
+    )
+
+
+def show_budget() -> None:
+    """
+    Обрабатывает команду budget: остаток бюджета запросов к внешним API
+    (общего для всех процессов).
+    """
+    if not config.API_BUDGET_ENABLED:
+        print("Бюджет запросов к API отключён (API_BUDGET_ENABLED = False)")
+        return
+    print(f"\n{'источник':<20}{'осталось':>10}{'ёмкость':>10}{'период, с':>12}{'след. токен, с':>16}")
+    for source, info in request_budget.status().items():
+        print(
+            f"{source:<20}{int(info['remaining']):>10}{info['capacity']:>10}"
+            f"{info['period']:>12.0f}{info['retry_in']:>16.0f}"
+        )
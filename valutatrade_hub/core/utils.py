@@ -27,6 +27,10 @@ def load_portfolios() -> list:
     with open(PORTFOLIOS_FILE, "r", encoding="utf-8") as f:
         data = json.load(f)
 
+    # Снимок журнала портфелей: {"journal": ..., "portfolios": [...]}
+    if isinstance(data, dict) and "portfolios" in data:
+        data = data["portfolios"]
+
     # Проверяем, что загруженные данные — это список
     if not isinstance(data, list):
         raise ValueError(f"Ожидался список в {PORTFOLIOS_FILE}, но получен {type(data)}")
@@ -0,0 +1,493 @@
+import argparse
+import json
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from constants import (
+    DATABASE_FILE, DATABASE_FILE_ENV, PORTFOLIOS_FILE, PORTFOLIOS_JOURNAL_FILE, STORAGE_BACKEND,
+    STORAGE_BACKEND_ENV, USERS_FILE
+)
+from valutatrade_hub.core.exceptions import ConcurrentModificationError
+from valutatrade_hub.core.models import Portfolio, User, Wallet
+from valutatrade_hub.infra.journal import PortfolioJournal, portfolio_journal
+from valutatrade_hub.infra.settings import SettingsLoader
+from valutatrade_hub.infra.shards import ShardedPortfolioStore, portfolio_shards
+from valutatrade_hub.infra.user_directory import UserDirectory, user_directory
+
+
+class Storage(ABC):
+    """
+    Хранилище пользователей, кошельков и сделок.
+
+    Usecases работают только через этот интерфейс и затрагивают записи
+    одного пользователя; конкретный формат хранения выбирается в create_storage.
+    Реализация, в которой не хватает методов, не создаётся (TypeError).
+    """
+
+    @abstractmethod
+    def find_user(self, username: str) -> Optional[User]:
+        """Пользователь по имени или None."""
+
+    @abstractmethod
+    def get_user(self, user_id: int) -> Optional[User]:
+        """Пользователь по id или None."""
+
+    @abstractmethod
+    def create_user(self, username: str, hashed_password: str, salt: str, registration_date: datetime) -> User:
+        """
+        Создаёт пользователя со следующим свободным id.
+
+        Raises:
+            ValueError: имя уже занято.
+        """
+
+    @abstractmethod
+    def load_portfolio(self, user_id: int) -> Optional[Portfolio]:
+        """Портфель пользователя (с версией записи) или None, если его нет."""
+
+    @abstractmethod
+    def portfolio_version(self, user_id: int) -> int:
+        """Текущая версия портфеля в хранилище (0 — портфеля нет)."""
+
+    @abstractmethod
+    def save_portfolio(self, portfolio: Portfolio) -> None:
+        """Сохраняет портфель целиком (набор кошельков заменяется) и обновляет portfolio.version."""
+
+    @abstractmethod
+    def save_wallets(
+        self,
+        user_id: int,
+        balances: Dict[str, float],
+        trades: Optional[List[Dict[str, Any]]] = None,
+        expected_version: Optional[int] = None
+    ) -> int:
+        """
+        Сохраняет балансы изменённых кошельков и записи о сделках одной транзакцией.
+
+        Args:
+            balances: {код валюты: новый баланс}.
+            trades: сделки (side, currency, amount, base_currency, rate, cost, timestamp).
+            expected_version: сохранить, только если версия портфеля в хранилище совпадает.
+
+        Returns:
+            Новая версия портфеля.
+
+        Raises:
+            ConcurrentModificationError: портфель изменён после загрузки.
+        """
+
+    def close(self) -> None:
+        """Освобождает ресурсы хранилища."""
+
+
+class JsonStorage(Storage):
+    """
+    Прежний формат: users.json и portfolios.json. Пользователи ищутся и
+    добавляются через индексированный каталог (UserDirectory), изменения
+    портфелей и сделки пишутся в журнал (PortfolioJournal), а portfolios.json
+    служит его периодическим снимком.
+    """
+
+    def __init__(self, users: UserDirectory = None, journal: PortfolioJournal = None):
+        self.users = users or user_directory
+        self.journal = journal or portfolio_journal
+
+    def find_user(self, username: str) -> Optional[User]:
+        return self.users.find(username)
+
+    def get_user(self, user_id: int) -> Optional[User]:
+        return self.users.get(user_id)
+
+    def create_user(self, username: str, hashed_password: str, salt: str, registration_date: datetime) -> User:
+        return self.users.add(username, hashed_password, salt, registration_date)
+
+    def load_portfolio(self, user_id: int) -> Optional[Portfolio]:
+        loaded = self.journal.load(user_id)
+        if loaded is None:
+            return None
+        balances, version = loaded
+        return Portfolio(user_id, {code: Wallet(code, balance) for code, balance in balances.items()}, version)
+
+    def portfolio_version(self, user_id: int) -> int:
+        return self.journal.version(user_id)
+
+    def save_portfolio(self, portfolio: Portfolio) -> None:
+        balances = {code: wallet.balance for code, wallet in portfolio.wallets.items()}
+        self.journal.append([{"user_id": portfolio.user, "balances": balances, "replace": True}])
+        portfolio.version = self.journal.version(portfolio.user)
+
+    def save_wallets(
+        self,
+        user_id: int,
+        balances: Dict[str, float],
+        trades: Optional[List[Dict[str, Any]]] = None,
+        expected_version: Optional[int] = None
+    ) -> int:
+        entry = {"user_id": user_id, "balances": balances}
+        if trades:
+            entry["trades"] = trades
+        expected = {user_id: expected_version} if expected_version is not None else None
+        self.journal.append([entry], expected)
+        return self.journal.version(user_id)
+
+
+class ShardedStorage(JsonStorage):
+    """
+    Пользователи — в users.json (UserDirectory), портфели — по файлам
+    пользователей в шардах (ShardedPortfolioStore): сделки разных
+    пользователей не блокируют друг друга.
+
+    Если каталога шардов ещё нет, а рядом лежат portfolios.json или журнал,
+    портфели переносятся из них при первом обращении.
+    """
+
+    def __init__(
+        self,
+        users: UserDirectory = None,
+        shards: ShardedPortfolioStore = None,
+        journal: PortfolioJournal = None,
+        auto_migrate: bool = True
+    ):
+        super().__init__(users, journal)
+        self.shards = shards or portfolio_shards
+        self.auto_migrate = auto_migrate
+        self._lock = threading.Lock()
+        self._ready = False
+
+    def _ensure_ready(self) -> None:
+        """Переносит портфели из portfolios.json и журнала, если раскладки ещё нет."""
+        if self._ready:
+            return
+        with self._lock:
+            if self._ready:
+                return
+            if (self.auto_migrate and not os.path.exists(self.shards.directory)
+                    and (os.path.exists(self.journal.snapshot_file) or os.path.exists(self.journal.journal_file))):
+                count = self.shards.import_state(self.journal.state(), only_if_empty=True)
+                if count:
+                    print(f"Портфели перенесены в {self.shards.directory}: {count}")
+            self._ready = True
+
+    def load_portfolio(self, user_id: int) -> Optional[Portfolio]:
+        self._ensure_ready()
+        record = self.shards.load(user_id)
+        if record is None:
+            return None
+        wallets = {code: Wallet(code, info["balance"]) for code, info in record["wallets"].items()}
+        return Portfolio(user_id, wallets, record.get("version", 0))
+
+    def portfolio_version(self, user_id: int) -> int:
+        self._ensure_ready()
+        return self.shards.version(user_id)
+
+    def save_portfolio(self, portfolio: Portfolio) -> None:
+        self._ensure_ready()
+        balances = {code: wallet.balance for code, wallet in portfolio.wallets.items()}
+        portfolio.version = self.shards.update(portfolio.user, balances, replace=True)
+
+    def save_wallets(
+        self,
+        user_id: int,
+        balances: Dict[str, float],
+        trades: Optional[List[Dict[str, Any]]] = None,
+        expected_version: Optional[int] = None
+    ) -> int:
+        self._ensure_ready()
+        return self.shards.update(user_id, balances, trades=trades, expected_version=expected_version)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT NOT NULL UNIQUE,
+    hashed_password TEXT NOT NULL,
+    salt TEXT NOT NULL,
+    registration_date TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS wallets (
+    user_id INTEGER NOT NULL,
+    currency_code TEXT NOT NULL,
+    balance REAL NOT NULL,
+    PRIMARY KEY (user_id, currency_code)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS trades (
+    trade_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    side TEXT NOT NULL,
+    currency_code TEXT NOT NULL,
+    amount REAL NOT NULL,
+    base_currency TEXT NOT NULL,
+    rate REAL NOT NULL,
+    cost REAL NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS trades_user_idx ON trades (user_id, trade_id);
+CREATE TABLE IF NOT EXISTS portfolio_versions (
+    user_id INTEGER PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+"""
+
+UPSERT_WALLET = (
+    "INSERT INTO wallets (user_id, currency_code, balance) VALUES (?, ?, ?) "
+    "ON CONFLICT (user_id, currency_code) DO UPDATE SET balance = excluded.balance"
+)
+
+
+class SqliteStorage(Storage):
+    """
+    Хранилище на SQLite в режиме WAL: читатели не ждут писателя, а сделка
+    обновляет только строки своих кошельков. Запись идёт в транзакциях
+    BEGIN IMMEDIATE, поэтому несколько процессов могут работать с одной базой.
+
+    База открывается при первом обращении; если её ещё нет, а рядом лежат
+    users.json и portfolios.json, данные переносятся из них автоматически.
+    """
+
+    def __init__(
+        self,
+        path: str = DATABASE_FILE,
+        users_file: str = USERS_FILE,
+        portfolios_file: str = PORTFOLIOS_FILE,
+        auto_migrate: bool = True
+    ):
+        """
+        Args:
+            path: файл базы.
+            users_file, portfolios_file: JSON‑файлы для автоматического переноса.
+            auto_migrate: переносить данные из JSON при создании новой базы.
+        """
+        self.path = path
+        self.users_file = users_file
+        self.portfolios_file = portfolios_file
+        self.auto_migrate = auto_migrate
+        self._lock = threading.RLock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connection(self) -> sqlite3.Connection:
+        with self._lock:
+            if self._conn is None:
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                fresh = not os.path.exists(self.path)
+                # isolation_level=None: транзакции открываются явно в _transaction
+                conn = sqlite3.connect(self.path, timeout=30.0, isolation_level=None, check_same_thread=False)
+                conn.row_factory = sqlite3.Row
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                conn.executescript(SCHEMA)
+                self._conn = conn
+                if fresh and self.auto_migrate and (os.path.exists(self.users_file) or os.path.exists(self.portfolios_file)):
+                    users, wallets = self.import_json(self.users_file, self.portfolios_file)
+                    print(f"Данные перенесены в {self.path}: пользователей {users}, кошельков {wallets}")
+            return self._conn
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """Транзакция записи: BEGIN IMMEDIATE сразу берёт блокировку базы."""
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    @staticmethod
+    def _user_from_row(row: sqlite3.Row) -> User:
+        return User(
+            user_id=row["user_id"],
+            username=row["username"],
+            hashed_password=row["hashed_password"],
+            salt=row["salt"],
+            registration_date=datetime.fromisoformat(row["registration_date"])
+        )
+
+    def _fetch_user(self, where: str, value: Any) -> Optional[User]:
+        with self._lock:
+            row = self._connection().execute(f"SELECT * FROM users WHERE {where} = ?", (value,)).fetchone()
+        return self._user_from_row(row) if row is not None else None
+
+    def find_user(self, username: str) -> Optional[User]:
+        return self._fetch_user("username", username)
+
+    def get_user(self, user_id: int) -> Optional[User]:
+        return self._fetch_user("user_id", user_id)
+
+    def create_user(self, username: str, hashed_password: str, salt: str, registration_date: datetime) -> User:
+        try:
+            with self._transaction() as conn:
+                cursor = conn.execute(
+                    "INSERT INTO users (username, hashed_password, salt, registration_date) VALUES (?, ?, ?, ?)",
+                    (username, hashed_password, salt, registration_date.isoformat())
+                )
+        except sqlite3.IntegrityError:
+            raise ValueError(f"Имя пользователя '{username}' уже занято")
+        return User(cursor.lastrowid, username, hashed_password, salt, registration_date)
+
+    @staticmethod
+    def _version(conn: sqlite3.Connection, user_id: int) -> int:
+        row = conn.execute("SELECT version FROM portfolio_versions WHERE user_id = ?", (user_id,)).fetchone()
+        return row["version"] if row is not None else 0
+
+    @staticmethod
+    def _bump_version(conn: sqlite3.Connection, user_id: int, version: int) -> int:
+        conn.execute(
+            "INSERT INTO portfolio_versions (user_id, version) VALUES (?, ?) "
+            "ON CONFLICT (user_id) DO UPDATE SET version = excluded.version",
+            (user_id, version + 1)
+        )
+        return version + 1
+
+    def load_portfolio(self, user_id: int) -> Optional[Portfolio]:
+        with self._lock:
+            conn = self._connection()
+            # Балансы и версия — из одного снимка базы
+            conn.execute("BEGIN")
+            try:
+                rows = conn.execute(
+                    "SELECT currency_code, balance FROM wallets WHERE user_id = ?", (user_id,)
+                ).fetchall()
+                version = self._version(conn, user_id)
+            finally:
+                conn.execute("COMMIT")
+        if not rows:
+            return None
+        wallets = {row["currency_code"]: Wallet(row["currency_code"], row["balance"]) for row in rows}
+        return Portfolio(user_id, wallets, version)
+
+    def portfolio_version(self, user_id: int) -> int:
+        with self._lock:
+            return self._version(self._connection(), user_id)
+
+    def save_portfolio(self, portfolio: Portfolio) -> None:
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM wallets WHERE user_id = ?", (portfolio.user,))
+            conn.executemany(
+                UPSERT_WALLET,
+                [(portfolio.user, code, wallet.balance) for code, wallet in portfolio.wallets.items()]
+            )
+            portfolio.version = self._bump_version(conn, portfolio.user, self._version(conn, portfolio.user))
+
+    def save_wallets(
+        self,
+        user_id: int,
+        balances: Dict[str, float],
+        trades: Optional[List[Dict[str, Any]]] = None,
+        expected_version: Optional[int] = None
+    ) -> int:
+        with self._transaction() as conn:
+            version = self._version(conn, user_id)
+            if expected_version is not None and version != expected_version:
+                raise ConcurrentModificationError(user_id, expected_version, version)
+            conn.executemany(UPSERT_WALLET, [(user_id, code, balance) for code, balance in balances.items()])
+            conn.executemany(
+                "INSERT INTO trades (user_id, side, currency_code, amount, base_currency, rate, cost, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(user_id, trade["side"], trade["currency"], trade["amount"], trade["base_currency"],
+                  trade["rate"], trade["cost"], trade["timestamp"]) for trade in trades or []]
+            )
+            return self._bump_version(conn, user_id, version)
+
+    def import_json(
+        self,
+        users_file: str,
+        portfolios_file: str,
+        journal_file: str = PORTFOLIOS_JOURNAL_FILE
+    ) -> Tuple[int, int]:
+        """
+        Переносит пользователей и портфели из JSON‑файлов (id пользователей
+        сохраняются, существующие записи с теми же ключами заменяются).
+        Портфели берутся из снимка portfolios_file с журналом journal_file.
+
+        Returns:
+            (число пользователей, число кошельков).
+        """
+        users = []
+        if os.path.exists(users_file):
+            with open(users_file, "r", encoding="utf-8") as f:
+                users = json.load(f)
+
+        state = PortfolioJournal(portfolios_file, journal_file).state()
+        wallets = [
+            (user_id, code, balance)
+            for user_id, balances in state.items()
+            for code, balance in balances.items()
+        ]
+
+        with self._transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO users (user_id, username, hashed_password, salt, registration_date) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(u["user_id"], u["username"], u["hashed_password"], u["salt"], u["registration_date"]) for u in users]
+            )
+            conn.executemany(UPSERT_WALLET, wallets)
+        return len(users), len(wallets)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+def migrate_json_to_sqlite(
+    db_path: str = DATABASE_FILE,
+    users_file: str = USERS_FILE,
+    portfolios_file: str = PORTFOLIOS_FILE,
+    journal_file: str = PORTFOLIOS_JOURNAL_FILE
+) -> Tuple[int, int]:
+    """Переносит users.json и портфели (снимок и журнал) в базу SQLite, см. SqliteStorage.import_json."""
+    target = SqliteStorage(db_path, auto_migrate=False)
+    try:
+        return target.import_json(users_file, portfolios_file, journal_file)
+    finally:
+        target.close()
+
+
+def create_storage(backend: str = None) -> Storage:
+    """
+    Хранилище выбирается (в порядке приоритета): аргументом backend,
+    переменной окружения VALUTATRADE_STORAGE, настройкой storage_backend
+    загруженного файла настроек (SettingsLoader.load), constants.STORAGE_BACKEND.
+    Файл базы SQLite — VALUTATRADE_DATABASE, настройка database_file или
+    constants.DATABASE_FILE.
+    """
+    settings = SettingsLoader()
+    backend = (
+        backend
+        or os.getenv(STORAGE_BACKEND_ENV)
+        or settings.get("storage_backend", STORAGE_BACKEND)
+    ).strip().lower()
+    if backend == "sqlite":
+        return SqliteStorage(os.getenv(DATABASE_FILE_ENV) or settings.get("database_file", DATABASE_FILE))
+    if backend == "json":
+        return JsonStorage()
+    if backend == "sharded":
+        return ShardedStorage()
+    raise ValueError(f"Неизвестное хранилище '{backend}'. Доступны: sqlite, json, sharded")
+
+
+storage = create_storage()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Перенос пользователей и портфелей из JSON в SQLite")
+    parser.add_argument("--db", default=DATABASE_FILE)
+    parser.add_argument("--users", default=USERS_FILE)
+    parser.add_argument("--portfolios", default=PORTFOLIOS_FILE)
+    parser.add_argument("--journal", default=PORTFOLIOS_JOURNAL_FILE)
+    args = parser.parse_args()
+    users, wallets = migrate_json_to_sqlite(args.db, args.users, args.portfolios, args.journal)
+    print(f"Перенесено в {args.db}: пользователей {users}, кошельков {wallets}")
+
+
+if __name__ == "__main__":
+    main()
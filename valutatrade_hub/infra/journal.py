@@ -0,0 +1,347 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+from constants import (
+    JOURNAL_ARCHIVE_DIR, JOURNAL_GROUP_COMMIT_DELAY, JOURNAL_SNAPSHOT_EVERY, PORTFOLIOS_FILE, PORTFOLIOS_JOURNAL_FILE
+)
+from parse_service.fileutils import atomic_write_json, file_lock
+from valutatrade_hub.core.exceptions import ConcurrentModificationError
+
+
+def _stamp(path: str) -> Optional[List[int]]:
+    """Отпечаток файла (mtime в нс, размер, inode) или None, если файла нет."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [st.st_mtime_ns, st.st_size, st.st_ino]
+
+
+class _Pending:
+    """Запись, ожидающая групповой фиксации."""
+
+    __slots__ = ("data", "users", "expected", "done", "error")
+
+    def __init__(self, data: bytes, users: List[int], expected: Optional[Dict[int, int]]):
+        """
+        Args:
+            data: строки журнала.
+            users: user_id каждой строки (каждая строка увеличивает версию портфеля).
+            expected: {user_id: версия} — записать, только если версии совпадают.
+        """
+        self.data = data
+        self.users = users
+        self.expected = expected
+        self.done = False
+        self.error: Optional[BaseException] = None
+
+
+class PortfolioJournal:
+    """
+    Журнал упреждающей записи для портфелей в формате JSON.
+
+    Состояние портфелей = снимок (portfolios.json) + журнал изменений после
+    него. Каждая сделка дописывает в журнал одну строку с новыми балансами
+    затронутых кошельков и fsync; одновременные записи из нескольких потоков
+    фиксируются одной общей записью и одним fsync (групповая фиксация).
+    Записи хранят абсолютные балансы, поэтому повторное применение записи
+    безопасно. После JOURNAL_SNAPSHOT_EVERY записей состояние сохраняется в
+    новый снимок, а журнал со сделками переносится в архив (JOURNAL_ARCHIVE_DIR)
+    и начинается заново.
+
+    Состояние держится в памяти и дочитывается из журнала инкрементально;
+    смена снимка или журнала другим процессом замечается по отпечаткам файлов.
+    Каждая запись увеличивает версию портфеля пользователя; записи с
+    ожидаемой версией (append с expected_versions) тоже идут через групповую
+    фиксацию: ведущий поток проверяет версии всей пачки под исключительной
+    блокировкой, отклоняет конфликтующие записи и фиксирует остальные одним fsync.
+    """
+
+    def __init__(
+        self,
+        snapshot_file: str = PORTFOLIOS_FILE,
+        journal_file: str = PORTFOLIOS_JOURNAL_FILE,
+        archive_dir: str = JOURNAL_ARCHIVE_DIR,
+        snapshot_every: int = JOURNAL_SNAPSHOT_EVERY,
+        group_commit_delay: float = JOURNAL_GROUP_COMMIT_DELAY
+    ):
+        self.snapshot_file = snapshot_file
+        self.journal_file = journal_file
+        self.archive_dir = archive_dir
+        self.lock_file = journal_file + ".lock"
+        self.snapshot_every = snapshot_every
+        self.group_commit_delay = group_commit_delay
+        self._state_lock = threading.RLock()
+        self._leader = threading.Lock()
+        self._queue_lock = threading.Lock()
+        self._queue: List[_Pending] = []
+        self._state: Dict[int, Dict[str, float]] = {}
+        self._versions: Dict[int, int] = {}
+        self._snapshot_stamp = None
+        self._journal_inode = None
+        self._offset = 0
+        self._entries = 0
+        self._loaded = False
+        # Часть журнала, уже учтённая в снимке: {"inode", "offset"} или None
+        self._covered: Optional[Dict[str, int]] = None
+
+    # --- чтение состояния ---
+
+    def _apply(self, entry: Dict[str, Any]) -> None:
+        user_id = entry["user_id"]
+        if entry.get("replace") or user_id not in self._state:
+            self._state[user_id] = {}
+        self._state[user_id].update(entry["balances"])
+        self._versions[user_id] = self._versions.get(user_id, 0) + 1
+
+    def _load_snapshot(self) -> None:
+        self._state, self._versions, self._covered = {}, {}, None
+        try:
+            with open(self.snapshot_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        # Прежний формат снимка — список портфелей без отметки о журнале
+        if isinstance(data, dict):
+            self._covered = data.get("journal")
+            data = data.get("portfolios", [])
+        for item in data:
+            # Поддерживаются оба формата: {"USD": {"balance": 1.0}} и {"USD": 1.0}
+            self._state[item["user_id"]] = {
+                code: float(info["balance"] if isinstance(info, dict) else info)
+                for code, info in item.get("wallets", {}).items()
+            }
+            self._versions[item["user_id"]] = item.get("version", 0)
+
+    def _read_journal(self, offset: int) -> int:
+        """Применяет полные строки журнала начиная с offset; возвращает новое смещение."""
+        try:
+            with open(self.journal_file, 'rb') as f:
+                f.seek(offset)
+                data = f.read()
+        except FileNotFoundError:
+            return offset
+        # Неполная последняя строка — запись другого процесса ещё идёт
+        complete = data[:data.rfind(b"\n") + 1]
+        for line in complete.splitlines():
+            if not line.strip():
+                continue
+            try:
+                self._apply(json.loads(line))
+            except (json.JSONDecodeError, KeyError):
+                print(f"{self.journal_file}: пропущена повреждённая запись")
+            self._entries += 1
+        return offset + len(complete)
+
+    def _repair_tail(self) -> None:
+        """Обрезает строку, недописанную при сбое (под исключительной блокировкой)."""
+        try:
+            with open(self.journal_file, 'rb+') as f:
+                data = f.read()
+                if data and not data.endswith(b"\n"):
+                    f.truncate(data.rfind(b"\n") + 1)
+                    print(f"{self.journal_file}: отброшена недописанная запись")
+        except FileNotFoundError:
+            pass
+
+    def _reload_locked(self) -> None:
+        """Полная загрузка: снимок и воспроизведение журнала после него (под исключительной блокировкой)."""
+        self._repair_tail()
+        self._snapshot_stamp = _stamp(self.snapshot_file)
+        journal = _stamp(self.journal_file)
+        self._journal_inode = journal[2] if journal else None
+        self._load_snapshot()
+        self._entries = 0
+        self._offset = self._read_journal(self._covered_offset(journal))
+        self._loaded = True
+
+    def _covered_offset(self, journal: Optional[List[int]]) -> int:
+        """
+        С какого места воспроизводить журнал поверх снимка.
+
+        Если снимок записан, а журнал не успел уйти в архив (сбой между ними),
+        его начало уже учтено в снимке — повторное применение увеличило бы
+        версии портфелей ещё раз.
+        """
+        covered = self._covered
+        if (journal and covered and covered.get("inode") == journal[2]
+                and covered.get("offset", 0) <= journal[1]):
+            return covered["offset"]
+        return 0
+
+    def _refresh(self, locked: bool = False) -> None:
+        """
+        Дочитывает новые записи журнала или перезагружает всё, если сменился снимок.
+
+        Args:
+            locked: исключительная блокировка журнала уже взята вызывающим.
+        """
+        with self._state_lock:
+            journal = _stamp(self.journal_file)
+            inode = journal[2] if journal else None
+            if (not self._loaded or _stamp(self.snapshot_file) != self._snapshot_stamp
+                    or inode != self._journal_inode or (journal and journal[1] < self._offset)):
+                if locked:
+                    self._reload_locked()
+                else:
+                    with file_lock(self.lock_file):
+                        self._reload_locked()
+            elif journal and journal[1] > self._offset:
+                self._offset = self._read_journal(self._offset)
+
+    def load(self, user_id: int) -> Optional[Tuple[Dict[str, float], int]]:
+        """Балансы пользователя {код: баланс} и версия портфеля или None, если портфеля нет."""
+        with self._state_lock:
+            self._refresh()
+            wallets = self._state.get(user_id)
+            return (dict(wallets), self._versions.get(user_id, 0)) if wallets is not None else None
+
+    def version(self, user_id: int) -> int:
+        """Текущая версия портфеля пользователя (0 — портфеля нет)."""
+        with self._state_lock:
+            self._refresh()
+            return self._versions.get(user_id, 0)
+
+    def state(self) -> Dict[int, Dict[str, float]]:
+        """Балансы всех пользователей: {user_id: {код: баланс}}."""
+        with self._state_lock:
+            self._refresh()
+            return {user_id: dict(wallets) for user_id, wallets in self._state.items()}
+
+    # --- запись ---
+
+    def _append_bytes(self, data: bytes) -> None:
+        directory = os.path.dirname(self.journal_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fd = os.open(self.journal_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _write(self, batch: List[_Pending]) -> None:
+        """Дописывает пачку одной записью; записи с ожидаемой версией проверяются в её составе."""
+        if not any(item.expected for item in batch):
+            # Разделяемая блокировка: писать могут несколько процессов, снимок ждёт их
+            with file_lock(self.lock_file, shared=True):
+                self._append_bytes(b"".join(item.data for item in batch))
+            return
+
+        # Проверка версий и запись — под исключительной блокировкой, одним fsync на пачку
+        with self._state_lock, file_lock(self.lock_file):
+            self._refresh(locked=True)
+            versions = dict(self._versions)
+            accepted = []
+            for item in batch:
+                conflict = next(
+                    ((user_id, expected, versions.get(user_id, 0))
+                     for user_id, expected in (item.expected or {}).items()
+                     if versions.get(user_id, 0) != expected),
+                    None
+                )
+                if conflict is not None:
+                    item.error = ConcurrentModificationError(*conflict)
+                    continue
+                # Записи пачки применяются по порядку: следующая видит версии после предыдущей
+                for user_id in item.users:
+                    versions[user_id] = versions.get(user_id, 0) + 1
+                accepted.append(item)
+            if accepted:
+                self._append_bytes(b"".join(item.data for item in accepted))
+
+    def _commit(self, data: bytes, users: List[int], expected: Optional[Dict[int, int]] = None) -> None:
+        """
+        Групповая фиксация: первый поток становится ведущим и одной записью
+        с одним fsync фиксирует всё, что накопилось в очереди.
+        """
+        pending = _Pending(data, users, expected)
+        with self._queue_lock:
+            self._queue.append(pending)
+        with self._leader:
+            if not pending.done:
+                if self.group_commit_delay:
+                    time.sleep(self.group_commit_delay)
+                with self._queue_lock:
+                    batch, self._queue = self._queue, []
+                try:
+                    self._write(batch)
+                except BaseException as e:
+                    for item in batch:
+                        item.error = item.error or e
+                for item in batch:
+                    item.done = True
+        if pending.error is not None:
+            raise pending.error
+
+    def append(self, entries: List[Dict[str, Any]], expected_versions: Optional[Dict[int, int]] = None) -> None:
+        """
+        Фиксирует записи в журнале (одна строка на запись, общий fsync).
+
+        Args:
+            entries: записи {"user_id", "balances": {код: баланс}, "replace"?, "trades"?}.
+            expected_versions: {user_id: версия} — записать, только если версии
+                портфелей в журнале совпадают.
+
+        Raises:
+            ConcurrentModificationError: версия портфеля не совпала.
+        """
+        if not entries:
+            return
+        data = b"".join(json.dumps(entry, ensure_ascii=False).encode('utf-8') + b"\n" for entry in entries)
+        self._commit(data, [entry["user_id"] for entry in entries], expected_versions)
+        with self._state_lock:
+            self._refresh()
+            if self._entries >= self.snapshot_every:
+                self.snapshot(force=False)
+
+    # --- снимок ---
+
+    def snapshot(self, force: bool = True) -> None:
+        """
+        Сохраняет состояние в новый снимок и переносит журнал в архив.
+
+        Args:
+            force: снимать, даже если в журнале меньше JOURNAL_SNAPSHOT_EVERY записей
+                (иначе снимок пропускается — его мог только что сделать другой процесс).
+        """
+        with self._state_lock, file_lock(self.lock_file):
+            # Под исключительной блокировкой никто не пишет: читаем журнал целиком
+            self._reload_locked()
+            if not force and self._entries < self.snapshot_every:
+                return
+            snapshot = {
+                # Снимок отмечает, до какого места учтён журнал
+                "journal": {"inode": self._journal_inode, "offset": self._offset} if self._journal_inode else None,
+                "portfolios": [
+                    {
+                        "user_id": user_id,
+                        "version": self._versions.get(user_id, 0),
+                        "wallets": {code: {"balance": balance} for code, balance in wallets.items()}
+                    }
+                    for user_id, wallets in self._state.items()
+                ]
+            }
+            # Сначала снимок, затем перенос журнала: при сбое между ними журнал
+            # остаётся на месте, но его учтённая часть по отметке снимка пропускается
+            atomic_write_json(self.snapshot_file, snapshot, indent=2)
+            if os.path.exists(self.journal_file):
+                os.makedirs(self.archive_dir, exist_ok=True)
+                name = f"portfolios-{datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')}.jsonl"
+                os.replace(self.journal_file, os.path.join(self.archive_dir, name))
+
+            self._snapshot_stamp = _stamp(self.snapshot_file)
+            self._journal_inode = None
+            self._covered = snapshot["journal"]
+            self._offset = 0
+            self._entries = 0
+            self._loaded = True
+
+
+portfolio_journal = PortfolioJournal()
@@ -0,0 +1,254 @@
+import argparse
+import json
+import os
+import shutil
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from constants import PORTFOLIO_SHARDS, PORTFOLIOS_DIR
+from parse_service.fileutils import atomic_write_json, file_lock
+from valutatrade_hub.core.exceptions import ConcurrentModificationError
+from valutatrade_hub.infra.journal import portfolio_journal
+
+LAYOUT_FILE = "layout.json"
+TRADES_NAME = "trades.jsonl"
+LOCK_NAME = ".lock"
+
+
+class ShardedPortfolioStore:
+    """
+    Портфели в отдельных файлах: <directory>/<шард>/<user_id>.json, шард = user_id % shards.
+
+    Запись портфеля идёт под блокировкой его шарда (flock) с атомарной
+    заменой файла, поэтому сделки пользователей из разных шардов выполняются
+    параллельно, в том числе из разных процессов. Сделки дописываются в
+    trades.jsonl своего шарда. Число шардов хранится в layout.json и
+    меняется инструментом reshard, который строит новую раскладку рядом и
+    подменяет каталог под исключительной блокировкой раскладки; обычные
+    операции держат эту блокировку разделяемой.
+    """
+
+    def __init__(self, directory: str = PORTFOLIOS_DIR, default_shards: int = PORTFOLIO_SHARDS):
+        self.directory = directory
+        self.default_shards = default_shards
+        self.layout_lock = directory.rstrip(os.sep) + ".lock"
+        self.staging = directory.rstrip(os.sep) + ".reshard"
+
+    # --- раскладка ---
+
+    def _recover(self) -> None:
+        """Завершает подмену каталога, прерванную сбоем во время reshard."""
+        if os.path.exists(self.directory) or not os.path.exists(self.staging):
+            return
+        with file_lock(self.layout_lock):
+            if not os.path.exists(self.directory) and os.path.exists(self.staging):
+                os.replace(self.staging, self.directory)
+
+    def _shard_count(self) -> int:
+        try:
+            with open(os.path.join(self.directory, LAYOUT_FILE), 'r', encoding='utf-8') as f:
+                return json.load(f)["shards"]
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            return self.default_shards
+
+    @contextmanager
+    def _layout(self) -> Iterator[int]:
+        """Разделяемая блокировка раскладки; отдаёт число шардов."""
+        self._recover()
+        with file_lock(self.layout_lock, shared=True):
+            yield self._shard_count()
+
+    @staticmethod
+    def shard_name(user_id: int, shards: int) -> str:
+        return f"{user_id % shards:03d}"
+
+    def _shard_dir(self, user_id: int, shards: int) -> str:
+        return os.path.join(self.directory, self.shard_name(user_id, shards))
+
+    # --- портфели ---
+
+    @staticmethod
+    def _read(path: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def load(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """
+        Запись портфеля {"user_id", "version", "wallets": {код: {"balance": ...}}}
+        или None. Файлы заменяются атомарно, блокировка шарда не нужна.
+        """
+        with self._layout() as shards:
+            return self._read(os.path.join(self._shard_dir(user_id, shards), f"{user_id}.json"))
+
+    def version(self, user_id: int) -> int:
+        """Текущая версия портфеля (0 — портфеля нет)."""
+        record = self.load(user_id)
+        return record.get("version", 0) if record is not None else 0
+
+    def update(
+        self,
+        user_id: int,
+        balances: Dict[str, float],
+        replace: bool = False,
+        trades: Optional[List[Dict[str, Any]]] = None,
+        expected_version: Optional[int] = None
+    ) -> int:
+        """
+        Обновляет балансы кошельков пользователя под блокировкой шарда.
+
+        Args:
+            balances: {код валюты: новый баланс}.
+            replace: заменить набор кошельков целиком.
+            trades: записи о сделках для trades.jsonl шарда.
+            expected_version: записать, только если версия портфеля совпадает.
+
+        Returns:
+            Новая версия портфеля.
+
+        Raises:
+            ConcurrentModificationError: версия портфеля не совпала.
+        """
+        with self._layout() as shards:
+            shard_dir = self._shard_dir(user_id, shards)
+            os.makedirs(shard_dir, exist_ok=True)
+            layout = os.path.join(self.directory, LAYOUT_FILE)
+            if not os.path.exists(layout):
+                # Фиксируем число шардов первой записью, чтобы смена настройки не сдвинула раскладку
+                atomic_write_json(layout, {"shards": shards})
+            with file_lock(os.path.join(shard_dir, LOCK_NAME)):
+                path = os.path.join(shard_dir, f"{user_id}.json")
+                record = self._read(path) or {"user_id": user_id, "version": 0, "wallets": {}}
+                if expected_version is not None and record.get("version", 0) != expected_version:
+                    raise ConcurrentModificationError(user_id, expected_version, record.get("version", 0))
+                if replace:
+                    record["wallets"] = {}
+                for code, balance in balances.items():
+                    record["wallets"][code] = {"balance": balance}
+                record["version"] = record.get("version", 0) + 1
+                atomic_write_json(path, record, indent=2)
+                if trades:
+                    self._append_trades(shard_dir, [dict(trade, user_id=user_id) for trade in trades])
+                return record["version"]
+
+    @staticmethod
+    def _append_trades(shard_dir: str, trades: List[Dict[str, Any]]) -> None:
+        with open(os.path.join(shard_dir, TRADES_NAME), 'a', encoding='utf-8') as f:
+            f.write("".join(json.dumps(trade, ensure_ascii=False) + "\n" for trade in trades))
+            f.flush()
+            os.fsync(f.fileno())
+
+    # --- перераскладка ---
+
+    def _collect(self) -> Tuple[Dict[int, Dict[str, Any]], List[Dict[str, Any]]]:
+        """Все портфели и сделки текущей раскладки (под исключительной блокировкой)."""
+        records, trades = {}, []
+        if not os.path.isdir(self.directory):
+            return records, trades
+        for shard in sorted(os.listdir(self.directory)):
+            shard_dir = os.path.join(self.directory, shard)
+            if not os.path.isdir(shard_dir):
+                continue
+            for name in os.listdir(shard_dir):
+                if name.endswith(".json"):
+                    record = self._read(os.path.join(shard_dir, name))
+                    records[record["user_id"]] = record
+                elif name == TRADES_NAME:
+                    with open(os.path.join(shard_dir, name), 'r', encoding='utf-8') as f:
+                        trades.extend(json.loads(line) for line in f if line.strip())
+        return records, trades
+
+    def _swap_in(self, records: Dict[int, Dict[str, Any]], trades: List[Dict[str, Any]], shards: int) -> None:
+        """Строит раскладку в staging и подменяет ею каталог (под исключительной блокировкой)."""
+        if os.path.exists(self.staging):
+            shutil.rmtree(self.staging)
+        os.makedirs(self.staging)
+        for user_id, record in records.items():
+            shard_dir = os.path.join(self.staging, self.shard_name(user_id, shards))
+            os.makedirs(shard_dir, exist_ok=True)
+            atomic_write_json(os.path.join(shard_dir, f"{user_id}.json"), record, indent=2)
+        by_shard: Dict[str, List[Dict[str, Any]]] = {}
+        for trade in trades:
+            by_shard.setdefault(self.shard_name(trade["user_id"], shards), []).append(trade)
+        for shard, shard_trades in by_shard.items():
+            shard_dir = os.path.join(self.staging, shard)
+            os.makedirs(shard_dir, exist_ok=True)
+            self._append_trades(shard_dir, shard_trades)
+        atomic_write_json(os.path.join(self.staging, LAYOUT_FILE), {"shards": shards})
+
+        retired = None
+        if os.path.exists(self.directory):
+            retired = f"{self.directory.rstrip(os.sep)}.old-{datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')}"
+            os.replace(self.directory, retired)
+        # При сбое между переименованиями раскладку вернёт _recover
+        os.replace(self.staging, self.directory)
+        if retired:
+            shutil.rmtree(retired)
+
+    def reshard(self, shards: int) -> int:
+        """
+        Раскладывает портфели и сделки по новому числу шардов.
+
+        Returns:
+            Число перенесённых портфелей.
+        """
+        if shards < 1:
+            raise ValueError("Число шардов должно быть положительным.")
+        self._recover()
+        with file_lock(self.layout_lock):
+            records, trades = self._collect()
+            self._swap_in(records, trades, shards)
+        return len(records)
+
+    def import_state(self, state: Dict[int, Dict[str, float]], shards: int = None, only_if_empty: bool = False) -> int:
+        """
+        Заменяет раскладку портфелями из state ({user_id: {код: баланс}}),
+        например из portfolios.json с журналом. Сделки текущей раскладки сохраняются.
+
+        Args:
+            only_if_empty: переносить, только если раскладки ещё нет (проверяется
+                под блокировкой — перенос при первом запуске из нескольких процессов).
+
+        Returns:
+            Число перенесённых портфелей.
+        """
+        self._recover()
+        with file_lock(self.layout_lock):
+            if only_if_empty and os.path.exists(self.directory):
+                return 0
+            shards = shards or self._shard_count()
+            _, trades = self._collect()
+            records = {
+                user_id: {
+                    "user_id": user_id,
+                    "version": 1,
+                    "wallets": {code: {"balance": balance} for code, balance in wallets.items()}
+                }
+                for user_id, wallets in state.items()
+            }
+            self._swap_in(records, trades, shards)
+        return len(records)
+
+
+portfolio_shards = ShardedPortfolioStore()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Перераскладка портфелей по шардам")
+    parser.add_argument("--shards", type=int, default=PORTFOLIO_SHARDS, help="новое число шардов")
+    parser.add_argument("--dir", default=PORTFOLIOS_DIR)
+    parser.add_argument("--from-json", action="store_true", help="взять портфели из portfolios.json и журнала")
+    args = parser.parse_args()
+
+    store = ShardedPortfolioStore(args.dir)
+    if args.from_json:
+        count = store.import_state(portfolio_journal.state(), args.shards)
+    else:
+        count = store.reshard(args.shards)
+    print(f"{args.dir}: портфелей {count}, шардов {args.shards}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+import json
+import os
+import struct
+import threading
+import zlib
+from typing import Any, Dict, List, Optional, Tuple
+from constants import USERS_FILE, USERS_INDEX_FILE, USERS_INDEX_PARTITIONS
+from parse_service.fileutils import atomic_write_bytes, atomic_write_json, file_lock
+from valutatrade_hub.core.models import User
+
+# Конец файла users.json в построчном формате: последняя запись, перевод строки и «]»
+TAIL = b"\n]\n"
+EMPTY = b"[\n]\n"
+# Версия формата индекса: заголовок + разделы имён + таблица смещений
+INDEX_VERSION = 2
+# Запись таблицы смещений: (смещение, длина) строки пользователя в users.json
+OFFSET_RECORD = struct.Struct("<QQ")
+OFFSETS_NAME = "offsets.bin"
+
+
+def _stamp(path: str) -> Optional[List[int]]:
+    """Отпечаток файла (mtime в нс, размер, inode) или None, если файла нет."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [st.st_mtime_ns, st.st_size, st.st_ino]
+
+
+class UserDirectory:
+    """
+    Каталог пользователей users.json с индексом для поиска без полного чтения.
+
+    users.json остаётся JSON‑списком, но каждая запись лежит на своей строке.
+    Индекс состоит из трёх частей:
+    - заголовок (USERS_INDEX_FILE): отпечаток users.json и следующий свободный id;
+    - разделы имён (<индекс>/names-NN.jsonl): имя → user_id, раздел выбирается
+      по хешу имени, строки только дописываются;
+    - таблица смещений (<индекс>/offsets.bin): запись фиксированной длины
+      на user_id с (смещение, длина) строки в users.json.
+
+    Вход читает один раздел имён, одну запись таблицы и одну строку
+    users.json; регистрация дописывает строку в users.json, строку в один
+    раздел и запись в таблицу и переписывает только маленький заголовок.
+    Индекс привязан к отпечатку users.json: если файл изменили в обход
+    каталога (другой формат, ручная правка) или регистрация прервалась,
+    индекс перестраивается, а файл переписывается построчно.
+    """
+
+    def __init__(
+        self,
+        users_file: str = USERS_FILE,
+        index_file: str = USERS_INDEX_FILE,
+        partitions: int = USERS_INDEX_PARTITIONS
+    ):
+        self.users_file = users_file
+        self.index_file = index_file
+        self.index_dir = os.path.splitext(index_file)[0]
+        self.partitions = max(partitions, 1)
+        self.lock_file = users_file + ".lock"
+        self._lock = threading.Lock()
+        self._head: Optional[Dict[str, Any]] = None
+        # Прочитанные разделы имён; действительны, пока не сменился заголовок
+        self._names: Dict[int, Dict[str, int]] = {}
+
+    def _partition(self, username: str) -> int:
+        return zlib.crc32(username.encode('utf-8')) % self.partitions
+
+    def _partition_path(self, partition: int) -> str:
+        return os.path.join(self.index_dir, f"names-{partition:02d}.jsonl")
+
+    @property
+    def _offsets_path(self) -> str:
+        return os.path.join(self.index_dir, OFFSETS_NAME)
+
+    def _load_head(self) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self.index_file, 'r', encoding='utf-8') as f:
+                head = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        # Индекс прежнего формата или с другим числом разделов перестраивается
+        if head.get("version") != INDEX_VERSION or head.get("partitions") != self.partitions:
+            return None
+        return head
+
+    def _head_valid(self, head: Optional[Dict[str, Any]]) -> bool:
+        return head is not None and head.get("stamp") is not None and head["stamp"] == _stamp(self.users_file)
+
+    def _read_records(self) -> List[Dict[str, Any]]:
+        """
+        Все записи users.json. Недописанная последняя строка (сбой во время
+        регистрации) отбрасывается.
+        """
+        try:
+            with open(self.users_file, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        try:
+            return json.loads(data)
+        except json.JSONDecodeError:
+            pass
+        records = []
+        for line in data.splitlines():
+            line = line.strip().rstrip(b",")
+            if not line.startswith(b"{"):
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                print(f"{self.users_file}: пропущена повреждённая запись")
+        return records
+
+    def _rebuild(self) -> Dict[str, Any]:
+        """Переписывает users.json построчно и строит индекс заново (под блокировкой)."""
+        records = self._read_records()
+        lines = [json.dumps(record, ensure_ascii=False).encode('utf-8') for record in records]
+        partitions: List[List[bytes]] = [[] for _ in range(self.partitions)]
+        next_id = max((record["user_id"] for record in records), default=0) + 1
+        offsets = bytearray(OFFSET_RECORD.size * (next_id - 1))
+        position = 2  # после «[\n»
+        for record, line in zip(records, lines):
+            partitions[self._partition(record["username"])].append(self._name_line(record["username"], record["user_id"]))
+            OFFSET_RECORD.pack_into(offsets, OFFSET_RECORD.size * (record["user_id"] - 1), position, len(line))
+            position += len(line) + 2  # «,\n» или «\n]»
+        data = b"[\n" + b",\n".join(lines) + TAIL if lines else EMPTY
+        atomic_write_bytes(self.users_file, data)
+
+        # Части индекса восстанавливаются из users.json, fsync не нужен
+        for partition, entries in enumerate(partitions):
+            atomic_write_bytes(self._partition_path(partition), b"".join(entries), fsync=False)
+        atomic_write_bytes(self._offsets_path, bytes(offsets), fsync=False)
+        self._names = {}
+        return self._save_head(next_id)
+
+    @staticmethod
+    def _name_line(username: str, user_id: int) -> bytes:
+        return json.dumps({"username": username, "user_id": user_id}, ensure_ascii=False).encode('utf-8') + b"\n"
+
+    def _save_head(self, next_id: int) -> Dict[str, Any]:
+        head = {
+            "version": INDEX_VERSION,
+            "partitions": self.partitions,
+            "stamp": _stamp(self.users_file),
+            "next_id": next_id
+        }
+        atomic_write_json(self.index_file, head, fsync=False)
+        self._head = head
+        return head
+
+    def _current_head(self) -> Dict[str, Any]:
+        """Заголовок индекса, соответствующий текущему users.json; при расхождении — перестроенный."""
+        with self._lock:
+            if self._head_valid(self._head):
+                return self._head
+            head = self._load_head()
+            if self._head_valid(head):
+                self._head, self._names = head, {}
+                return head
+        with file_lock(self.lock_file):
+            with self._lock:
+                # Пока ждали блокировку, индекс мог перестроить другой процесс
+                head = self._load_head()
+                if self._head_valid(head):
+                    self._head, self._names = head, {}
+                    return head
+                return self._rebuild()
+
+    def _read_partition(self, partition: int) -> Dict[str, int]:
+        """Имена одного раздела. Недописанная последняя строка пропускается."""
+        names = {}
+        try:
+            with open(self._partition_path(partition), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return names
+        for line in data[:data.rfind(b"\n") + 1].splitlines():
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            names[entry["username"]] = entry["user_id"]
+        return names
+
+    def _lookup_name(self, username: str) -> Optional[int]:
+        self._current_head()
+        partition = self._partition(username)
+        with self._lock:
+            names = self._names.get(partition)
+        if names is None or username not in names:
+            # Раздел мог пополнить другой процесс — перечитываем только его
+            names = self._read_partition(partition)
+            with self._lock:
+                self._names[partition] = names
+        return names.get(username)
+
+    def _location(self, user_id: int) -> Optional[Tuple[int, int]]:
+        """(смещение, длина) строки пользователя в users.json по таблице смещений."""
+        if user_id < 1:
+            return None
+        try:
+            with open(self._offsets_path, 'rb') as f:
+                f.seek(OFFSET_RECORD.size * (user_id - 1))
+                data = f.read(OFFSET_RECORD.size)
+        except FileNotFoundError:
+            return None
+        if len(data) < OFFSET_RECORD.size:
+            return None
+        offset, length = OFFSET_RECORD.unpack(data)
+        return (offset, length) if length else None
+
+    def _read_record(self, user_id: int) -> Optional[Dict[str, Any]]:
+        location = self._location(user_id)
+        if location is None:
+            return None
+        offset, length = location
+        with open(self.users_file, 'rb') as f:
+            f.seek(offset)
+            line = f.read(length)
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            return None
+        return record if record.get("user_id") == user_id else None
+
+    def _get(self, user_id: int) -> Optional[User]:
+        for _ in range(2):
+            head = self._current_head()
+            if user_id >= head["next_id"]:
+                return None
+            record = self._read_record(user_id)
+            if record is not None:
+                return User.from_dict(record)
+            # Файл заменили между проверкой отпечатка и чтением — повторяем по свежему индексу
+            with self._lock:
+                self._head = None
+        return None
+
+    def get(self, user_id: int) -> Optional[User]:
+        """Пользователь по id или None."""
+        return self._get(user_id)
+
+    def find(self, username: str) -> Optional[User]:
+        """Пользователь по имени или None."""
+        user_id = self._lookup_name(username)
+        return self._get(user_id) if user_id is not None else None
+
+    @staticmethod
+    def _append(path: str, data: bytes) -> None:
+        with open(path, 'ab') as f:
+            f.write(data)
+
+    def add(self, username: str, hashed_password: str, salt: str, registration_date) -> User:
+        """
+        Регистрирует пользователя: выдаёт следующий id и дописывает строку в users.json.
+
+        Raises:
+            ValueError: имя уже занято.
+        """
+        with file_lock(self.lock_file), self._lock:
+            head = self._load_head()
+            if not self._head_valid(head):
+                head = self._rebuild()
+            partition = self._partition(username)
+            names = self._read_partition(partition)
+            if username in names:
+                raise ValueError(f"Имя пользователя '{username}' уже занято")
+
+            user = User(head["next_id"], username, hashed_password, salt, registration_date)
+            line = json.dumps(user.to_dict(), ensure_ascii=False).encode('utf-8')
+            with open(self.users_file, 'r+b') as f:
+                size = f.seek(0, os.SEEK_END)
+                if head["next_id"] > 1 and size > len(EMPTY):
+                    position, prefix = size - len(TAIL), b",\n"
+                else:
+                    position, prefix = len(EMPTY) - len(b"]\n"), b""
+                f.seek(position)
+                f.write(prefix + line + TAIL)
+                f.truncate()
+                f.flush()
+                os.fsync(f.fileno())
+
+            # Индекс дополняется одной записью; заголовок пишется последним —
+            # до него прерванная регистрация видна по отпечатку и ведёт к перестройке
+            self._append(self._partition_path(partition), self._name_line(username, user.user_id))
+            offsets = bytearray(OFFSET_RECORD.size * (user.user_id - 1) - self._offsets_size())
+            self._append(self._offsets_path, bytes(offsets) + OFFSET_RECORD.pack(position + len(prefix), len(line)))
+            names[username] = user.user_id
+            self._names[partition] = names
+            self._save_head(user.user_id + 1)
+            return user
+
+    def _offsets_size(self) -> int:
+        try:
+            return os.path.getsize(self._offsets_path)
+        except FileNotFoundError:
+            return 0
+
+
+user_directory = UserDirectory()
@@ -0,0 +1,24 @@
+import logging
+import os
+from constants import LOG_FILE
+
+
+def setup_logging(log_file: str = LOG_FILE, level: int = logging.INFO) -> None:
+    """
+    Направляет журнал обновления курсов (logger parse_service) в файл.
+
+    Фоновые обновления пишут туда вместо stdout, поэтому их сообщения не
+    смешиваются с выводом команд CLI. Повторный вызов ничего не делает.
+    """
+    logger = logging.getLogger("parse_service")
+    if logger.handlers:
+        return
+    directory = os.path.dirname(log_file)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    handler = logging.FileHandler(log_file, encoding='utf-8')
+    handler.setFormatter(logging.Formatter("%(asctime)s %(threadName)s %(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    # Сообщения не уходят выше — в stderr через обработчики корневого logger
+    logger.propagate = False